@@ -0,0 +1,326 @@
+"""
+Local stand-ins for everything the controller talks to, so that it can be booted and
+benchmarked on a plain Linux box without an X server, GPU, Docker daemon or network.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import random
+import stat
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import zmq
+import zmq.asyncio
+from aiohttp import web
+from PIL import Image
+
+# Stays alive until terminated, like the real shells and loader
+_FAKE_SHELL_SCRIPT = """#!/bin/sh
+exec sleep infinity
+"""
+
+_WM_ADDRESS = "tcp://127.0.0.1:5557"
+
+# About what a real thumbnail weighs as a JPEG
+_THUMBNAIL_SIZE = (1280, 720)
+
+
+def write_fake_shells(bin_path: Path):
+    bin_path.mkdir(parents=True, exist_ok=True)
+    for name in ["footron-web-shell", "footron-loader", "footron-capture-shell"]:
+        script_path = bin_path / name
+        script_path.write_text(_FAKE_SHELL_SCRIPT)
+        script_path.chmod(script_path.stat().st_mode | stat.S_IXUSR)
+
+
+def _thumbnail_jpeg() -> bytes:
+    # Smoothed noise, so that it compresses about as well as a real picture
+    rng = random.Random(0)
+    width, height = _THUMBNAIL_SIZE
+    noise_size = (width // 8, height // 8)
+    noise = Image.frombytes(
+        "RGB", noise_size, rng.randbytes(noise_size[0] * noise_size[1] * 3)
+    )
+    output = io.BytesIO()
+    noise.resize(_THUMBNAIL_SIZE, Image.BILINEAR).save(
+        output, format="JPEG", quality=85
+    )
+    return output.getvalue()
+
+
+def write_catalog(
+    experiences_path: Path,
+    web: int,
+    docker: int,
+    capture: int,
+    load_time: bool,
+    listed: bool = False,
+):
+    """
+    Listed experiences get a thumbnail, and with it the thumbnail hashing and color
+    lookups that the web interface needs. Pair them with write_color_cache unless
+    you want to measure color extraction too.
+    """
+    experiences_path.mkdir(parents=True, exist_ok=True)
+    thumbnail = _thumbnail_jpeg() if listed else None
+    counts = {"web": web, "docker": docker, "capture": capture}
+    for type, count in counts.items():
+        for i in range(count):
+            id = f"bench-{type}-{i}"
+            path = experiences_path / id
+            path.mkdir(exist_ok=True)
+            config: Dict[str, Any] = {
+                "type": type,
+                "id": id,
+                "title": f"Benchmark {type} {i}",
+                "description": "Benchmark experience",
+                "unlisted": not listed,
+            }
+            if thumbnail:
+                (path / "thumb.jpg").write_bytes(thumbnail)
+            if load_time:
+                config["load_time"] = 2
+            if type == "web":
+                (path / "static").mkdir(exist_ok=True)
+                (path / "static" / "index.html").write_text("<html></html>")
+            elif type == "docker":
+                config["image_id"] = f"footron/bench-{i}:latest"
+            elif type == "capture":
+                config["path"] = f"C:\\bench\\{id}.exe"
+            (path / "config.json").write_text(json.dumps(config))
+
+
+def write_color_cache(colors_path: Path, experiences_path: Path):
+    """
+    Colors for every thumbnail under `experiences_path`, as a controller that had
+    already processed them would have cached them.
+    """
+    palette = {str(tone): "#808080" for tone in range(0, 100 + 1, 5)}
+    cache = {
+        path.name: {
+            "hash": hashlib.sha256(thumbnail.read_bytes()).hexdigest(),
+            "colors": {
+                sub_palette: palette
+                for sub_palette in ["primary", "secondary", "tertiary"]
+            },
+        }
+        for thumbnail in experiences_path.glob("*/thumb.jpg")
+        for path in [thumbnail.parent]
+    }
+    colors_path.write_text(json.dumps(cache))
+
+
+class FakeWm:
+    """
+    The other end of WmApi's ZeroMQ PAIR socket, which acknowledges every message.
+    """
+
+    messages: int
+
+    def __init__(self):
+        self._context = zmq.asyncio.Context()
+        # noinspection PyUnresolvedReferences
+        self._socket = self._context.socket(zmq.PAIR)
+        self._socket.bind(_WM_ADDRESS)
+        self._task: Optional[asyncio.Task] = None
+        self.messages = 0
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self._receive())
+
+    async def _receive(self):
+        while True:
+            message = await self._socket.recv_json()
+            self.messages += 1
+            if "id" in message:
+                await self._socket.send_json({"type": "ack", "id": message["id"]})
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        self._socket.close(linger=0)
+        self._context.term()
+
+
+async def _start_site(app: web.Application, site_factory: Callable) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await site_factory(runner).start()
+    return runner
+
+
+class FakePlacard:
+    """
+    The placard's HTTP API, served over the same Unix socket PlacardApi uses.
+    """
+
+    def __init__(self, socket_path: Path):
+        self._socket_path = socket_path
+        self._state: Dict[str, Any] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _get(self, request: web.Request):
+        return web.json_response(self._state.get(request.path, {}))
+
+    async def _put(self, request: web.Request):
+        self._state[request.path] = await request.json()
+        return web.json_response(self._state[request.path])
+
+    async def start(self):
+        self._socket_path.parent.mkdir(parents=True, exist_ok=True)
+        app = web.Application()
+        app.router.add_get("/{path:.*}", self._get)
+        app.router.add_put("/{path:.*}", self._put)
+        self._runner = await _start_site(
+            app, lambda runner: web.UnixSite(runner, str(self._socket_path))
+        )
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class FakeCaptureApi:
+    """
+    The Windows capture machine's API, which reports a single running process for
+    whichever experience was set last.
+    """
+
+    def __init__(self, port: int):
+        self._port = port
+        self._current: Dict[str, Any] = {"id": None, "processes": None}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _get_current(self, request: web.Request):
+        return web.json_response(self._current)
+
+    async def _put_current(self, request: web.Request):
+        data = await request.json()
+        self._current = {
+            "id": data.get("id"),
+            "processes": 1 if data.get("id") else None,
+        }
+        return web.json_response(self._current)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/current", self._get_current)
+        app.router.add_put("/current", self._put_current)
+        self._runner = await _start_site(
+            app, lambda runner: web.TCPSite(runner, "127.0.0.1", self._port)
+        )
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+class FakeContainer:
+    _ids = itertools.count(1)
+
+    def __init__(self, image_id: str, labels: Dict[str, str]):
+        self.id = f"{next(self._ids):064x}"
+        self.short_id = self.id[:12]
+        self.image_id = image_id
+        self.labels = labels
+        self.status = "created"
+
+
+class _FakeImages:
+    def get(self, image_id: str):
+        return image_id
+
+
+class _FakeDockerClient:
+    images = _FakeImages()
+
+
+class FakeDockerApi:
+    """
+    Implements the DockerApi interface in memory, with configurable latency standing
+    in for the daemon's response times.
+    """
+
+    containers: Dict[str, FakeContainer]
+
+    def __init__(self, create_latency: float = 0.05, request_latency: float = 0.005):
+        self._create_latency = create_latency
+        self._request_latency = request_latency
+        self.containers = {}
+        self.client = _FakeDockerClient()
+
+    async def create_container(self, image_id: str, **kwargs) -> FakeContainer:
+        await asyncio.sleep(self._create_latency)
+        container = FakeContainer(image_id, kwargs.get("labels", {}))
+        self.containers[container.id] = container
+        return container
+
+    async def start_container(self, container: FakeContainer):
+        await asyncio.sleep(self._request_latency)
+        container.status = "running"
+
+    async def list_containers(
+        self, filters: Dict[str, Any], all: bool = False
+    ) -> List[FakeContainer]:
+        await asyncio.sleep(self._request_latency)
+        label_filter = filters.get("label")
+        status_filter = filters.get("status")
+        matching = []
+        for container in self.containers.values():
+            if not all and container.status not in ["running", "paused"]:
+                continue
+            if status_filter and container.status != status_filter:
+                continue
+            if label_filter:
+                key, _, value = label_filter.partition("=")
+                if key not in container.labels or (
+                    value and container.labels[key] != value
+                ):
+                    continue
+            matching.append(container)
+        return matching
+
+    async def container_status(self, container: FakeContainer) -> str:
+        await asyncio.sleep(self._request_latency)
+        return container.status
+
+    async def kill_container(self, container: FakeContainer):
+        await asyncio.sleep(self._request_latency)
+        # Experience containers are auto-removed once they exit
+        self.containers.pop(container.id, None)
+        container.status = "exited"
+
+    async def remove_container(self, container: FakeContainer):
+        await self.kill_container(container)
+
+    async def pause_container(self, container: FakeContainer):
+        await asyncio.sleep(self._request_latency)
+        container.status = "paused"
+
+    async def unpause_container(self, container: FakeContainer):
+        await asyncio.sleep(self._request_latency)
+        container.status = "running"
+
+    async def container_stats(self, container: FakeContainer) -> Dict[str, Any]:
+        await asyncio.sleep(self._request_latency)
+        return {"memory_stats": {"usage": 256 * 1024 * 1024}}
+
+    async def container_health(self, container: FakeContainer) -> Optional[str]:
+        await asyncio.sleep(self._request_latency)
+        return None
+
+    async def container_pids(self, container: FakeContainer) -> List[int]:
+        await asyncio.sleep(self._request_latency)
+        return []
+
+    def watch_container(self, container_id: str, callback) -> Callable[[], None]:
+        return lambda: None
+
+    def watch_container_health(self, container_id: str, callback) -> Callable[[], None]:
+        return lambda: None
@@ -0,0 +1,202 @@
+"""
+Headless controller startup benchmark.
+
+Boots the controller in a fresh process against the same local stand-ins as the
+switching benchmark (see fakes.py) and measures the time from process start to:
+
+- the first /experiences response
+- /experiences serving the full catalog
+
+Every boot is measured twice over: cold, without a catalog snapshot from a previous
+run, and warm, with one. Experiences are listed and have thumbnails unless you pass
+--unlisted, and their colors are cached as they would be on a controller that has run
+before. Results are printed (or written with --output) as JSON.
+Run from the repository root:
+
+    python -m benchmarks.startup --output startup.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .fakes import (
+    FakeCaptureApi,
+    FakeDockerApi,
+    FakePlacard,
+    FakeWm,
+    write_catalog,
+    write_color_cache,
+    write_fake_shells,
+)
+from .switching import (
+    _configure_environment,
+    _free_port,
+    _git_revision,
+    _kill_children,
+    _summarize,
+)
+
+
+async def _boot(catalog_size: int) -> Dict[str, float]:
+    # Imported late because footron_controller reads its configuration from the
+    # environment at import time
+    import httpx
+
+    import footron_controller.api as api
+    import footron_controller.data.docker_api as docker_api
+
+    docker_api._docker_api = FakeDockerApi()
+    docker_api._docker_api_created = True
+
+    wm = FakeWm()
+    wm.start()
+    placard = FakePlacard(Path(os.environ["XDG_RUNTIME_DIR"]) / "placard" / "socket")
+    await placard.start()
+    capture = FakeCaptureApi(int(os.environ["FT_CAPTURE_API_URL"].rsplit(":", 1)[1]))
+    await capture.start()
+
+    api.on_startup()
+    transport = httpx.ASGITransport(app=api.fastapi_app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://controller", timeout=None
+    ) as client:
+        response = await client.get("/experiences")
+        first_response = time.monotonic()
+        while len(response.json()) < catalog_size:
+            await asyncio.sleep(0.005)
+            response = await client.get("/experiences")
+        full_catalog = time.monotonic()
+
+    # Give the controller a chance to write its snapshot for the next boot
+    await asyncio.sleep(1)
+    return {"first_response": first_response, "full_catalog": full_catalog}
+
+
+def _run_child(args):
+    _configure_environment(args.child, args.capture_port)
+    timestamps = asyncio.get_event_loop().run_until_complete(
+        _boot(args.web + args.docker + args.capture)
+    )
+    print(json.dumps(timestamps))
+    _kill_children()
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def _measure_boot(args, data_path: Path) -> Dict[str, float]:
+    # CLOCK_MONOTONIC is shared between processes, so the child's timestamps line up
+    # with ours
+    start = time.monotonic()
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.startup",
+            "--child",
+            str(data_path),
+            "--capture-port",
+            str(_free_port()),
+            "--web",
+            str(args.web),
+            "--docker",
+            str(args.docker),
+            "--capture",
+            str(args.capture),
+        ],
+        text=True,
+        stderr=subprocess.DEVNULL,
+    )
+    timestamps = json.loads(output.strip().splitlines()[-1])
+    return {name: timestamp - start for name, timestamp in timestamps.items()}
+
+
+def _summarize_boots(boots: List[Dict[str, float]]) -> Dict[str, Any]:
+    return {
+        f"{name}_s": _summarize([boot[name] for boot in boots])
+        for name in ["first_response", "full_catalog"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--web", type=int, default=300, help="web experiences")
+    parser.add_argument("--docker", type=int, default=150, help="Docker experiences")
+    parser.add_argument("--capture", type=int, default=10, help="capture experiences")
+    parser.add_argument("--runs", type=int, default=5, help="boots per measurement")
+    parser.add_argument(
+        "--unlisted",
+        action="store_true",
+        help="unlisted experiences, which skip thumbnail hashing and colors",
+    )
+    parser.add_argument("--output", type=Path, help="write JSON results here")
+    parser.add_argument("--child", type=Path, help=argparse.SUPPRESS)
+    parser.add_argument("--capture-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _run_child(args)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="footron-bench-") as data_dir:
+        data_path = Path(data_dir)
+        write_fake_shells(data_path / "bin")
+        write_catalog(
+            data_path / "experiences",
+            args.web,
+            args.docker,
+            args.capture,
+            False,
+            listed=not args.unlisted,
+        )
+        write_color_cache(data_path / "colors.json", data_path / "experiences")
+        snapshot_path = data_path / "experience-data" / ".catalog-snapshot"
+
+        cold = []
+        for _ in range(args.runs):
+            snapshot_path.unlink(missing_ok=True)
+            cold.append(_measure_boot(args, data_path))
+        # The catalog was only just written, and files that recent aren't
+        # snapshotted yet, so we make sure the snapshot is complete first
+        _measure_boot(args, data_path)
+        warm = [_measure_boot(args, data_path) for _ in range(args.runs)]
+
+    cold_summary = _summarize_boots(cold)
+    warm_summary = _summarize_boots(warm)
+    results = {
+        "benchmark": "startup",
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "parameters": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+            if key not in ["child", "capture_port"]
+        },
+        "results": {
+            "cold": cold_summary,
+            "warm": warm_summary,
+            "full_catalog_speedup": statistics.fmean(
+                boot["full_catalog"] for boot in cold
+            )
+            / statistics.fmean(boot["full_catalog"] for boot in warm),
+        },
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
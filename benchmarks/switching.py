@@ -0,0 +1,361 @@
+"""
+Headless experience switching benchmark.
+
+Boots the controller's FastAPI app in-process against local stand-ins for the window
+manager, placard, capture API, web shell, loader and Docker (see fakes.py), then
+measures:
+
+- end-to-end PUT /current latency
+- switches per minute under sustained, timer-driven load
+- event loop stall time while switching
+- memory and file descriptor growth over thousands of switches
+
+Results are printed (or written with --output) as JSON so that runs can be compared
+between commits. Run from the repository root:
+
+    python -m benchmarks.switching --output before.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from .fakes import (
+    FakeCaptureApi,
+    FakeDockerApi,
+    FakePlacard,
+    FakeWm,
+    write_catalog,
+    write_fake_shells,
+)
+
+# Event loop lag sampling period, anything later than this counts as a stall
+_STALL_SAMPLE_INTERVAL_S = 0.01
+
+
+def _configure_environment(data_path: Path, capture_port: int):
+    # These are read when footron_controller is first imported
+    os.environ["FT_DATA_PATH"] = str(data_path)
+    os.environ["FT_CONFIG_PATH"] = str(data_path / "config")
+    os.environ["FT_CAPTURE_API_URL"] = f"http://127.0.0.1:{capture_port}"
+    os.environ["XDG_RUNTIME_DIR"] = str(data_path / "runtime")
+    os.environ.setdefault("DISPLAY", ":0")
+
+
+def _free_port() -> int:
+    import socket
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def _open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def _summarize(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "count": len(samples),
+        "mean": statistics.fmean(samples),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": ordered[-1],
+    }
+
+
+def _kill_children():
+    # Experiences' fake shells would otherwise outlive us
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            fields = stat_path.read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == os.getpid():
+            try:
+                os.kill(int(stat_path.parent.name), signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class StallMonitor:
+    """
+    Samples event loop lag while running, to measure how long the loop was blocked.
+    """
+
+    def __init__(self):
+        self._lags: List[float] = []
+        self._task = None
+
+    async def _sample(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + _STALL_SAMPLE_INTERVAL_S
+            await asyncio.sleep(_STALL_SAMPLE_INTERVAL_S)
+            self._lags.append(max(loop.time() - expected, 0))
+
+    def __enter__(self):
+        self._task = asyncio.get_event_loop().create_task(self._sample())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+    def results(self) -> Dict[str, Any]:
+        stalls = [lag for lag in self._lags if lag > _STALL_SAMPLE_INTERVAL_S]
+        return {
+            "lag_s": _summarize(self._lags),
+            "stalls": len(stalls),
+            "total_stall_s": sum(stalls),
+        }
+
+
+class SwitchingBenchmark:
+    def __init__(self, client, experience_ids: List[str]):
+        self._client = client
+        self._experience_ids = experience_ids
+        self._playlist: List[str] = []
+
+    def _pop_next(self) -> str:
+        # Same shuffled-playlist behavior as footron_timer
+        if not self._playlist:
+            self._playlist = random.sample(
+                self._experience_ids, len(self._experience_ids)
+            )
+        return self._playlist.pop()
+
+    def _peek_next(self) -> str:
+        if not self._playlist:
+            self._playlist = random.sample(
+                self._experience_ids, len(self._experience_ids)
+            )
+        return self._playlist[-1]
+
+    async def _switch(self, id: str) -> int:
+        # Wait for the transition to finish so that we measure the whole switch
+        response = await self._client.put(
+            "/current", params={"wait": True}, json={"id": id}
+        )
+        return response.status_code
+
+    async def latency(self, samples: int) -> Dict[str, Any]:
+        by_type: Dict[str, List[float]] = {}
+        rejected = 0
+        for _ in range(samples):
+            id = self._pop_next()
+            start = time.perf_counter()
+            status = await self._switch(id)
+            elapsed = time.perf_counter() - start
+            if status != 200:
+                rejected += 1
+                continue
+            by_type.setdefault(id.split("-")[1], []).append(elapsed)
+        all_samples = [sample for samples in by_type.values() for sample in samples]
+        return {
+            "put_current_s": _summarize(all_samples),
+            "put_current_by_type_s": {
+                type: _summarize(samples) for type, samples in by_type.items()
+            },
+            "rejected": rejected,
+        }
+
+    async def sustained(self, duration: float, tick: float) -> Dict[str, Any]:
+        switches = 0
+        rejected = 0
+        with StallMonitor() as stall_monitor:
+            end = time.perf_counter() + duration
+            while time.perf_counter() < end:
+                status = await self._switch(self._pop_next())
+                if status == 200:
+                    switches += 1
+                    await self._client.put("/next", json={"id": self._peek_next()})
+                else:
+                    rejected += 1
+                await asyncio.sleep(tick)
+        return {
+            "duration_s": duration,
+            "switches": switches,
+            "switches_per_minute": switches / duration * 60,
+            "rejected": rejected,
+            "event_loop": stall_monitor.results(),
+        }
+
+    async def soak(self, switches: int) -> Dict[str, Any]:
+        # Let startup settle before taking the baseline
+        await asyncio.sleep(1)
+        rss_start, fds_start = _rss_bytes(), _open_fds()
+        completed = 0
+        while completed < switches:
+            if await self._switch(self._pop_next()) == 200:
+                completed += 1
+        # Give background stops a chance to finish so we don't count them as leaks
+        await asyncio.sleep(3)
+        rss_end, fds_end = _rss_bytes(), _open_fds()
+        return {
+            "switches": completed,
+            "rss_start_bytes": rss_start,
+            "rss_end_bytes": rss_end,
+            "rss_growth_per_1000_switches_bytes": (rss_end - rss_start)
+            / completed
+            * 1000,
+            "open_fds_start": fds_start,
+            "open_fds_end": fds_end,
+        }
+
+
+async def _run(args) -> Dict[str, Any]:
+    # Imported late because footron_controller reads its configuration from the
+    # environment at import time
+    import httpx
+
+    import footron_controller.api as api
+    import footron_controller.data.docker_api as docker_api
+
+    docker = FakeDockerApi(create_latency=args.docker_create_latency)
+    docker_api._docker_api = docker
+    docker_api._docker_api_created = True
+
+    wm = FakeWm()
+    wm.start()
+    placard = FakePlacard(Path(os.environ["XDG_RUNTIME_DIR"]) / "placard" / "socket")
+    await placard.start()
+    capture = FakeCaptureApi(int(os.environ["FT_CAPTURE_API_URL"].rsplit(":", 1)[1]))
+    await capture.start()
+
+    catalog_size = args.web + args.docker + args.capture
+    startup_start = time.perf_counter()
+    api.on_startup()
+    transport = httpx.ASGITransport(app=api.fastapi_app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://controller", timeout=None
+    ) as client:
+        response = await client.get("/experiences")
+        startup_s = time.perf_counter() - startup_start
+        # Experiences may still be loading once the API is up
+        while len(response.json()) < catalog_size:
+            await asyncio.sleep(0.01)
+            response = await client.get("/experiences")
+        catalog_s = time.perf_counter() - startup_start
+        experience_ids = list(response.json().keys())
+        benchmark = SwitchingBenchmark(client, experience_ids)
+
+        results = {
+            "startup_to_first_experiences_s": startup_s,
+            "startup_to_full_catalog_s": catalog_s,
+            "experiences": len(experience_ids),
+            "latency": await benchmark.latency(args.latency_samples),
+            "sustained": await benchmark.sustained(args.duration, args.timer_tick),
+            "soak": await benchmark.soak(args.soak_switches),
+            "wm_messages": wm.messages,
+            "docker_containers_left": len(docker.containers),
+        }
+
+    await placard.close()
+    await capture.close()
+    wm.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--web", type=int, default=20, help="web experiences")
+    parser.add_argument("--docker", type=int, default=20, help="Docker experiences")
+    parser.add_argument("--capture", type=int, default=2, help="capture experiences")
+    parser.add_argument(
+        "--load-time",
+        action="store_true",
+        help="give experiences a load_time so the loader is shown on every switch",
+    )
+    parser.add_argument("--latency-samples", type=int, default=200)
+    parser.add_argument(
+        "--duration", type=float, default=60, help="sustained load duration (s)"
+    )
+    parser.add_argument(
+        "--timer-tick",
+        type=float,
+        default=0,
+        help="delay between timer-driven switches (s)",
+    )
+    parser.add_argument("--soak-switches", type=int, default=2000)
+    parser.add_argument(
+        "--docker-create-latency",
+        type=float,
+        default=0.05,
+        help="simulated container create time (s)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write JSON results here")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix="footron-bench-") as data_dir:
+        data_path = Path(data_dir)
+        _configure_environment(data_path, _free_port())
+        write_fake_shells(data_path / "bin")
+        write_catalog(
+            data_path / "experiences",
+            args.web,
+            args.docker,
+            args.capture,
+            args.load_time,
+        )
+
+        results = {
+            "benchmark": "switching",
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "parameters": {
+                key: str(value) if isinstance(value, Path) else value
+                for key, value in vars(args).items()
+            },
+            "results": asyncio.get_event_loop().run_until_complete(_run(args)),
+        }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(output)
+    else:
+        print(output)
+    # The controller leaves background loops and child processes running, so we
+    # clean up after it instead of waiting for a clean interpreter shutdown
+    _kill_children()
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
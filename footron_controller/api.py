@@ -2,27 +2,42 @@ import asyncio
 import atexit
 import dataclasses
 import logging
-from typing import Optional
+from typing import List, Optional
 
 import footron_protocol as protocol
 import rollbar
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from rollbar.contrib.fastapi import add_to as rollbar_add_to
 
-from .constants import LOG_IGNORE_PATTERNS, ROLLBAR_TOKEN
+from .catalog import Catalog
+from .constants import (
+    FROZEN_DISPLAY_CHECK,
+    LOG_IGNORE_PATTERNS,
+    ROLLBAR_TOKEN,
+    SCREENSHOT_STREAM_DEFAULT_WIDTH,
+    SCREENSHOT_STREAM_MAX_FPS,
+)
 from .controller import Controller
-from .data.groupings import Collection, Folder, Tag
+from .data.container_pool import ContainerPool, get_container_pool
+from .data.images import get_image_manager
 from .data.placard import PlacardExperienceData, PlacardUrlData
-from .data.screenshot import SCREENSHOT_MIME_TYPES
-from .experiences import BaseExperience, VideoExperience
-from .util import (
-    create_image_bytes_generator,
-    datetime_to_timestamp,
-    timestamp_to_datetime,
+from .data.screenshot import (
+    SCREENSHOT_MIME_TYPES,
+    SCREENSHOT_TARGETS,
+    ScreenshotQueueFull,
+    ScreenshotTargetMissing,
+    ScreenshotUnavailable,
+    ScreenshotViewer,
 )
+from .experiences import BaseExperience
+from .metrics import registry as metrics_registry
+from .metrics import throttle_rejections
+from .payloads import SerializedPayload, etag_matches, preferred_encoding
+from .transitions import Transition
+from .util import datetime_to_timestamp, timestamp_to_datetime
 
 fastapi_app = FastAPI()
 
@@ -57,121 +72,190 @@ class UpdateCurrentExperienceBody(BaseModel):
     lock: Optional[protocol.Lock]
 
 
-# TODO: Find a cleaner way to do this
-def experience_response(experience: BaseExperience):
-    data = {
-        "type": experience.type.value,
-        "id": experience.id,
-        "title": experience.title,
-        "artist": experience.artist,
-        "description": experience.description,
-        "lifetime": experience.lifetime,
-        "last_update": datetime_to_timestamp(_controller.last_update),
-        "unlisted": experience.unlisted,
-        "queueable": experience.queueable,
-        "folders": _controller.experience_folders_map[experience.id],
-        "tags": _controller.experience_tag_map[experience.id],
+def experience_response(experience: BaseExperience, catalog: Catalog):
+    return {
+        **catalog.experience_payload(experience),
+        # Learned from recent starts where possible, see LoadTimeManager. These change
+        # with every start, so they're left out of the catalog's payloads and only
+        # served for single experiences.
+        "load_time": _controller.load_times.load_time(
+            experience.id, experience.load_time
+        ),
+        "learned_load_time": _controller.load_times.estimate(experience.id),
+        "load_time_samples": _controller.load_times.samples(experience.id),
     }
 
-    colors = _controller.colors.get(experience.id)
-    if colors:
-        data["colors"] = colors.dict()
-
-    if experience.id in _controller.experience_collection_map.keys():
-        data["collection"] = _controller.experience_collection_map[experience.id]
-
-    if isinstance(experience, VideoExperience):
-        data["scrubbing"] = experience.scrubbing
 
+def transition_response(transition: Transition):
+    data = {
+        "id": transition.id,
+        "experience": transition.experience_id,
+        "status": transition.status.value,
+        "created_at": datetime_to_timestamp(transition.created_at),
+    }
+    if transition.finished_at is not None:
+        data["finished_at"] = datetime_to_timestamp(transition.finished_at)
     return data
 
 
-def collection_response(collection: Collection):
-    return collection.dict()
-
+# Route for reloading data
+@fastapi_app.get("/reload")
+async def api_reload():
+    await _controller.load_from_fs()
+    return {"status": "ok"}
 
-def folder_response(folder: Folder):
-    return folder.dict()
 
+def catalog_response(request: Request, payload: SerializedPayload) -> Response:
+    encoding = preferred_encoding(request.headers.get("accept-encoding"))
+    etag = payload.etag(encoding)
+    headers = {
+        "ETag": etag,
+        # Clients can keep a copy, but have to check with us before using it
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
 
-def tag_response(tag: Tag):
-    return tag.dict()
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(
+        payload.body(encoding), media_type="application/json", headers=headers
+    )
 
 
-# Route for reloading data
-@fastapi_app.get("/reload")
-def api_reload():
-    _controller.load_from_fs()
-    return {"status": "ok"}
+# Catalog endpoints grab the current catalog once and only read from it, see Catalog
 
 
 @fastapi_app.get("/info/queueable")
 def info_queueable_experiences():
-    return {
-        id for id, experience in _controller.experiences.items() if experience.queueable
-    }
+    return _controller.catalog.queueable_ids
+
+
+def _split_query_list(value: Optional[str]) -> Optional[List[str]]:
+    if value is None:
+        return None
+    return [item for item in (item.strip() for item in value.split(",")) if item]
+
+
+def _project(data: dict, fields: Optional[List[str]]) -> dict:
+    if fields is None:
+        return data
+    return {field: data[field] for field in fields if field in data}
 
 
 @fastapi_app.get("/experiences")
-def experiences():
+def experiences(
+    request: Request,
+    tag: Optional[str] = None,
+    folder: Optional[str] = None,
+    collection: Optional[str] = None,
+    type: Optional[str] = None,
+    queueable: Optional[bool] = None,
+    unlisted: Optional[bool] = None,
+    ids: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """
+    All experiences by default. Filters narrow the results down to experiences
+    matching all of them, `ids` and `fields` are comma-separated lists of experience
+    IDs to look up and payload fields to include.
+    """
+    catalog = _controller.catalog
+    id_list = _split_query_list(ids)
+    field_list = _split_query_list(fields)
+    filters = dict(
+        ids=id_list,
+        tag=tag,
+        folder=folder,
+        collection=collection,
+        type=type,
+        queueable=queueable,
+        unlisted=unlisted,
+    )
+    if all(value is None for value in filters.values()) and field_list is None:
+        return catalog_response(request, catalog.serialized_payloads["experiences"])
+
+    data = {}
+    for id in catalog.query(**filters):
+        data[id] = _project(catalog.experience_payloads[id], field_list)
+    # Query results aren't worth keeping around, but they still change exactly when
+    # the full list does, so they can share its ETag version (ETags are per URL)
+    return catalog_response(request, SerializedPayload(data, catalog.payload_version))
+
+
+@fastapi_app.get("/search")
+def search(
+    q: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    unlisted: bool = False,
+    fields: str = "id,title,artist,description",
+):
+    """
+    Experiences matching `q`, best matches first. Results only include `fields` of
+    each experience (comma-separated) to keep responses small, and leave out
+    unlisted experiences unless `unlisted` is set.
+    """
+    catalog = _controller.catalog
+    matches = catalog.search_index.search(q)
+    if not unlisted:
+        matches = [match for match in matches if match[0] not in catalog.unlisted_ids]
+    field_list = _split_query_list(fields)
     return {
-        id: experience_response(experience)
-        for id, experience in _controller.experiences.items()
+        "total": len(matches),
+        "offset": offset,
+        "limit": limit,
+        "results": [
+            {
+                **_project(catalog.experience_payloads[id], field_list),
+                "score": round(score, 3),
+            }
+            for id, score in matches[offset : offset + limit]
+        ],
     }
 
 
 @fastapi_app.get("/experiences/{id}")
 def experience(id):
-    if id not in _controller.experiences:
+    catalog = _controller.catalog
+    if id not in catalog.experiences:
         return {}
 
-    return experience_response(_controller.experiences[id])
+    return experience_response(catalog.experiences[id], catalog)
 
 
 @fastapi_app.get("/collections")
-def collections():
-    return {
-        id: collection_response(collection)
-        for id, collection in _controller.collections.items()
-    }
+def collections(request: Request):
+    catalog = _controller.catalog
+    return catalog_response(request, catalog.serialized_payloads["collections"])
 
 
 @fastapi_app.get("/collections/{id}")
 def collection(id):
-    if id not in _controller.collections:
-        return {}
-
-    return collection_response(_controller.collections[id])
+    return _controller.catalog.collection_payloads.get(id, {})
 
 
 @fastapi_app.get("/folders")
-def folders():
-    return {
-        id: folder_response(folder)
-        for id, folder in _controller.folders.items()
-        if folder.visible
-    }
+def folders(request: Request):
+    catalog = _controller.catalog
+    return catalog_response(request, catalog.serialized_payloads["folders"])
 
 
 @fastapi_app.get("/folders/{id}")
 def folder(id):
-    if id not in _controller.folders:
-        return {}
-
-    return folder_response(_controller.folders[id])
+    return _controller.catalog.folder_payloads.get(id, {})
 
 
 @fastapi_app.get("/tags")
-def tags():
-    return {id: tag_response(tag) for id, tag in _controller.tags.items()}
+def tags(request: Request):
+    catalog = _controller.catalog
+    return catalog_response(request, catalog.serialized_payloads["tags"])
 
 
 @fastapi_app.get("/tags/{id}")
 def tag(id):
-    if id not in _controller.tags:
-        return {}
-
-    return tag_response(_controller.tags[id])
+    return _controller.catalog.tag_payloads.get(id, {})
 
 
 @fastapi_app.get("/current")
@@ -180,7 +264,7 @@ async def current_experience():
         return {}
     current = _controller.current
 
-    response_data = experience_response(current.experience)
+    response_data = experience_response(current.experience, _controller.catalog)
     if current.end_time is not None:
         response_data["end_time"] = datetime_to_timestamp(current.end_time)
     if current.start_time is not None:
@@ -200,25 +284,53 @@ async def current_experience():
 
 @fastapi_app.put("/current")
 async def set_current_experience(
-    body: SetCurrentExperienceBody, throttle: Optional[int] = None
+    body: SetCurrentExperienceBody, throttle: Optional[int] = None, wait: bool = False
 ):
     if body.id is not None and body.id not in _controller.experiences:
         raise HTTPException(
             status_code=400, detail=f"Experience with id '{body.id}' not registered"
         )
 
-    if not await _controller.set_experience(body.id, throttle=throttle):
-        throttle_scenario = "while it was changing"
-        if throttle:
-            throttle_scenario = (
-                "either {throttle_scenario} or before timeout "
-                "specified in 'throttle' parameter"
-            )
+    transition = await _controller.set_experience(body.id, throttle=throttle)
+    if not transition:
+        throttle_rejections.inc(reason="throttle")
         raise HTTPException(
             status_code=429,
-            detail=f"Tried to change current experience {throttle_scenario}",
+            detail="Tried to change current experience before timeout specified in "
+            "'throttle' parameter",
+        )
+
+    if wait:
+        await transition.wait()
+
+    return {"status": "ok", "transition": transition_response(transition)}
+
+
+@fastapi_app.get("/transitions/{id}")
+async def transition(id: str, wait: bool = False):
+    if not (transition := _controller.transition(id)):
+        raise HTTPException(status_code=404, detail=f"Unknown transition '{id}'")
+
+    if wait:
+        await transition.wait()
+
+    return transition_response(transition)
+
+
+@fastapi_app.put("/next")
+async def set_next_experience(body: SetCurrentExperienceBody):
+    # Experiences still waiting on their image can't be shown yet, but they can be
+    # next, which gets their image pulled sooner
+    if (
+        body.id is not None
+        and body.id not in _controller.experiences
+        and body.id not in _controller.pending_experiences
+    ):
+        raise HTTPException(
+            status_code=400, detail=f"Experience with id '{body.id}' not registered"
         )
 
+    _controller.prepare_experience(body.id)
     return {"status": "ok"}
 
 
@@ -248,6 +360,29 @@ async def update_current_experience(body: UpdateCurrentExperienceBody):
     return {"status": "ok"}
 
 
+@fastapi_app.get("/pool")
+def container_pool():
+    if not (pool := get_container_pool()):
+        return ContainerPool.empty_stats()
+    return pool.stats()
+
+
+@fastapi_app.get("/images")
+def images():
+    if not (image_manager := get_image_manager()):
+        return {}
+    return image_manager.statuses()
+
+
+# Async so that rendering runs on the event loop, which is where every metric is
+# recorded, rather than on a threadpool thread racing with new label sets
+@fastapi_app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(
+        metrics_registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 @fastapi_app.get("/placard/experience")
 async def placard_experience():
     return await _controller.placard.experience()
@@ -279,7 +414,12 @@ async def screenshot(
     format: str = "jpeg",
     q: int = 95,
     target: str = "display",
+    region: Optional[str] = None,
 ):
+    """
+    `region` crops the screenshot to "x,y,width,height" (in pixels, relative to the
+    target) before it's scaled.
+    """
     format = format.lower()
     target = target.lower()
     if format not in SCREENSHOT_MIME_TYPES:
@@ -288,22 +428,83 @@ async def screenshot(
             detail=f"'format' parameter has invalid value '{format}'",
         )
 
-    screenshot_capture = _controller.screenshot_capture
-    if target == "display":
-        image = screenshot_capture.capture_root()
-    elif target == "viewport":
-        image = screenshot_capture.capture_viewport()
-    else:
+    if target not in SCREENSHOT_TARGETS:
         raise HTTPException(
             status_code=400,
             detail=f"'target' parameter has invalid value '{target}'",
         )
 
+    crop = None
+    if region is not None:
+        try:
+            crop = tuple(int(value) for value in region.split(","))
+        except ValueError:
+            crop = None
+        if crop is None or len(crop) != 4 or crop[2] <= 0 or crop[3] <= 0:
+            raise HTTPException(
+                status_code=400,
+                detail=f"'region' parameter has invalid value '{region}'",
+            )
+
+    try:
+        image_bytes = await _controller.screenshots.screenshot(
+            target, region=crop, width=w, height=h, quality=q, format=format
+        )
+    except ScreenshotTargetMissing as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ScreenshotQueueFull:
+        raise HTTPException(status_code=503, detail="Too many screenshots queued")
+    except ScreenshotUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Screenshot timed out")
+
+    return Response(image_bytes, media_type=SCREENSHOT_MIME_TYPES[format])
+
+
+_STREAM_BOUNDARY = "frame"
+
+
+async def _multipart_frames(viewer: ScreenshotViewer):
+    async for frame in viewer.frames():
+        yield (
+            f"--{_STREAM_BOUNDARY}\r\n"
+            "Content-Type: image/jpeg\r\n"
+            f"Content-Length: {len(frame)}\r\n\r\n"
+        ).encode() + frame + b"\r\n"
+
+
+@fastapi_app.get("/screenshot/stream")
+async def screenshot_stream(
+    fps: float = Query(2, gt=0, le=SCREENSHOT_STREAM_MAX_FPS),
+    w: Optional[int] = SCREENSHOT_STREAM_DEFAULT_WIDTH,
+    h: Optional[int] = None,
+    q: int = 80,
+    target: str = "display",
+):
+    """
+    A live MJPEG stream of the display (or viewport), which only sends frames when
+    something changed.
+    """
+    target = target.lower()
+    if target not in SCREENSHOT_TARGETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"'target' parameter has invalid value '{target}'",
+        )
+
+    try:
+        viewer = _controller.screenshots.watch(
+            target, fps, width=w, height=h, quality=q
+        )
+    except ScreenshotQueueFull:
+        raise HTTPException(status_code=503, detail="Too many screenshot streams")
+
     return StreamingResponse(
-        create_image_bytes_generator(
-            image, width=w, height=h, quality=q, format=format
-        ),
-        media_type=SCREENSHOT_MIME_TYPES[format],
+        _multipart_frames(viewer),
+        media_type=f"multipart/x-mixed-replace; boundary={_STREAM_BOUNDARY}",
+        # Frames are live, so nothing along the way should hold onto them
+        headers={"Cache-Control": "no-store"},
     )
 
 
@@ -314,6 +515,11 @@ def on_startup():
     asyncio.get_event_loop().create_task(_controller.stability_loop())
     asyncio.get_event_loop().create_task(_controller.handle_experience_exit_loop())
     asyncio.get_event_loop().create_task(_controller.colors_handling_loop())
+    asyncio.get_event_loop().create_task(_controller.event_loop_lag_loop())
+    asyncio.get_event_loop().create_task(_controller.image_refresh_loop())
+    asyncio.get_event_loop().create_task(_controller.catalog_watch_loop())
+    if FROZEN_DISPLAY_CHECK:
+        asyncio.get_event_loop().create_task(_controller.frozen_display_loop())
 
 
 @atexit.register
@@ -1,18 +1,22 @@
+import asyncio
 import logging
 import subprocess
 import urllib.parse
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Callable, Dict, Optional
 
 from aiohttp import web
 from aiohttp.web_log import AccessLogger
 from aiohttp.web_runner import AppRunner, TCPSite
 
 from .constants import BASE_BIN_PATH, BASE_MESSAGING_URL
-from .util import find_free_port, mercilessly_kill_process
+from .util import find_free_port, mercilessly_kill_process, watch_process_exit
 
 WEB_SHELL_PATH = BASE_BIN_PATH / "footron-web-shell"
 
+# The web shell requests this from our static server once the page has loaded
+READY_PATH = "/__footron/ready"
+
 
 class BrowserRunner:
     _id: str
@@ -22,8 +26,10 @@ class BrowserRunner:
     _routes: Dict[str, str]
     _profile_path: Path
     _browser_process: Optional[subprocess.Popen]
-    _runner = Optional[AppRunner]
-    _site = Optional[TCPSite]
+    _runner: Optional[AppRunner]
+    _site: Optional[TCPSite]
+    # Created on start, since runners can be created off the event loop
+    _ready: Optional[asyncio.Event]
 
     def __init__(self, id: str, routes: Dict[str, str], url: str = "/"):
         self._id = id
@@ -31,6 +37,9 @@ class BrowserRunner:
         self._routes = {route.rstrip("/"): path for route, path in routes.items()}
         self._url = url
         self._browser_process = None
+        self._runner = None
+        self._site = None
+        self._ready = None
 
     def _create_url(self):
         base_url = urllib.parse.urljoin(f"http://localhost:{self._port}", self._url)
@@ -66,9 +75,20 @@ class BrowserRunner:
         #  maybe we just handle exceptions?
         return True
 
+    def watch_browser_exit(
+        self, callback: Callable[[], None]
+    ) -> Optional[Callable[[], None]]:
+        if not self._browser_process:
+            return None
+        return watch_process_exit(self._browser_process, callback)
+
     # Based on https://github.com/aio-libs/aiohttp/issues/1220#issuecomment-546572413
     @web.middleware
     async def static_serve(self, request, **kwargs):
+        if request.path == READY_PATH:
+            if self._ready:
+                self._ready.set()
+            return web.Response(status=204)
         matching_route, root_path = next(
             (route, Path(path))
             for route, path in self._routes.items()
@@ -115,11 +135,21 @@ class BrowserRunner:
         except RuntimeError as e:
             logging.error("Error while stopping static server:")
             logging.exception(e)
+        self._runner = None
+        self._site = None
+
+    async def prepare(self):
+        if not self._site:
+            await self._start_static_server()
 
     async def start(self):
-        await self._start_static_server()
+        await self.prepare()
+        self._ready = asyncio.Event()
         self._start_browser()
 
+    async def wait_ready(self):
+        await self._ready.wait()
+
     async def stop(self):
         await self._stop_browser()
         await self._stop_static_server()
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+)
+
+from .data.colors import CachedColorPalettes
+from .data.groupings import Collection, Folder, Tag
+from .experiences import BaseExperience, VideoExperience
+from .payloads import SerializedPayload
+from .search import SearchIndex
+from .util import datetime_to_timestamp
+
+JsonDict = Dict[str, Any]
+
+
+class Catalog:
+    """
+    A consistent view of the experience catalog: the experiences, their groupings,
+    everything derived from them, and the API payloads for all of it.
+
+    Catalogs are never modified once built. The controller builds a new one whenever
+    anything changes and swaps it in with a single assignment, so readers (on any
+    thread) just grab the current catalog once and see a consistent state without
+    locking. Payload dicts are shared between requests and must be copied before
+    they're modified.
+
+    The list endpoints' payloads are serialized and compressed while the catalog is
+    built, which happens off the event loop, so serving them only copies bytes.
+    """
+
+    experiences: Mapping[str, BaseExperience]
+    collections: Mapping[str, Collection]
+    tags: Mapping[str, Tag]
+    folders: Mapping[str, Folder]
+    experience_collection_map: Mapping[str, str]
+    experience_tag_map: Mapping[str, List[str]]
+    experience_folders_map: Mapping[str, List[str]]
+    colors: Mapping[str, CachedColorPalettes]
+    last_update: datetime
+    experience_payloads: Mapping[str, JsonDict]
+    collection_payloads: Mapping[str, JsonDict]
+    tag_payloads: Mapping[str, JsonDict]
+    folder_payloads: Mapping[str, JsonDict]
+    # Changes whenever the catalog does, for ETags
+    payload_version: str
+    # Full lists of experiences, collections, folders and tags, by name
+    serialized_payloads: Mapping[str, SerializedPayload]
+    # Inverted indexes for filtering experiences, all only contain IDs of experiences
+    # in this catalog
+    tag_index: Mapping[str, FrozenSet[str]]
+    folder_index: Mapping[str, FrozenSet[str]]
+    collection_index: Mapping[str, FrozenSet[str]]
+    type_index: Mapping[str, FrozenSet[str]]
+    queueable_ids: FrozenSet[str]
+    unlisted_ids: FrozenSet[str]
+    search_index: SearchIndex
+    _positions: Dict[str, int]
+
+    def __init__(
+        self,
+        experiences: Mapping[str, BaseExperience],
+        collections: Mapping[str, Collection],
+        tags: Mapping[str, Tag],
+        folders: Mapping[str, Folder],
+        colors: Mapping[str, CachedColorPalettes],
+        last_update: datetime,
+    ):
+        self.experiences = experiences
+        self.collections = collections
+        self.tags = tags
+        self.folders = folders
+        self.colors = colors
+        self.last_update = last_update
+
+        self.experience_collection_map = {}
+        for collection in collections.values():
+            for experience_id in collection.experiences:
+                self.experience_collection_map[experience_id] = collection.id
+
+        self._positions = {id: position for position, id in enumerate(experiences)}
+        self.tag_index = {
+            tag.id: frozenset(id for id in tag.experiences if id in experiences)
+            for tag in tags.values()
+        }
+        self.collection_index = {
+            collection.id: frozenset(
+                id for id in collection.experiences if id in experiences
+            )
+            for collection in collections.values()
+        }
+        # Folders are made up of tags, so we can get them straight from the tag index
+        self.folder_index = {
+            folder.id: frozenset().union(
+                *(self.tag_index.get(tag_id, ()) for tag_id in folder.tags)
+            )
+            for folder in folders.values()
+        }
+        type_index: Dict[str, Set[str]] = {}
+        for id, experience in experiences.items():
+            type_index.setdefault(experience.type.value, set()).add(id)
+        self.type_index = {
+            type: frozenset(type_ids) for type, type_ids in type_index.items()
+        }
+        self.queueable_ids = frozenset(
+            id for id, experience in experiences.items() if experience.queueable
+        )
+        self.unlisted_ids = frozenset(
+            id for id, experience in experiences.items() if experience.unlisted
+        )
+
+        self.experience_tag_map = self._invert(self.tag_index)
+        self.experience_folders_map = self._invert(self.folder_index)
+        self.search_index = SearchIndex(experiences)
+
+        self.experience_payloads = {
+            id: self._experience_payload(experience)
+            for id, experience in experiences.items()
+        }
+        self.collection_payloads = {
+            id: collection.dict() for id, collection in collections.items()
+        }
+        self.tag_payloads = {id: tag.dict() for id, tag in tags.items()}
+        self.folder_payloads = {id: folder.dict() for id, folder in folders.items()}
+        self.payload_version = str(datetime_to_timestamp(last_update))
+        self.serialized_payloads = {
+            name: SerializedPayload(data, self.payload_version, precompress=True)
+            for name, data in [
+                ("experiences", self.experience_payloads),
+                ("collections", self.collection_payloads),
+                ("folders", self.visible_folder_payloads()),
+                ("tags", self.tag_payloads),
+            ]
+        }
+
+    @classmethod
+    def empty(cls) -> Catalog:
+        return cls({}, {}, {}, {}, {}, datetime.now())
+
+    def _invert(self, index: Mapping[str, FrozenSet[str]]) -> Dict[str, List[str]]:
+        inverted = {id: [] for id in self.experiences}
+        for key, ids in index.items():
+            for id in ids:
+                inverted[id].append(key)
+        return inverted
+
+    def query(
+        self,
+        ids: Optional[Iterable[str]] = None,
+        tag: Optional[str] = None,
+        folder: Optional[str] = None,
+        collection: Optional[str] = None,
+        type: Optional[str] = None,
+        queueable: Optional[bool] = None,
+        unlisted: Optional[bool] = None,
+    ) -> List[str]:
+        """
+        IDs of the experiences matching every filter that's given, in catalog order.
+        """
+        matches: Optional[FrozenSet[str]] = None
+        for index, key in [
+            (self.tag_index, tag),
+            (self.folder_index, folder),
+            (self.collection_index, collection),
+            (self.type_index, type),
+        ]:
+            if key is None:
+                continue
+            key_ids = index.get(key, frozenset())
+            matches = key_ids if matches is None else matches & key_ids
+
+        if ids is not None:
+            ids = frozenset(id for id in ids if id in self.experiences)
+            matches = ids if matches is None else matches & ids
+        if matches is None:
+            matches = frozenset(self.experiences)
+
+        for flagged, value in [
+            (self.queueable_ids, queueable),
+            (self.unlisted_ids, unlisted),
+        ]:
+            if value is True:
+                matches = matches & flagged
+            elif value is False:
+                matches = matches - flagged
+
+        return sorted(matches, key=self._positions.__getitem__)
+
+    def _experience_payload(self, experience: BaseExperience) -> JsonDict:
+        data = {
+            "type": experience.type.value,
+            "id": experience.id,
+            "title": experience.title,
+            "artist": experience.artist,
+            "description": experience.description,
+            "lifetime": experience.lifetime,
+            "last_update": datetime_to_timestamp(self.last_update),
+            "unlisted": experience.unlisted,
+            "queueable": experience.queueable,
+            "folders": self.experience_folders_map.get(experience.id, []),
+            "tags": self.experience_tag_map.get(experience.id, []),
+        }
+
+        colors = self.colors.get(experience.id)
+        if colors:
+            data["colors"] = colors.dict()
+
+        if experience.id in self.experience_collection_map:
+            data["collection"] = self.experience_collection_map[experience.id]
+
+        if isinstance(experience, VideoExperience):
+            data["scrubbing"] = experience.scrubbing
+
+        return data
+
+    def experience_payload(self, experience: BaseExperience) -> JsonDict:
+        """
+        The payload for an experience, which doesn't have to be in this catalog
+        (e.g. the current experience after it's been removed).
+        """
+        if self.experiences.get(experience.id) is experience:
+            return self.experience_payloads[experience.id]
+        return self._experience_payload(experience)
+
+    def visible_folder_payloads(self) -> Dict[str, JsonDict]:
+        return {
+            id: payload
+            for id, payload in self.folder_payloads.items()
+            if self.folders[id].visible
+        }
@@ -42,6 +42,12 @@ STABILITY_CHECK = (
     else False
 )
 
+# Stability probes each have their own sampling interval, this is just how often we
+# check whether any of them are due
+STABILITY_CHECK_INTERVAL_S = 5
+
+ROGUE_CONTAINER_CLEANUP_INTERVAL_S = 15
+
 CAPTURE_SHELL_PATH = BASE_BIN_PATH / "footron-capture-shell"
 
 CAPTURE_FAILED_TIMEOUT_S = 10
@@ -54,6 +60,117 @@ CAPTURE_API_URL = (
     else "http://localhost:8090/"
 )
 
+# How often the current environment is polled for failures when it can't notify us
+FAILURE_POLL_INTERVAL_S = 1
+
+# Environments that push failure notifications are still polled this often in case a
+# notification gets lost (e.g. a Docker events stream reconnect)
+FAILURE_FALLBACK_POLL_INTERVAL_S = 15
+
+# Blocking Docker SDK calls are run on a dedicated thread pool of this size
+DOCKER_EXECUTOR_WORKERS = 4
+
+DOCKER_REQUEST_TIMEOUT_S = 10
+
+# Creating a container can take a while on a busy daemon
+DOCKER_CREATE_TIMEOUT_S = 30
+
+# Labels we put on the containers we launch so that we can find them again
+CONTAINER_LABEL_EXPERIENCE = "org.footron.experience"
+CONTAINER_LABEL_CONTROLLER = "org.footron.controller"
+CONTAINER_LABEL_GENERATION = "org.footron.generation"
+
+# Number of stopped Docker experiences to keep paused for a fast restart, 0 disables
+# the pool
+CONTAINER_POOL_SIZE = (
+    int(os.environ["FT_CONTAINER_POOL_SIZE"])
+    if "FT_CONTAINER_POOL_SIZE" in os.environ
+    else 0
+)
+
+CONTAINER_POOL_MEMORY_BUDGET_MB = (
+    int(os.environ["FT_CONTAINER_POOL_MEMORY_MB"])
+    if "FT_CONTAINER_POOL_MEMORY_MB" in os.environ
+    else 8192
+)
+
+CONTAINER_POOL_GPU_MEMORY_BUDGET_MB = (
+    int(os.environ["FT_CONTAINER_POOL_GPU_MEMORY_MB"])
+    if "FT_CONTAINER_POOL_GPU_MEMORY_MB" in os.environ
+    else 4096
+)
+
+# Docker images are pulled in the background, this many at a time
+IMAGE_PULL_CONCURRENCY = (
+    int(os.environ["FT_IMAGE_PULL_CONCURRENCY"])
+    if "FT_IMAGE_PULL_CONCURRENCY" in os.environ
+    else 2
+)
+
+# How often we check the registry for newer versions of the images we have
+IMAGE_REFRESH_INTERVAL_S = 6 * 60 * 60
+
+# Pulls of images we don't have are retried after this long, doubling with every
+# failure up to the maximum
+IMAGE_PULL_RETRY_INTERVAL_S = 60
+IMAGE_PULL_RETRY_MAX_INTERVAL_S = 60 * 60
+
+# Unused images are removed before a pull would leave less than this much free space
+# for Docker, 0 disables the check
+IMAGE_MIN_FREE_DISK_GB = (
+    float(os.environ["FT_IMAGE_MIN_FREE_DISK_GB"])
+    if "FT_IMAGE_MIN_FREE_DISK_GB" in os.environ
+    else 10
+)
+
+FROZEN_DISPLAY_CHECK = (
+    bool(int(os.environ["FT_CHECK_FROZEN_DISPLAY"]))
+    if "FT_CHECK_FROZEN_DISPLAY" in os.environ
+    else True
+)
+
+# How long an experience's viewport can look the same, with nobody interacting, before
+# we decide it's frozen. Experiences can set their own with `frozen_timeout`, and 0
+# turns the check off: videos have still scenes and get paused, and capture sources
+# can legitimately show a still picture for a long time.
+FROZEN_DISPLAY_TIMEOUTS_S: Dict[str, int] = {
+    "docker": 120,
+    "web": 120,
+    "video": 0,
+    "capture": 0,
+}
+
+# How often the viewport is sampled while it looks the same. While it keeps changing,
+# sampling backs off to a fraction of the timeout.
+FROZEN_DISPLAY_SAMPLE_INTERVALS_S: Dict[str, float] = {
+    "docker": 5,
+    "web": 10,
+    "video": 15,
+    "capture": 15,
+}
+
+# Frames are compared by the average brightness of square tiles this many pixels wide,
+# so small changes are diluted by the area of their tile: with 8px tiles and a
+# tolerance of 2, a change has to add up to more than 128 (out of 255) summed over the
+# pixels it covers, e.g. one pixel changing by half or a 2x2 sprite by an eighth.
+FROZEN_DISPLAY_TILE_SIZE = 8
+
+# Largest change in any tile's average (out of 255) that still counts as the same
+# frame, which absorbs compression noise
+FROZEN_DISPLAY_TOLERANCE = 2
+
+# Upper bound on waiting for the loader window to show up before starting an
+# experience behind it
+LOADER_SHOW_TIMEOUT_S = 1
+
+# Experiences we've learned are ready sooner than this aren't worth covering with the
+# loader
+LOADER_MIN_LOAD_TIME_S = 1
+
+# How long we keep watching a started experience for its first frame, to learn how long
+# it takes to load
+READINESS_WATCH_TIMEOUT_S = 120
+
 DISABLE_WM = (
     bool(int(os.environ["FT_DISABLE_WM"])) if "FT_DISABLE_WM" in os.environ else False
 )
@@ -66,10 +183,29 @@ DISABLE_PLACARD = (
 
 EXPERIENCES_PATH = Path(BASE_DATA_PATH, "experiences")
 
+# Experience configs are read and validated on a thread pool of this size
+CATALOG_LOAD_WORKERS = 8
+
+# Checking whether an experience is available can mean asking the Docker daemon about
+# its image, so these get a pool of their own
+CATALOG_AVAILABILITY_WORKERS = 8
+
+# Changes to the catalog on disk are batched until they've settled for this long, so
+# that a deploy copying many files triggers one reload
+CATALOG_WATCH_DEBOUNCE_MS = 1000
+
+CATALOG_WATCH_RETRY_INTERVAL_S = 30
+
 EXPERIENCE_DATA_PATH = Path(BASE_DATA_PATH, "experience-data")
 
 EXPERIENCE_COLORS_PATH = Path(BASE_DATA_PATH, "colors.json")
 
+# Recent time-to-ready samples, one file per experience
+EXPERIENCE_LOAD_TIMES_PATH = Path(EXPERIENCE_DATA_PATH, ".load-times")
+
+# Parsed catalog from the last load, so that restarts only reparse what changed
+CATALOG_SNAPSHOT_PATH = Path(EXPERIENCE_DATA_PATH, ".catalog-snapshot")
+
 EMPTY_EXPERIENCE_DATA = PlacardExperienceData(
     title="Footron",
     artist="Vin Howe, Chris Luangrath, Matt Powley",
@@ -81,13 +217,43 @@ INITIAL_EMPTY_EXPERIENCE_DELAY_S = 2
 
 VIEWPORT_WINDOW_NAME = "FOOTRON_EXPERIENCE_VIEWPORT"
 
+# Screenshots are captured one at a time on a worker thread. Past this many different
+# screenshots waiting their turn, new requests are turned away.
+SCREENSHOT_MAX_PENDING = 4
+
+SCREENSHOT_TIMEOUT_S = 10
+
+# Identical screenshot requests this close together share one capture
+SCREENSHOT_COALESCE_WINDOW_S = 0.5
+
+# Streams of the same target share one capture loop, but each distinct combination of
+# stream settings is scaled and encoded separately
+SCREENSHOT_MAX_STREAMS = 4
+
+SCREENSHOT_STREAM_MAX_FPS = 10
+
+# Streams of the whole wall at full resolution would be far too much for remote
+# monitoring, so frames are scaled down to this width unless asked otherwise
+SCREENSHOT_STREAM_DEFAULT_WIDTH = 1280
+
+# Capture through X shared memory (MIT-SHM) when the X server supports it
+SCREENSHOT_USE_SHM = (
+    bool(int(os.environ["FT_SCREENSHOT_SHM"]))
+    if "FT_SCREENSHOT_SHM" in os.environ
+    else True
+)
+
 VIDEO_ACTION_HINTS = ["control video playback"]
 
 # noinspection PyTypeChecker
 LOG_IGNORE_PATTERNS: List[Pattern] = list(
     map(
         re.compile,
-        [r"(GET|PATCH) /current.*200", r"(GET|PATCH) /placard/url.*200"],
+        [
+            r"(GET|PATCH) /current.*200",
+            r"(GET|PATCH) /placard/url.*200",
+            r"GET /metrics.*200",
+        ],
     )
 )
 
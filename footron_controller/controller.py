@@ -1,121 +1,350 @@
 import asyncio
+import functools
 import logging
 import os
+from collections import deque
 from datetime import datetime
-from typing import Dict, List, Optional
+from pathlib import Path
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
 
 import aiohttp.client_exceptions
 import rollbar
+import watchfiles
 
+from .catalog import Catalog
 from .constants import (
     BASE_BIN_PATH,
+    BASE_DATA_PATH,
+    CATALOG_WATCH_DEBOUNCE_MS,
+    CATALOG_WATCH_RETRY_INTERVAL_S,
     DISABLE_PLACARD,
     DISABLE_WM,
     EMPTY_EXPERIENCE_DATA,
     EXPERIENCE_DATA_PATH,
     EXPERIENCES_PATH,
+    FAILURE_POLL_INTERVAL_S,
+    FROZEN_DISPLAY_SAMPLE_INTERVALS_S,
+    FROZEN_DISPLAY_TILE_SIZE,
+    IMAGE_REFRESH_INTERVAL_S,
     INITIAL_EMPTY_EXPERIENCE_DELAY_S,
+    LOADER_MIN_LOAD_TIME_S,
+    LOADER_SHOW_TIMEOUT_S,
+    READINESS_WATCH_TIMEOUT_S,
+    ROGUE_CONTAINER_CLEANUP_INTERVAL_S,
     STABILITY_CHECK,
+    STABILITY_CHECK_INTERVAL_S,
 )
+from .data.catalog_snapshot import CatalogSnapshot, get_catalog_snapshot
 from .data.colors import ColorManager
+from .data.container_pool import get_container_pool
+from .data.frozen_display import FrozenDisplayDetector
 from .data.groupings import Collection, Folder, Tag, load_experience_grouping
-from .data.loader import LoaderManager
+from .data.images import ImageManager, PullPriority, get_image_manager
+from .data.load_times import LoadTimeManager, get_load_time_manager
+from .data.loader import LOADER_WINDOW_CLASS, LoaderManager
 from .data.placard import PlacardApi, PlacardExperienceData
-from .data.screenshot import ScreenshotCapture
-from .data.stability import StabilityManager
+from .data.screenshot import (
+    ScreenshotTargetMissing,
+    ScreenshotUnavailable,
+    ScreenshotWorker,
+)
+from .data.stability import Remedy, StabilityManager, default_probes
+from .data.windows import IndexedWindow, WindowIndex, get_window_index
 from .data.wm import DisplayLayout, WmApi
-from .environments import EnvironmentState
+from .environments import BaseEnvironment, DockerEnvironment, EnvironmentState
 from .experiences import (
     BaseExperience,
     CurrentExperience,
     DockerExperience,
     load_experiences_fs,
 )
+from .metrics import (
+    environment_failures,
+    event_loop_lag_max_seconds,
+    event_loop_lag_seconds,
+    frozen_display_sample_seconds,
+    frozen_displays,
+    placard_retries,
+    transition_phase_seconds,
+    transition_seconds,
+)
+from .transitions import Transition, TransitionScheduler
 
 logger = logging.getLogger(__name__)
 
+_EVENT_LOOP_LAG_INTERVAL_S = 0.5
+# Number of lag samples the reported maximum is taken over, one minute's worth
+_EVENT_LOOP_LAG_WINDOW = 120
+
+
+def _experience_type_label(experience: Optional[BaseExperience]) -> str:
+    return experience.type.value if experience else "none"
+
+
+def _is_loader_window(window: IndexedWindow) -> bool:
+    return LOADER_WINDOW_CLASS in window.wm_class
+
+
+def _is_experience_window(window: IndexedWindow) -> bool:
+    return not _is_loader_window(window)
+
 
 class Controller:
-    # TODO: Redo these hints the way FastAPI does them internally
-    experiences: Dict[str, BaseExperience]
-    # TODO: Think up a cleaner way to do this...
-    collections: Dict[str, Collection]
-    tags: Dict[str, Tag]
-    folders: Dict[str, Folder]
     colors: ColorManager
-    # TODO: ...and this
-    experience_collection_map: Dict[str, str]
-    experience_tags_map: Dict[str, List[str]]
-    last_update: datetime
     last_started_setting_experience: Optional[datetime]
+    # What we serve, see the properties below
+    _catalog: Catalog
+    # What the next catalog is built from, only touched on the event loop
+    _experiences: Dict[str, BaseExperience]
+    _collections: Dict[str, Collection]
+    _tags: Dict[str, Tag]
+    _folders: Dict[str, Folder]
+    _catalog_task: Optional[asyncio.Task]
+    # Resolved once a catalog with the changes they're waiting on is published
+    _catalog_waiters: List[asyncio.Future]
     _wm: Optional[WmApi]
-    _screenshot_capture: ScreenshotCapture
+    _screenshots: ScreenshotWorker
     _placard: Optional[PlacardApi]
     _stability: StabilityManager
     _loader: LoaderManager
+    _windows: WindowIndex
+    _load_times: LoadTimeManager
+    _images: Optional[ImageManager]
+    _snapshot: CatalogSnapshot
+    # Docker experiences waiting on their image to be pulled before they're published
+    _pending_experiences: Dict[str, DockerExperience]
+    # Watches the last started experience until it's ready, then dismisses the loader
+    _readiness_task: Optional[asyncio.Task]
     _current: Optional[CurrentExperience]
+    _prepared: Optional[BaseExperience]
+    _prepare_task: Optional[asyncio.Task]
+    # Prepared experiences that a transition is headed for, by transition ID, until
+    # the transition starts them or finishes without doing so
+    _handed_over: Dict[str, Tuple[BaseExperience, asyncio.Task]]
+    _transitions: TransitionScheduler
     _modify_lock: asyncio.Lock
+    _load_lock: asyncio.Lock
 
     def __init__(self):
         self._modify_lock = asyncio.Lock()
+        self._load_lock = asyncio.Lock()
+        self._transitions = TransitionScheduler(self._run_transition)
 
-        self.experiences = {}
-        self.collections = {}
-        self.tags = {}
-        self.experience_collection_map = {}
-        self.experience_tags_map = {}
+        self.colors = ColorManager()
         self.last_started_setting_experience = None
+        self._catalog = Catalog.empty()
+        self._experiences = {}
+        self._collections = {}
+        self._tags = {}
+        self._folders = {}
+        self._catalog_task = None
+        self._catalog_waiters = []
 
-        self._screenshot_capture = ScreenshotCapture()
+        self._screenshots = ScreenshotWorker()
         self._wm = WmApi() if not DISABLE_WM else None
         self._placard = PlacardApi() if not DISABLE_PLACARD else None
-        self._stability = StabilityManager()
+        self._stability = StabilityManager(
+            default_probes(self._experience_container_ids)
+        )
         self._loader = LoaderManager(self._wm)
+        self._windows = get_window_index()
+        self._windows.start()
+        self._load_times = get_load_time_manager()
+        self._images = get_image_manager()
+        self._snapshot = get_catalog_snapshot()
+        if self._images:
+            self._images.add_listener(self._handle_image_pulled)
+        self._pending_experiences = {}
+        self._readiness_task = None
         self._current = None
+        self._prepared = None
+        self._prepare_task = None
+        self._handed_over = {}
 
         self._create_paths()
-        self.load_from_fs()
+        # The API serves right away, with experiences showing up as they finish
+        # loading
+        asyncio.get_event_loop().create_task(self.load_from_fs())
         # Clear the placard when starting up, but not if an experience has already been
         # set within the last 5 seconds--this should fix our problem with placard races
         # when starting up
         asyncio.get_event_loop().create_task(self._set_initial_empty_experience())
 
-    def load_from_fs(self):
-        self.load_experiences()
-        self.load_collections()
-        self.load_tags()
-        self.load_folders()
-        self.load_colors()
-        self.last_update = datetime.now()
-
-    def load_experiences(self):
-        self.experiences = {
-            experience.id: experience for experience in load_experiences_fs()
+    async def load_from_fs(self):
+        loop = asyncio.get_event_loop()
+        async with self._load_lock:
+            if not self._snapshot.loaded:
+                await loop.run_in_executor(None, self._snapshot.load)
+            if not self._load_times.loaded:
+                await loop.run_in_executor(None, self._load_times.load)
+            await self.load_collections()
+            await self.load_tags()
+            await self.load_folders()
+            await self.load_experiences()
+            await self._update_catalog()
+            self._snapshot.prune()
+            await loop.run_in_executor(None, self._snapshot.save)
+
+    async def load_experiences(self):
+        self.colors.load_cache()
+        deferred_ids = set()
+
+        def defer_experience(experience: BaseExperience):
+            if self._defer_experience(experience):
+                deferred_ids.add(experience.id)
+
+        loaded_ids = {
+            experience.id
+            for experience in await load_experiences_fs(
+                self._publish_experience, defer_experience
+            )
         }
+        # Experiences stay up while a reload is in progress, so we only drop the ones
+        # that are gone once it's done
+        for id in list(self._experiences):
+            if id not in loaded_ids:
+                del self._experiences[id]
+        for id in list(self._pending_experiences):
+            if id not in deferred_ids:
+                del self._pending_experiences[id]
 
-    def load_collections(self):
-        self.collections = load_experience_grouping(Collection, "collections.toml")
-        self._fill_experience_collection_map()
+    def _publish_experience(self, experience: BaseExperience):
+        self._experiences[experience.id] = experience
+        self._add_colors(experience)
+        self._update_catalog()
 
-    def load_folders(self):
-        self.folders = load_experience_grouping(Folder, "folders.toml")
-        self._fill_experience_folder_map()
+    def _add_colors(
+        self, experience: BaseExperience, thumbnail_hash: Optional[str] = None
+    ):
+        try:
+            self.colors.add(experience, thumbnail_hash)
+        except Exception as e:
+            rollbar.report_exc_info(e)
+            logger.exception(f"Couldn't load colors for experience '{experience.id}'")
 
-    def load_tags(self):
-        self.tags = load_experience_grouping(Tag, "tags.toml")
-        self._fill_experience_tag_map()
+    def _defer_experience(self, experience: BaseExperience) -> bool:
+        """
+        Queue a pull for a Docker experience's missing image, publishing the
+        experience once it's done. Returns False for experiences that won't become
+        available.
+        """
+        if not isinstance(experience, DockerExperience) or not self._images:
+            return False
 
-    def load_colors(self):
-        self.colors = ColorManager()
-        self.colors.load(list(self.experiences.values()))
+        self._pending_experiences[experience.id] = experience
+        # Queueable experiences will come up in the rotation, so they go first
+        self._images.pull(
+            experience.image_id,
+            PullPriority.ROTATION if experience.queueable else PullPriority.CATALOG,
+        )
+        return True
+
+    def _handle_image_pulled(self, image_id: str):
+        for experience in list(self._pending_experiences.values()):
+            if experience.image_id == image_id:
+                del self._pending_experiences[experience.id]
+                logger.info(f"Image pulled, experience '{experience.id}' is available")
+                self._publish_experience(experience)
+
+        # Pooled containers were created from the old image, so they have to go.
+        # The current experience keeps running the old image until it's restarted.
+        pool = get_container_pool()
+        if not pool:
+            return
+        loop = asyncio.get_event_loop()
+        for experience in self.experiences.values():
+            if (
+                isinstance(experience, DockerExperience)
+                and experience.image_id == image_id
+                and experience.id in pool
+            ):
+                loop.create_task(pool.discard(experience.id))
+
+    async def load_collections(self):
+        self._collections = await asyncio.get_event_loop().run_in_executor(
+            None, load_experience_grouping, Collection, "collections.toml"
+        )
+
+    async def load_folders(self):
+        self._folders = await asyncio.get_event_loop().run_in_executor(
+            None, load_experience_grouping, Folder, "folders.toml"
+        )
+
+    async def load_tags(self):
+        self._tags = await asyncio.get_event_loop().run_in_executor(
+            None, load_experience_grouping, Tag, "tags.toml"
+        )
+
+    def _update_catalog(self) -> asyncio.Future:
+        """
+        Build a new catalog from the current loading state and swap it in, returning
+        a future that resolves once it's published. Changes made while a catalog is
+        being built are batched into the next one.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._catalog_waiters.append(future)
+        if not self._catalog_task:
+            self._catalog_task = loop.create_task(self._build_catalogs())
+        return future
+
+    async def _build_catalogs(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._catalog_waiters:
+                waiters, self._catalog_waiters = self._catalog_waiters, []
+                # Copied here so that loading can carry on while we build
+                build = functools.partial(
+                    Catalog,
+                    dict(self._experiences),
+                    dict(self._collections),
+                    dict(self._tags),
+                    dict(self._folders),
+                    self.colors.palettes(),
+                    datetime.now(),
+                )
+                try:
+                    self._catalog = await loop.run_in_executor(None, build)
+                except Exception as e:
+                    # Keep serving the last good catalog
+                    rollbar.report_exc_info(e)
+                    logger.exception("Error while building experience catalog")
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+        finally:
+            self._catalog_task = None
+
+    @property
+    def catalog(self) -> Catalog:
+        return self._catalog
+
+    @property
+    def experiences(self) -> Mapping[str, BaseExperience]:
+        return self._catalog.experiences
+
+    @property
+    def pending_experiences(self) -> Mapping[str, DockerExperience]:
+        """
+        Docker experiences whose images are still being pulled.
+        """
+        return self._pending_experiences
+
+    @property
+    def last_update(self) -> datetime:
+        return self._catalog.last_update
 
     @property
     def current(self) -> Optional[CurrentExperience]:
         return self._current
 
     @property
-    def screenshot_capture(self):
-        return self._screenshot_capture
+    def load_times(self):
+        return self._load_times
+
+    @property
+    def screenshots(self):
+        return self._screenshots
 
     @property
     def placard(self):
@@ -133,54 +362,43 @@ class Controller:
         async with self._modify_lock:
             self._current.lock = value
 
-    def _fill_experience_collection_map(self):
-        self.experience_collection_map = {}
-        for collection in self.collections.values():
-            for experience in collection.experiences:
-                self.experience_collection_map[experience] = collection.id
-
-    def _fill_experience_tag_map(self):
-        self.experience_tag_map = {}
-        for experience in self.experiences:
-            self.experience_tag_map[experience] = []
-        for tag in self.tags.values():
-            for experience in tag.experiences:
-                if experience not in self.experience_tag_map:
-                    continue
-
-                self.experience_tag_map[experience].append(tag.id)
-
-    def _fill_experience_folder_map(self):
-        self.experience_folders_map = {}
-        for experience in self.experiences:
-            self.experience_folders_map[experience] = []
-
-        for folder in self.folders.values():
-            for tag in folder.tags:
-                for experience in self.tags[tag].experiences:
-                    if experience not in self.experiences:
-                        continue
-                    self.experience_folders_map[experience].append(folder.id)
-
     @staticmethod
     def _create_paths():
         EXPERIENCES_PATH.mkdir(parents=True, exist_ok=True)
         EXPERIENCE_DATA_PATH.mkdir(parents=True, exist_ok=True)
         BASE_BIN_PATH.mkdir(parents=True, exist_ok=True)
 
-    async def _update_experience_display(self, experience: Optional[BaseExperience]):
-        await self._try_launch_loader(experience)
+    async def _update_experience_display(
+        self, experience: Optional[BaseExperience]
+    ) -> Optional[asyncio.Future]:
+        experience_type = _experience_type_label(experience)
+        with transition_phase_seconds.time(
+            phase="loader", experience_type=experience_type
+        ):
+            loader_shown = await self._try_launch_loader(experience)
         # We don't actually want to wait for this to complete
         if self._placard:
-            asyncio.get_event_loop().create_task(self._update_placard(experience))
+            asyncio.get_event_loop().create_task(self._update_placard_timed(experience))
         if self._wm:
-            await self._wm.set_layout(
-                experience.layout if experience else DisplayLayout.Wide
-            )
+            with transition_phase_seconds.time(
+                phase="set_layout", experience_type=experience_type
+            ):
+                await self._wm.set_layout(
+                    experience.layout if experience else DisplayLayout.Wide
+                )
+        return loader_shown
+
+    def transition(self, id: str) -> Optional[Transition]:
+        return self._transitions.get(id)
 
     async def set_experience(
         self, id: Optional[str], *, throttle: int = None, update_throttle: bool = True
-    ) -> bool:
+    ) -> Optional[Transition]:
+        """
+        Request a switch to another experience, superseding any switch still in
+        progress. Returns the transition to wait on, or None if the request was
+        throttled.
+        """
         delta_last_experience = (
             (datetime.now() - self.last_started_setting_experience)
             if throttle and self._current and self.last_started_setting_experience
@@ -192,55 +410,271 @@ class Controller:
             and delta_last_experience.seconds < throttle
             and delta_last_experience.days == 0
         ):
-            return False
+            return None
 
-        # We just return here instead of waiting for a lock because we don't want
-        # experience changes to queue up and lock up the display.
-        if self._modify_lock.locked():
-            return False
+        if update_throttle:
+            self.last_started_setting_experience = datetime.now()
+
+        # Experience changes don't queue up: only the latest request is ever shown
+        transition = self._transitions.request(id)
+        self._hand_over_prepared(transition)
+        return transition
 
+    async def _run_transition(self, transition: Transition) -> bool:
         async with self._modify_lock:
-            await self._set_experience_impl(id, update_throttle=update_throttle)
-        return True
+            return await self._set_experience_impl(
+                transition.experience_id, transition=transition
+            )
 
     async def _set_experience_impl(
-        self, id: Optional[str], *, update_throttle: bool = True
-    ):
+        self, id: Optional[str], *, transition: Optional[Transition] = None
+    ) -> bool:
         if self._current and self._current.id == id:
-            return
-
-        if update_throttle:
-            self.last_started_setting_experience = datetime.now()
+            return True
 
         # Unchecked exception, consumer's responsibility to know that experience with
         # ID exists
         experience = self.experiences[id] if id else None
-        await self._update_experience_display(experience)
+        experience_type = _experience_type_label(experience)
+        with transition_seconds.time(experience_type=experience_type):
+            return await self._set_experience_phases(experience, transition)
+
+    async def _set_experience_phases(
+        self, experience: Optional[BaseExperience], transition: Optional[Transition]
+    ) -> bool:
+        experience_type = _experience_type_label(experience)
+        with transition_phase_seconds.time(
+            phase="claim_prepared", experience_type=experience_type
+        ):
+            await self._wait_prepared(transition)
+        loader_shown = await self._update_experience_display(experience)
+        loader_deadline = (
+            asyncio.get_event_loop().time() + self._expected_load_time(experience)
+            if loader_shown
+            else None
+        )
 
         try:
             if self._wm:
-                await self._wm.clear_viewport()
+                with transition_phase_seconds.time(
+                    phase="clear_viewport", experience_type=experience_type
+                ):
+                    await self._wm.clear_viewport()
             if self._current:
                 asyncio.get_event_loop().create_task(self._current.stop(experience))
         finally:
+            skipped = False
+            first_frame = None
             try:
                 if experience:
-                    if experience.load_time:
-                        # Wait for loading screen to kick in (we need a better solution
-                        # here)
-                        await asyncio.sleep(1)
-                    await experience.start(
-                        self._current.experience if self._current else None
-                    )
+                    if loader_shown:
+                        # Don't start the experience until the loader is covering the
+                        # viewport
+                        with transition_phase_seconds.time(
+                            phase="loader_wait", experience_type=experience_type
+                        ):
+                            await asyncio.wait(
+                                {loader_shown}, timeout=LOADER_SHOW_TIMEOUT_S
+                            )
+                    # Someone may have asked for another experience in the meantime,
+                    # in which case there's no point in starting this one
+                    skipped = transition is not None and transition.superseded
+                    if not skipped:
+                        if transition:
+                            # Ours to start now, see _release_handed_over
+                            self._handed_over.pop(transition.id, None)
+                        first_frame = self._windows.wait_for_map(_is_experience_window)
+                        started_at = asyncio.get_event_loop().time()
+                        with transition_phase_seconds.time(
+                            phase="start", experience_type=experience_type
+                        ):
+                            await self._start_experience(experience, transition)
+            except asyncio.CancelledError:
+                # Preempted while starting, see TransitionScheduler
+                self._set_current(None)
+                await self._stop_preempted(experience)
+                raise
             except Exception:
-                self._current = None
+                self._set_current(None)
                 raise
             else:
-                self._current = (
+                self._set_current(
                     CurrentExperience(experience, datetime.now())
-                    if experience
+                    if experience and not skipped
                     else None
                 )
+                if first_frame:
+                    self._readiness_task = asyncio.get_event_loop().create_task(
+                        self._watch_readiness(
+                            experience, first_frame, started_at, loader_deadline
+                        )
+                    )
+                    first_frame = None
+            finally:
+                if loader_shown:
+                    loader_shown.cancel()
+                if first_frame:
+                    first_frame.cancel()
+        return not skipped
+
+    async def _start_experience(
+        self, experience: BaseExperience, transition: Optional[Transition]
+    ):
+        last_experience = self._current.experience if self._current else None
+        if transition:
+            transition.preemptible = True
+        try:
+            await experience.start(last_experience)
+        finally:
+            if transition:
+                transition.preemptible = False
+
+    @staticmethod
+    async def _stop_preempted(experience: BaseExperience):
+        try:
+            await experience.stop()
+        except Exception as e:
+            rollbar.report_exc_info(e)
+            logger.exception(
+                f"Error while stopping preempted experience '{experience.id}'"
+            )
+
+    def _set_current(self, current: Optional[CurrentExperience]):
+        if self._current and self._current.environment:
+            self._current.environment.remove_failure_listener(
+                self._on_environment_failed
+            )
+        self._current = current
+        if current and current.environment:
+            current.environment.add_failure_listener(self._on_environment_failed)
+
+    def _on_environment_failed(self, environment: BaseEnvironment):
+        if not self._current or self._current.environment is not environment:
+            return
+        asyncio.get_event_loop().create_task(self._handle_environment_failure())
+
+    async def _handle_environment_failure(self):
+        environment_failures.inc(
+            experience_type=_experience_type_label(
+                self._current.experience if self._current else None
+            )
+        )
+        try:
+            logger.error(
+                "Environment failed, attempting to set current experience to empty..."
+            )
+            await self.set_experience(None, throttle=5)
+        except Exception as e:
+            rollbar.report_exc_info(e)
+            logger.exception("Error while handling environment failure")
+
+    def prepare_experience(self, id: Optional[str]):
+        """
+        Warm up the experience we expect to show next so that switching to it later
+        only has to finish starting it. Replaces any previously prepared experience.
+        """
+        if id in self._pending_experiences:
+            # Can't warm up an experience without its image, but we can get the
+            # image sooner
+            self._discard_prepared()
+            self._images.prioritize(
+                self._pending_experiences[id].image_id, PullPriority.NEXT
+            )
+            return
+
+        # Unchecked exception, consumer's responsibility to know that experience with
+        # ID exists
+        experience = self.experiences[id] if id else None
+        if experience is self._prepared:
+            return
+
+        self._discard_prepared()
+        if not experience or self._headed_for(experience):
+            return
+
+        self._prepared = experience
+        self._prepare_task = asyncio.get_event_loop().create_task(
+            self._prepare_experience_impl(experience)
+        )
+
+    def _headed_for(self, experience: BaseExperience) -> bool:
+        # Already current, or a transition is on its way to making it current
+        if self._current and self._current.experience is experience:
+            return True
+        latest = self._transitions.latest
+        return latest is not None and latest.experience_id == experience.id
+
+    @staticmethod
+    async def _prepare_experience_impl(experience: BaseExperience):
+        try:
+            if not await experience.environment.can_prepare():
+                # Most likely still stopping from the last time it was shown, so it
+                # will just start cold
+                logger.info(
+                    f"Not preparing experience '{experience.id}', it isn't stopped yet"
+                )
+                return
+            await experience.prepare()
+        except Exception as e:
+            # Failing to prepare isn't fatal--the experience will just start cold
+            rollbar.report_exc_info(e)
+            logger.exception(f"Error while preparing experience '{experience.id}'")
+
+    def _hand_over_prepared(self, transition: Transition):
+        """
+        Give the prepared experience to a newly requested transition if that's where
+        it's headed, and discard it otherwise. Anything prepared after this is left
+        for later transitions.
+        """
+        if not self._prepared or transition.id in self._handed_over:
+            return
+
+        if self._prepared.id != transition.experience_id:
+            self._discard_prepared()
+            return
+
+        self._handed_over[transition.id] = (self._prepared, self._prepare_task)
+        self._prepared = None
+        self._prepare_task = None
+        asyncio.get_event_loop().create_task(self._release_handed_over(transition))
+
+    async def _wait_prepared(self, transition: Optional[Transition]):
+        if not transition or transition.id not in self._handed_over:
+            return
+
+        # Make sure preparation has settled before we try to start the experience
+        _, prepare_task = self._handed_over[transition.id]
+        await prepare_task
+
+    async def _release_handed_over(self, transition: Transition):
+        # Transitions that never got to start their prepared experience, e.g. because
+        # they were superseded, leave it to us to stop
+        await transition.wait()
+        if handed_over := self._handed_over.pop(transition.id, None):
+            await self._stop_prepared(*handed_over)
+
+    def _discard_prepared(self):
+        if not self._prepared:
+            return
+
+        asyncio.get_event_loop().create_task(
+            self._stop_prepared(self._prepared, self._prepare_task)
+        )
+        self._prepared = None
+        self._prepare_task = None
+
+    @staticmethod
+    async def _stop_prepared(experience: BaseExperience, prepare_task: asyncio.Task):
+        await prepare_task
+        if (await experience.environment.state()) != EnvironmentState.PREPARED:
+            return
+        try:
+            await experience.stop()
+        except Exception as e:
+            rollbar.report_exc_info(e)
+            logger.exception(
+                f"Error while stopping unused prepared experience '{experience.id}'"
+            )
 
     async def _set_initial_empty_experience(self):
         await asyncio.sleep(INITIAL_EMPTY_EXPERIENCE_DELAY_S)
@@ -250,14 +684,123 @@ class Controller:
             update_throttle=False,
         )
 
-    async def _try_launch_loader(self, experience: BaseExperience):
-        if not experience or not experience.load_time:
-            return
+    async def _try_launch_loader(
+        self, experience: BaseExperience
+    ) -> Optional[asyncio.Future]:
+        """
+        Show the loader if the experience needs it, returning a future for the loader
+        window showing up.
+        """
+        # Whatever the loader was covering for is being replaced
+        if self._readiness_task:
+            self._readiness_task.cancel()
+            self._readiness_task = None
 
-        await self._loader.start()
-        asyncio.get_event_loop().create_task(
-            self._loader.stop_after_timeout(experience.load_time)
-        )
+        if not experience or not self._needs_loader(experience):
+            if self._loader.running:
+                asyncio.get_event_loop().create_task(self._loader.stop())
+            return None
+
+        # Watch before launching so that we can't miss the window
+        loader_shown = self._windows.wait_for_map(_is_loader_window)
+        if not await self._loader.start():
+            # Already up from a transition that was superseded
+            loader_shown.set_result(None)
+        return loader_shown
+
+    def _expected_load_time(self, experience: BaseExperience) -> Optional[float]:
+        return self._load_times.load_time(experience.id, experience.load_time)
+
+    def _needs_loader(self, experience: BaseExperience) -> bool:
+        # A configured load_time always gets the loader, however fast we've seen the
+        # experience start: that doesn't mean its first frames are presentable. Without
+        # one, the loader only shows once we've learned that the experience is slow.
+        if experience.load_time:
+            return True
+        estimate = self._load_times.estimate(experience.id)
+        return estimate is not None and estimate >= LOADER_MIN_LOAD_TIME_S
+
+    async def _watch_readiness(
+        self,
+        experience: BaseExperience,
+        first_frame: asyncio.Future,
+        started_at: float,
+        loader_deadline: Optional[float],
+    ):
+        """
+        Wait for a started experience to put something on screen and take the loader
+        down, then keep waiting for the experience to report that it's ready so that
+        we learn how long that took. The loader goes early if the experience takes
+        longer than we expect it to.
+
+        Only the experience's own readiness signal counts towards its load time: its
+        window showing up says nothing about whether what's in it has loaded.
+        """
+        loop = asyncio.get_event_loop()
+        readiness = loop.create_task(experience.environment.wait_ready())
+        waiting = {first_frame, readiness}
+        give_up_at = started_at + READINESS_WATCH_TIMEOUT_S
+        shown = False
+        try:
+            while readiness in waiting:
+                deadline = (
+                    loader_deadline if loader_deadline is not None else give_up_at
+                )
+                done, waiting = await asyncio.wait(
+                    waiting,
+                    timeout=max(deadline - loop.time(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                elapsed = loop.time() - started_at
+                if not done:
+                    if loader_deadline is None:
+                        break
+                    logger.info(
+                        f"Experience '{experience.id}' isn't ready within its expected "
+                        "load time, dismissing loader anyway"
+                    )
+                    loader_deadline = None
+                    await self._stop_loader()
+                    continue
+
+                # wait_ready() returns False when the environment has no readiness
+                # signal of its own, and errors count as no signal either
+                signalled = [
+                    future
+                    for future in done
+                    if not future.cancelled()
+                    and not future.exception()
+                    and future.result() is not False
+                ]
+                if signalled and not shown:
+                    shown = True
+                    transition_phase_seconds.observe(
+                        elapsed,
+                        phase="first_frame",
+                        experience_type=_experience_type_label(experience),
+                    )
+                    if loader_deadline is not None:
+                        loader_deadline = None
+                        await self._stop_loader()
+                if readiness in signalled:
+                    await self._load_times.record(experience.id, elapsed)
+        finally:
+            for future in waiting:
+                future.cancel()
+
+        if loader_deadline is not None:
+            await self._stop_loader()
+
+    async def _stop_loader(self):
+        # The next transition cancels readiness watching, but it shouldn't interrupt
+        # the loader halfway through being killed
+        await asyncio.shield(self._loader.stop())
+
+    async def _update_placard_timed(self, experience: BaseExperience):
+        with transition_phase_seconds.time(
+            phase="placard", experience_type=_experience_type_label(experience)
+        ):
+            await self._update_placard(experience)
 
     async def _update_placard(self, experience: BaseExperience):
         # TODO: Validate this worked somehow
@@ -288,62 +831,326 @@ class Controller:
             logger.warning(
                 "Updating placard failed with client exception, retrying in 1s"
             )
+            placard_retries.inc()
             # Wait for a second and try again
             await asyncio.sleep(1)
             await self._update_placard(experience)
 
     async def _cleanup_rogue_docker_containers(self):
-        for experience in self.experiences.values():
-            if not isinstance(experience, DockerExperience) or (
-                self._current and experience.id == self._current.id
-            ):
-                continue
-            await experience.attempt_cleanup()
+        await DockerEnvironment.cleanup_rogue_containers()
 
     async def colors_handling_loop(self):
         while True:
             try:
-                self.colors.load_queued_colors()
+                if self.colors.load_queued_colors():
+                    self._update_catalog()
             except Exception as e:
                 rollbar.report_exc_info(e)
                 logger.exception("Error while handling colors")
             await asyncio.sleep(1)
 
+    async def event_loop_lag_loop(self):
+        loop = asyncio.get_event_loop()
+        samples = deque(maxlen=_EVENT_LOOP_LAG_WINDOW)
+        while True:
+            expected = loop.time() + _EVENT_LOOP_LAG_INTERVAL_S
+            await asyncio.sleep(_EVENT_LOOP_LAG_INTERVAL_S)
+            lag = max(loop.time() - expected, 0)
+            samples.append(lag)
+            event_loop_lag_seconds.set(lag)
+            event_loop_lag_max_seconds.set(max(samples))
+
     async def handle_experience_exit_loop(self):
+        # Environments push failures to _on_environment_failed as they happen, so this
+        # loop is mostly a fallback. It still polls every second for environments that
+        # can't push, and only occasionally for the ones that can.
+        loop = asyncio.get_event_loop()
+        last_check = 0
         while True:
-            logger.debug("Checking current experience state for exit...")
             try:
+                environment = self._current.environment if self._current else None
                 if (
-                    self._current
-                    and (await self._current.environment.state())
-                    == EnvironmentState.FAILED
+                    environment
+                    and loop.time() - last_check >= environment.failure_poll_interval
                 ):
-                    logger.error(
-                        "Environment failed, attempting to set current experience to empty..."
-                    )
-                    await self.set_experience(None, throttle=5)
+                    logger.debug("Checking current experience state for exit...")
+                    last_check = loop.time()
+                    if (await environment.state()) == EnvironmentState.FAILED:
+                        await self._handle_environment_failure()
             except Exception as e:
                 rollbar.report_exc_info(e)
                 logger.exception("Error while handling experience exit loop")
-            await asyncio.sleep(1)
+            await asyncio.sleep(FAILURE_POLL_INTERVAL_S)
+
+    def _experience_container_ids(self) -> List[str]:
+        container_ids = []
+        environment = self._current.environment if self._current else None
+        if isinstance(environment, DockerEnvironment) and environment.container_id:
+            container_ids.append(environment.container_id)
+        if pool := get_container_pool():
+            container_ids.extend(pool.container_ids())
+        return container_ids
+
+    async def _restart_current_experience(self):
+        if self._modify_lock.locked() or not self._current:
+            return
+
+        async with self._modify_lock:
+            self.last_started_setting_experience = datetime.now()
+            current = self._current
+            # Detach first so the failure we're about to mark isn't handled as a
+            # crash, and so that the environment isn't kept around in the pool
+            self._set_current(None)
+            current.environment.mark_failed("restarting to relieve system pressure")
+            try:
+                await current.experience.stop()
+            except Exception as e:
+                # Starting again can still recover from a failed stop
+                rollbar.report_exc_info(e)
+                logger.exception(f"Error while stopping experience '{current.id}'")
+            await self._set_experience_impl(current.id)
+
+    async def _apply_remedy(self, remedy: Remedy):
+        if remedy == Remedy.NONE:
+            return
+
+        rollbar.report_message(f"System is unstable, applying remedy {remedy.name}")
+        logger.error(f"System is unstable, applying remedy {remedy.name}")
+        if remedy == Remedy.CLEAR_CONTAINER_POOL:
+            if pool := get_container_pool():
+                await pool.clear()
+        elif remedy == Remedy.RESTART_EXPERIENCE:
+            await self._restart_current_experience()
+        elif remedy == Remedy.REBOOT:
+            # Note that the current user has to have NOPASSWD set up in
+            # /etc/sudoers for /sbin/reboot on Ubuntu systems for this to
+            # work from Python
+            os.system("sudo reboot")
+
+    async def catalog_watch_loop(self):
+        """
+        Apply changes to experience directories and grouping files as they happen on
+        disk, reloading only what changed.
+        """
+        # Grouping files sit right next to everything else we keep in the data
+        # directory, so it isn't watched recursively
+        await asyncio.gather(
+            self._watch_catalog_path(EXPERIENCES_PATH, recursive=True),
+            self._watch_catalog_path(BASE_DATA_PATH, recursive=False),
+        )
+
+    async def _watch_catalog_path(self, path: Path, recursive: bool):
+        while True:
+            try:
+                async for changes in watchfiles.awatch(
+                    path, recursive=recursive, debounce=CATALOG_WATCH_DEBOUNCE_MS
+                ):
+                    await self._apply_catalog_changes(
+                        Path(changed_path) for _, changed_path in changes
+                    )
+            except Exception as e:
+                rollbar.report_exc_info(e)
+                logger.exception(f"Error while watching '{path}' for catalog changes")
+            await asyncio.sleep(CATALOG_WATCH_RETRY_INTERVAL_S)
+
+    async def _apply_catalog_changes(self, changed_paths: Iterable[Path]):
+        experiences_path = EXPERIENCES_PATH.resolve()
+        data_path = BASE_DATA_PATH.resolve()
+        experience_paths = set()
+        grouping_files = set()
+        for changed_path in changed_paths:
+            changed_path = changed_path.resolve()
+            if experiences_path in changed_path.parents:
+                # Experiences are loaded by their directory, so any change within one
+                # reloads it
+                experience_dir = changed_path.relative_to(experiences_path).parts[0]
+                experience_paths.add(EXPERIENCES_PATH / experience_dir)
+            elif changed_path.parent == data_path:
+                grouping_files.add(changed_path.name)
+
+        if not experience_paths and not grouping_files:
+            return
+
+        async with self._load_lock:
+            changed = await self._reload_groupings(grouping_files)
+            changed = await self._reload_experiences(experience_paths) or changed
+            if changed:
+                await self._update_catalog()
+            await asyncio.get_event_loop().run_in_executor(None, self._snapshot.save)
+
+    async def _reload_groupings(self, file_names: Set[str]) -> bool:
+        changed = False
+        try:
+            if "collections.toml" in file_names:
+                collections = self._collections
+                await self.load_collections()
+                changed = changed or self._collections != collections
+            if "tags.toml" in file_names:
+                tags = self._tags
+                await self.load_tags()
+                changed = changed or self._tags != tags
+            if "folders.toml" in file_names:
+                folders = self._folders
+                await self.load_folders()
+                changed = changed or self._folders != folders
+        except Exception as e:
+            # Most likely caught the file halfway through being written, the rest of
+            # the write will trigger another reload
+            rollbar.report_exc_info(e)
+            logger.exception("Error while reloading experience groupings")
+        return changed
+
+    async def _reload_experiences(self, paths: Set[Path]) -> bool:
+        if not paths:
+            return False
+
+        changed = False
+        reloaded_ids = set()
+
+        def publish(experience: BaseExperience):
+            nonlocal changed
+            reloaded_ids.add(experience.id)
+            self._pending_experiences.pop(experience.id, None)
+            existing = self._experiences.get(experience.id)
+            if existing is not None and existing == experience:
+                # Keep the object that might be current or prepared, but the
+                # thumbnail can change without the config changing
+                self._add_colors(existing, experience.thumbnail_hash)
+                return
+            logger.info(f"Reloading experience '{experience.id}'")
+            self._publish_experience(experience)
+            changed = True
+
+        def defer(experience: BaseExperience):
+            nonlocal changed
+            if not self._defer_experience(experience):
+                return
+            reloaded_ids.add(experience.id)
+            if experience.id in self._experiences:
+                # Published again once its new image has been pulled
+                del self._experiences[experience.id]
+                changed = True
+
+        await load_experiences_fs(publish, defer, experience_paths=paths)
+
+        for experience in list(self._experiences.values()):
+            if (
+                experience.experience_path in paths
+                and experience.id not in reloaded_ids
+            ):
+                logger.info(f"Removing experience '{experience.id}'")
+                del self._experiences[experience.id]
+                changed = True
+        for experience in list(self._pending_experiences.values()):
+            if (
+                experience.experience_path in paths
+                and experience.id not in reloaded_ids
+            ):
+                del self._pending_experiences[experience.id]
+        return changed
+
+    async def image_refresh_loop(self):
+        if not self._images:
+            return
+
+        while True:
+            await asyncio.sleep(IMAGE_REFRESH_INTERVAL_S)
+            logger.debug("Checking Docker images for updates...")
+            try:
+                await self._images.refresh(
+                    {
+                        experience.image_id
+                        for experience in self.experiences.values()
+                        if isinstance(experience, DockerExperience)
+                    }
+                )
+            except Exception as e:
+                rollbar.report_exc_info(e)
+                logger.exception("Error while checking Docker images for updates")
+
+    async def frozen_display_loop(self):
+        """
+        Fail running experiences whose picture has stopped changing, which their
+        environments can't tell us about because their processes are still alive.
+        See FrozenDisplayDetector.
+        """
+        detector: Optional[FrozenDisplayDetector] = None
+        watched: Optional[CurrentExperience] = None
+        while True:
+            interval = FAILURE_POLL_INTERVAL_S
+            try:
+                current = self._current
+                if current is not watched:
+                    watched = current
+                    detector = None
+                    timeout = (
+                        current.experience.frozen_display_timeout if current else 0
+                    )
+                    if timeout:
+                        detector = FrozenDisplayDetector(
+                            timeout,
+                            FROZEN_DISPLAY_SAMPLE_INTERVALS_S[
+                                current.experience.type.value
+                            ],
+                        )
+
+                # Nothing to check until the experience has put something on screen
+                readiness_task = self._readiness_task
+                if detector and (readiness_task is None or readiness_task.done()):
+                    with frozen_display_sample_seconds.time():
+                        thumbnail = await self._screenshots.thumbnail(
+                            "viewport", FROZEN_DISPLAY_TILE_SIZE
+                        )
+                    # The experience could have changed while we were capturing
+                    if self._current is watched and detector.observe(
+                        thumbnail, datetime.now(), watched.last_interaction
+                    ):
+                        frozen_displays.inc(
+                            experience_type=_experience_type_label(watched.experience)
+                        )
+                        watched.environment.mark_failed(
+                            "picture hasn't changed in "
+                            f"{detector.timeout.total_seconds():g}s"
+                        )
+                        detector = None
+                    else:
+                        interval = detector.interval
+            except ScreenshotTargetMissing:
+                if detector:
+                    detector.reset()
+                    interval = detector.interval
+            except asyncio.TimeoutError:
+                # The screenshot thread is busy, e.g. with streams. We can't tell how
+                # long the picture stayed the same in the meantime, so we start over,
+                # and give the thread some room before asking again.
+                logger.warning("Timed out sampling the viewport for a frozen display")
+                if detector:
+                    detector.back_off()
+                    interval = detector.interval
+            except ScreenshotUnavailable:
+                # No X server, so there's nothing to watch
+                detector = None
+            except Exception as e:
+                rollbar.report_exc_info(e)
+                logger.exception("Error while checking for a frozen display")
+            await asyncio.sleep(interval)
 
     async def stability_loop(self):
-        # TODO: Break this method up
+        loop = asyncio.get_event_loop()
+        last_cleanup = None
         while True:
             logging.debug("Checking system stability...")
             try:
-                asyncio.get_event_loop().create_task(
-                    self._cleanup_rogue_docker_containers()
-                )
+                if (
+                    last_cleanup is None
+                    or loop.time() - last_cleanup >= ROGUE_CONTAINER_CLEANUP_INTERVAL_S
+                ):
+                    last_cleanup = loop.time()
+                    loop.create_task(self._cleanup_rogue_docker_containers())
 
-                if STABILITY_CHECK and not self._stability.check_stable():
-                    rollbar.report_message("System is unstable, rebooting")
-                    logging.error("System is unstable, rebooting")
-                    # Note that the current user has to have NOPASSWD set up in
-                    # /etc/sudoers for /sbin/reboot on Ubuntu systems for this to
-                    # work from Python
-                    os.system("sudo reboot")
+                if STABILITY_CHECK:
+                    await self._apply_remedy(await self._stability.check())
             except Exception as e:
                 rollbar.report_exc_info(e)
                 logger.exception("Error while checking stability")
-            await asyncio.sleep(15)
+            await asyncio.sleep(STABILITY_CHECK_INTERVAL_S)
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import logging
+import pickle
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Set, Tuple
+
+from ..constants import CATALOG_SNAPSHOT_PATH, PACKAGE_PATH
+
+logger = logging.getLogger(__name__)
+
+_catalog_snapshot: Optional[CatalogSnapshot] = None
+
+_SNAPSHOT_VERSION = 1
+
+# Cached entries are only as good as the code that made them, so the snapshot is
+# thrown out whenever the models it was built from change
+_SCHEMA_SOURCES = [
+    PACKAGE_PATH / "experiences.py",
+    PACKAGE_PATH / "data" / "groupings.py",
+    PACKAGE_PATH / "data" / "colors.py",
+]
+
+# Files modified this recently could still change without their mtime changing (on
+# filesystems with coarse timestamps), so we wait for them to settle before caching
+_RACY_WINDOW_NS = 2_000_000_000
+
+# (mtime in nanoseconds, size), or None for a file that doesn't exist
+FileKey = Optional[Tuple[int, int]]
+InputKey = Tuple[FileKey, ...]
+
+
+def input_key(*paths: Path) -> InputKey:
+    key = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            key.append(None)
+            continue
+        key.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(key)
+
+
+class CatalogSnapshot:
+    """
+    A pickled cache of everything we derive from files in the catalog (validated
+    experience configs, parsed grouping and color files, thumbnail hashes), so that
+    a restart only has to redo the work for files that changed since.
+
+    Entries are keyed by the mtimes and sizes of the files they were derived from.
+    Checking a key only takes a stat call per file, and an entry whose files have
+    changed is treated as missing.
+    """
+
+    _path: Path
+    _entries: Dict[str, Tuple[InputKey, Any]]
+    # Names looked up or stored since the last prune
+    _used: Set[str]
+    _loaded: bool
+    _dirty: bool
+
+    def __init__(self, path: Path = CATALOG_SNAPSHOT_PATH):
+        self._path = path
+        self._entries = {}
+        self._used = set()
+        self._loaded = False
+        self._dirty = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self):
+        self._entries = {}
+        self._loaded = True
+        if not self._path.exists():
+            return
+
+        try:
+            with open(self._path, "rb") as snapshot_file:
+                version, schema, entries = pickle.load(snapshot_file)
+        except Exception:
+            # Anything from a truncated write to a class that no longer exists
+            logger.warning("Couldn't read catalog snapshot, loading catalog from disk")
+            return
+
+        if version != _SNAPSHOT_VERSION or schema != input_key(*_SCHEMA_SOURCES):
+            logger.info("Catalog snapshot is out of date, loading catalog from disk")
+            return
+        self._entries = entries
+
+    def get(self, name: str, key: InputKey) -> Optional[Any]:
+        self._used.add(name)
+        entry = self._entries.get(name)
+        if entry is None or entry[0] != key:
+            return None
+        return entry[1]
+
+    def put(self, name: str, key: InputKey, value: Any):
+        self._used.add(name)
+        settled = time.time_ns() - _RACY_WINDOW_NS
+        if any(file_key and file_key[0] > settled for file_key in key):
+            self._entries.pop(name, None)
+            return
+        self._entries[name] = (key, value)
+        self._dirty = True
+
+    def prune(self):
+        """
+        Drop entries that haven't been used since the last prune, e.g. for
+        experiences that were removed.
+        """
+        for name in set(self._entries) - self._used:
+            del self._entries[name]
+            self._dirty = True
+        self._used = set()
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        # Colors can still be added from the event loop while we're saving
+        entries = dict(self._entries)
+        self._dirty = False
+        temp_path = self._path.with_suffix(".tmp")
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with open(temp_path, "wb") as snapshot_file:
+                pickle.dump(
+                    (_SNAPSHOT_VERSION, input_key(*_SCHEMA_SOURCES), entries),
+                    snapshot_file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            temp_path.replace(self._path)
+        except Exception:
+            self._dirty = True
+            logger.exception("Couldn't save catalog snapshot")
+
+
+def get_catalog_snapshot() -> CatalogSnapshot:
+    global _catalog_snapshot
+    if _catalog_snapshot is None:
+        _catalog_snapshot = CatalogSnapshot()
+
+    return _catalog_snapshot
@@ -1,7 +1,6 @@
 import json
 import multiprocessing
 import pickle
-import subprocess
 from pathlib import Path
 from queue import Empty
 from typing import Dict, List, Optional
@@ -13,6 +12,8 @@ from pydantic import BaseModel, parse_file_as
 
 from ..constants import EXPERIENCE_COLORS_PATH, EXPERIENCES_PATH
 from ..experiences import BaseExperience
+from ..metrics import color_jobs
+from .catalog_snapshot import get_catalog_snapshot, input_key
 
 
 class CachedColorPalettes(BaseModel):
@@ -43,7 +44,14 @@ class ColorManager:
         if not EXPERIENCE_COLORS_PATH.exists():
             return {}
 
-        return parse_file_as(Dict[str, ColorCacheItem], EXPERIENCE_COLORS_PATH)
+        snapshot = get_catalog_snapshot()
+        key = input_key(EXPERIENCE_COLORS_PATH)
+        cache = snapshot.get(str(EXPERIENCE_COLORS_PATH), key)
+        if cache is None:
+            cache = parse_file_as(Dict[str, ColorCacheItem], EXPERIENCE_COLORS_PATH)
+            snapshot.put(str(EXPERIENCE_COLORS_PATH), key, cache)
+        # We add to the cache as colors are processed
+        return dict(cache)
 
     def _save_color_cache(self):
         with open(EXPERIENCE_COLORS_PATH, "w") as colors_file:
@@ -51,10 +59,17 @@ class ColorManager:
                 {key: value.dict() for key, value in self._cache.items()}, colors_file
             )
 
-    def load_queued_colors(self):
+    def palettes(self) -> Dict[str, CachedColorPalettes]:
+        return dict(self._colors)
+
+    def load_queued_colors(self) -> bool:
+        """
+        Pick up colors that finished processing. Returns whether there were any.
+        """
         if not self._processing_colors:
-            return
+            return False
 
+        loaded = False
         try:
             while True:
                 experience_id, hash, colors = self._colors_queue.get_nowait()
@@ -62,8 +77,10 @@ class ColorManager:
                 self._processing_colors.pop(experience_id)
                 self._cache[experience_id] = ColorCacheItem(hash=hash, colors=colors)
                 self._save_color_cache()
+                color_jobs.inc(state="completed")
+                loaded = True
         except Empty:
-            return
+            return loaded
 
     @staticmethod
     def _process_experience(experience, hash, queue):
@@ -92,33 +109,38 @@ class ColorManager:
         )
         process.start()
         self._processing_colors[experience.id] = process
+        color_jobs.inc(state="started")
 
     def load(self, experiences: List[BaseExperience]):
-        self._cache = self._read_color_cache()
+        self.load_cache()
 
         # Iterate over every experience in the experiences directory
         for experience in experiences:
-            # We can ignore unlisted experiences because they won't show up in the web
-            # interface
-            if experience.unlisted:
-                continue
-
-            # Get hash of thumb.jpg using sha256sum
-            experience_path = experience.experience_path
-            hash = (
-                subprocess.check_output(
-                    ["sha256sum", str(experience_path / "thumb.jpg")]
-                )
-                .decode("utf-8")
-                .split()[0]
-            )
+            self.add(experience)
+
+    def load_cache(self):
+        self._cache = self._read_color_cache()
+
+    def add(self, experience: BaseExperience, thumbnail_hash: Optional[str] = None):
+        """
+        Pass `thumbnail_hash` when the thumbnail has changed since `experience` was
+        loaded.
+        """
+        # We can ignore unlisted experiences because they won't show up in the web
+        # interface
+        if experience.unlisted:
+            return
+
+        hash = thumbnail_hash or experience.thumbnail_hash
+        if hash is None:
+            raise FileNotFoundError(f"No thumbnail at {experience.thumbnail_path}")
 
-            color = self._cache.get(experience.id)
+        color = self._cache.get(experience.id)
 
-            # If the color is not in the cache, get it from the experience
-            if color is None or color.hash != hash:
-                # TODO: Make this return default colors instead of nothing
-                # Queue up for processing
-                self._queue_experience_process(experience, hash)
-            else:
-                self._colors[experience.id] = color.colors
+        # If the color is not in the cache, get it from the experience
+        if color is None or color.hash != hash:
+            # TODO: Make this return default colors instead of nothing
+            # Queue up for processing
+            self._queue_experience_process(experience, hash)
+        else:
+            self._colors[experience.id] = color.colors
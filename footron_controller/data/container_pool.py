@@ -0,0 +1,286 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+import docker.errors
+from docker.models.containers import Container
+
+from ..constants import (
+    CONTAINER_POOL_GPU_MEMORY_BUDGET_MB,
+    CONTAINER_POOL_MEMORY_BUDGET_MB,
+    CONTAINER_POOL_SIZE,
+)
+from .docker_api import DockerApi, get_docker_api
+from .windows import hide_client_windows, show_windows
+
+logger = logging.getLogger(__name__)
+
+_container_pool: Optional[ContainerPool] = None
+
+_MB = 1024 * 1024
+
+_NVIDIA_SMI_COMMAND = [
+    "nvidia-smi",
+    "--query-compute-apps=pid,used_memory",
+    "--format=csv,noheader,nounits",
+]
+
+_DOCKER_ERRORS = (docker.errors.APIError, asyncio.TimeoutError)
+
+
+class _PooledContainer:
+    container: Container
+    memory: int
+    gpu_memory: int
+    # X windows we hid when pausing the container, to show again when it resumes
+    hidden_windows: List[int]
+
+    def __init__(
+        self,
+        container: Container,
+        memory: int,
+        gpu_memory: int,
+        hidden_windows: List[int],
+    ):
+        self.container = container
+        self.memory = memory
+        self.gpu_memory = gpu_memory
+        self.hidden_windows = hidden_windows
+
+
+class ContainerPool:
+    """
+    Keeps the containers of recently stopped Docker experiences paused instead of
+    killing them, so that showing the same experience again skips container creation
+    and app startup (e.g. loading models onto the GPU).
+
+    The pool is bounded by a container count and by memory and GPU memory budgets,
+    evicting least recently used containers first.
+
+    A paused GUI app can't repaint or respond to the window manager, but its windows
+    stay mapped, so we withdraw them before pausing and map them again on resume.
+    """
+
+    _docker: DockerApi
+    _size: int
+    _memory_budget: int
+    _gpu_memory_budget: int
+    # Experience ID -> container, least recently used first
+    _containers: OrderedDict[str, _PooledContainer]
+    # IDs of containers on their way out of the pool, which nobody else owns yet
+    _checking_out: Set[str]
+    _lock: asyncio.Lock
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(
+        self,
+        docker_api: DockerApi,
+        size: int = CONTAINER_POOL_SIZE,
+        memory_budget_mb: int = CONTAINER_POOL_MEMORY_BUDGET_MB,
+        gpu_memory_budget_mb: int = CONTAINER_POOL_GPU_MEMORY_BUDGET_MB,
+    ):
+        self._docker = docker_api
+        self._size = size
+        self._memory_budget = memory_budget_mb * _MB
+        self._gpu_memory_budget = gpu_memory_budget_mb * _MB
+        self._containers = OrderedDict()
+        self._checking_out = set()
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._size > 0
+
+    def __contains__(self, experience_id: str) -> bool:
+        return experience_id in self._containers
+
+    def container_ids(self) -> Set[str]:
+        return {
+            pooled.container.id for pooled in self._containers.values()
+        } | self._checking_out
+
+    async def checkout(self, experience_id: str) -> Optional[Container]:
+        """
+        Take the pooled container for an experience out of the pool and resume it.
+        Returns None if there isn't one (or it couldn't be resumed).
+        """
+        async with self._lock:
+            pooled = self._containers.pop(experience_id, None)
+
+        if not pooled:
+            self.misses += 1
+            return None
+
+        self._checking_out.add(pooled.container.id)
+        try:
+            await self._docker.unpause_container(pooled.container)
+        except _DOCKER_ERRORS:
+            logger.exception(
+                f"Couldn't resume pooled container for app ID {experience_id}"
+            )
+            self.misses += 1
+            await self._kill(pooled.container)
+            return None
+        finally:
+            self._checking_out.discard(pooled.container.id)
+
+        await asyncio.get_event_loop().run_in_executor(
+            None, show_windows, pooled.hidden_windows
+        )
+        self.hits += 1
+        return pooled.container
+
+    async def checkin(self, experience_id: str, container: Container) -> bool:
+        """
+        Pause a running container and keep it for later instead of killing it.
+        Returns False if the container wasn't taken, in which case the caller is
+        still responsible for it.
+        """
+        if not self.enabled:
+            return False
+
+        try:
+            if await self._docker.container_status(container) != "running":
+                return False
+            pids = await self._docker.container_pids(container)
+            memory = await self._container_memory(container)
+            gpu_memory = await self._container_gpu_memory(pids)
+        except (*_DOCKER_ERRORS, docker.errors.NotFound):
+            logger.exception(f"Couldn't pool container for app ID {experience_id}")
+            return False
+
+        loop = asyncio.get_event_loop()
+        hidden_windows = await loop.run_in_executor(None, hide_client_windows, pids)
+        try:
+            await self._docker.pause_container(container)
+        except (*_DOCKER_ERRORS, docker.errors.NotFound):
+            logger.exception(f"Couldn't pool container for app ID {experience_id}")
+            await loop.run_in_executor(None, show_windows, hidden_windows)
+            return False
+
+        async with self._lock:
+            replaced = self._containers.pop(experience_id, None)
+            self._containers[experience_id] = _PooledContainer(
+                container, memory, gpu_memory, hidden_windows
+            )
+            evicted = self._evict_over_budget()
+
+        if replaced:
+            evicted.append(replaced)
+        await asyncio.gather(*(self._kill(pooled.container) for pooled in evicted))
+        return True
+
+    async def discard(self, experience_id: str):
+        """
+        Kill the pooled container for an experience, if there is one, so that it's
+        recreated (e.g. from a newer image) the next time it starts.
+        """
+        async with self._lock:
+            pooled = self._containers.pop(experience_id, None)
+        if pooled:
+            self.evictions += 1
+            await self._kill(pooled.container)
+
+    async def clear(self):
+        async with self._lock:
+            evicted = list(self._containers.values())
+            self._containers.clear()
+        self.evictions += len(evicted)
+        await asyncio.gather(*(self._kill(pooled.container) for pooled in evicted))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._containers),
+            "max_size": self._size,
+            "memory": sum(pooled.memory for pooled in self._containers.values()),
+            "gpu_memory": sum(
+                pooled.gpu_memory for pooled in self._containers.values()
+            ),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    @staticmethod
+    def empty_stats() -> Dict[str, int]:
+        """
+        Stats for when there's no pool at all, e.g. because Docker isn't available.
+        """
+        return {
+            "size": 0,
+            "max_size": 0,
+            "memory": 0,
+            "gpu_memory": 0,
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def _over_budget(self) -> bool:
+        pooled = self._containers.values()
+        return (
+            len(self._containers) > self._size
+            or sum(item.memory for item in pooled) > self._memory_budget
+            or sum(item.gpu_memory for item in pooled) > self._gpu_memory_budget
+        )
+
+    def _evict_over_budget(self):
+        evicted = []
+        while self._containers and self._over_budget():
+            _, pooled = self._containers.popitem(last=False)
+            evicted.append(pooled)
+        self.evictions += len(evicted)
+        return evicted
+
+    async def _kill(self, container: Container):
+        try:
+            # Older Docker versions refuse to kill paused containers
+            if await self._docker.container_status(container) == "paused":
+                await self._docker.unpause_container(container)
+            await self._docker.kill_container(container)
+        except docker.errors.NotFound:
+            return
+        except _DOCKER_ERRORS:
+            logger.exception(f"Couldn't kill pooled container {container.short_id}")
+
+    async def _container_memory(self, container: Container) -> int:
+        stats = await self._docker.container_stats(container)
+        return stats.get("memory_stats", {}).get("usage", 0)
+
+    async def _container_gpu_memory(self, container_pids: List[int]) -> int:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *_NVIDIA_SMI_COMMAND,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            output, _ = await process.communicate()
+        except OSError:
+            # No NVIDIA driver, so nothing is using GPU memory
+            return 0
+
+        pids = set(container_pids)
+        used_memory = 0
+        for line in output.decode().splitlines():
+            pid, memory = (value.strip() for value in line.split(","))
+            if pid.isdigit() and int(pid) in pids and memory.isdigit():
+                used_memory += int(memory) * _MB
+        return used_memory
+
+
+def get_container_pool() -> Optional[ContainerPool]:
+    global _container_pool
+    if _container_pool is None:
+        docker_api = get_docker_api()
+        if docker_api:
+            _container_pool = ContainerPool(docker_api)
+
+    return _container_pool
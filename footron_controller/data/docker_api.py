@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+import docker
+import docker.errors
+from docker.models.containers import Container
+
+from ..constants import (
+    DOCKER_CREATE_TIMEOUT_S,
+    DOCKER_EXECUTOR_WORKERS,
+    DOCKER_REQUEST_TIMEOUT_S,
+)
+
+logger = logging.getLogger(__name__)
+
+_docker_api: Optional[DockerApi] = None
+_docker_api_created = False
+
+# Identifies containers launched by this controller process, as opposed to ones left
+# over from a previous run
+CONTROLLER_INSTANCE_ID = uuid.uuid4().hex
+
+T = TypeVar("T")
+
+ContainerEventCallback = Callable[[Dict[str, Any]], None]
+
+# Container events that mean a running experience is gone
+_CONTAINER_FAILURE_EVENTS = ["die", "oom"]
+# Reported as e.g. "health_status: healthy" when a container's healthcheck changes
+_CONTAINER_HEALTH_EVENT = "health_status"
+_EVENTS_RECONNECT_DELAY_S = 1
+
+
+class _Subscriber:
+    loop: asyncio.AbstractEventLoop
+    callback: ContainerEventCallback
+    events: List[str]
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        callback: ContainerEventCallback,
+        events: List[str],
+    ):
+        self.loop = loop
+        self.callback = callback
+        self.events = events
+
+
+class _ContainerEventsWatcher:
+    """
+    Follows the Docker events stream on a background thread and dispatches
+    container events to per-container subscribers on their event loops.
+    """
+
+    _client: docker.DockerClient
+    _subscribers: Dict[str, List[_Subscriber]]
+    _lock: threading.Lock
+    _thread: Optional[threading.Thread]
+
+    def __init__(self, client: docker.DockerClient):
+        self._client = client
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(
+        self, container_id: str, callback: ContainerEventCallback, events: List[str]
+    ) -> Callable[[], None]:
+        subscriber = _Subscriber(asyncio.get_event_loop(), callback, events)
+        with self._lock:
+            self._subscribers.setdefault(container_id, []).append(subscriber)
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._follow_events, name="docker-events", daemon=True
+                )
+                self._thread.start()
+
+        def unsubscribe():
+            with self._lock:
+                subscribers = self._subscribers.get(container_id, [])
+                if subscriber in subscribers:
+                    subscribers.remove(subscriber)
+                if not subscribers:
+                    self._subscribers.pop(container_id, None)
+
+        return unsubscribe
+
+    def _follow_events(self):
+        while True:
+            try:
+                for event in self._client.events(
+                    decode=True,
+                    filters={
+                        "type": "container",
+                        "event": [*_CONTAINER_FAILURE_EVENTS, _CONTAINER_HEALTH_EVENT],
+                    },
+                ):
+                    action = event.get("Action", "").split(":")[0]
+                    with self._lock:
+                        subscribers = [
+                            subscriber
+                            for subscriber in self._subscribers.get(event.get("id"), [])
+                            if action in subscriber.events
+                        ]
+                    for subscriber in subscribers:
+                        subscriber.loop.call_soon_threadsafe(subscriber.callback, event)
+            except Exception:
+                logger.exception(
+                    f"Docker events stream failed, reconnecting in {_EVENTS_RECONNECT_DELAY_S}s"
+                )
+            time.sleep(_EVENTS_RECONNECT_DELAY_S)
+
+
+class DockerApi:
+    """
+    Async adapter around the (blocking) Docker SDK.
+
+    Every call is run on a small dedicated thread pool so that a slow daemon can't
+    stall the event loop, and every call is bounded by a timeout. Note that a timed
+    out call keeps running on its worker thread until the daemon answers; we just stop
+    waiting for it.
+    """
+
+    _client: docker.DockerClient
+    _executor: ThreadPoolExecutor
+    _timeout: float
+    _events: _ContainerEventsWatcher
+
+    def __init__(
+        self,
+        client: docker.DockerClient,
+        max_workers: int = DOCKER_EXECUTOR_WORKERS,
+        timeout: float = DOCKER_REQUEST_TIMEOUT_S,
+    ):
+        self._client = client
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="docker-api"
+        )
+        self._timeout = timeout
+        self._events = _ContainerEventsWatcher(client)
+
+    @property
+    def client(self) -> docker.DockerClient:
+        return self._client
+
+    async def _call(
+        self,
+        fn: Callable[..., T],
+        *args,
+        timeout: Optional[float],
+        **kwargs,
+    ) -> T:
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+        return await asyncio.wait_for(future, timeout)
+
+    async def create_container(self, image_id: str, **kwargs: Any) -> Container:
+        future = asyncio.get_event_loop().run_in_executor(
+            self._executor,
+            functools.partial(self._client.containers.create, image_id, **kwargs),
+        )
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future), DOCKER_CREATE_TIMEOUT_S
+            )
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            # The create carries on in the executor regardless, and nobody would ever
+            # own the container it makes
+            future.add_done_callback(self._remove_orphaned_container)
+            raise
+
+    def _remove_orphaned_container(self, future: asyncio.Future):
+        if future.cancelled() or future.exception():
+            return
+        container = future.result()
+        logger.info(f"Removing container {container.short_id} created after timeout")
+        asyncio.get_event_loop().create_task(self._remove_orphan(container))
+
+    async def _remove_orphan(self, container: Container):
+        try:
+            await self.remove_container(container)
+        except docker.errors.NotFound:
+            return
+        except (docker.errors.APIError, asyncio.TimeoutError):
+            # The rogue container sweep will get it
+            logger.exception(f"Couldn't remove container {container.short_id}")
+
+    async def start_container(self, container: Container):
+        await self._call(container.start, timeout=self._timeout)
+
+    async def list_containers(
+        self, filters: Dict[str, Any], all: bool = False
+    ) -> List[Container]:
+        """
+        Containers matching `filters`. Like `docker ps`, only running and paused
+        containers are listed unless `all` is set.
+        """
+        return await self._call(
+            self._client.containers.list,
+            all=all,
+            filters=filters,
+            timeout=self._timeout,
+        )
+
+    async def container_status(self, container: Container) -> str:
+        await self._call(container.reload, timeout=self._timeout)
+        return container.status
+
+    async def kill_container(self, container: Container):
+        await self._call(container.kill, timeout=self._timeout)
+
+    async def remove_container(self, container: Container):
+        await self._call(container.remove, force=True, timeout=self._timeout)
+
+    async def pause_container(self, container: Container):
+        await self._call(container.pause, timeout=self._timeout)
+
+    async def unpause_container(self, container: Container):
+        await self._call(container.unpause, timeout=self._timeout)
+
+    async def container_stats(self, container: Container) -> Dict[str, Any]:
+        # one_shot skips the second sample Docker would otherwise wait ~1s for
+        return await self._call(
+            container.stats, stream=False, one_shot=True, timeout=self._timeout
+        )
+
+    async def container_health(self, container: Container) -> Optional[str]:
+        """
+        The status of the container's healthcheck, or None if it doesn't have one.
+        """
+        await self._call(container.reload, timeout=self._timeout)
+        return container.attrs.get("State", {}).get("Health", {}).get("Status")
+
+    async def container_pids(self, container: Container) -> List[int]:
+        top = await self._call(container.top, timeout=self._timeout)
+        pid_index = top["Titles"].index("PID")
+        return [int(process[pid_index]) for process in top["Processes"]]
+
+    def watch_container(
+        self, container_id: str, callback: ContainerEventCallback
+    ) -> Callable[[], None]:
+        """
+        Call `callback` on the current event loop when the container dies or runs out
+        of memory. Returns a function that cancels the subscription.
+        """
+        return self._events.subscribe(container_id, callback, _CONTAINER_FAILURE_EVENTS)
+
+    def watch_container_health(
+        self, container_id: str, callback: ContainerEventCallback
+    ) -> Callable[[], None]:
+        """
+        Call `callback` on the current event loop when the status of the container's
+        healthcheck changes. Returns a function that cancels the subscription.
+        """
+        return self._events.subscribe(container_id, callback, [_CONTAINER_HEALTH_EVENT])
+
+
+def get_docker_api() -> Optional[DockerApi]:
+    global _docker_api, _docker_api_created
+    if not _docker_api_created:
+        _docker_api_created = True
+        try:
+            _docker_api = DockerApi(docker.from_env())
+        except docker.errors.DockerException:
+            logger.warning(
+                "Couldn't create Docker client, Docker experiences will be disabled"
+            )
+
+    return _docker_api
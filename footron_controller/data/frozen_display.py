@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from ..constants import FROZEN_DISPLAY_TOLERANCE
+
+# While the picture keeps changing, we sample at least this many times per timeout
+_SAMPLES_PER_TIMEOUT = 4
+
+
+def frame_signature(thumbnail: Image) -> np.ndarray:
+    # Signed, so that differences between signatures can't wrap around
+    return np.asarray(thumbnail, dtype=np.int16)
+
+
+class FrozenDisplayDetector:
+    """
+    Decides whether a running experience's picture has frozen, from a series of
+    tiled viewport thumbnails (see ScreenshotWorker.thumbnail and
+    FROZEN_DISPLAY_TILE_SIZE for how small a change we can see).
+
+    The picture is frozen once every sample has looked the same as the last one for
+    `timeout` seconds, not counting time before the last interaction: an experience
+    that's waiting on the person using it can hold still for as long as it likes.
+
+    Sampling adapts to what's on screen. It starts at `base_interval` and stays there
+    while the picture looks the same, so that a freeze is confirmed promptly. While
+    the picture keeps changing, the interval doubles up to a fraction of the timeout,
+    so that a healthy experience costs us very few captures.
+    """
+
+    timeout: timedelta
+    interval: float
+    _base_interval: float
+    _max_interval: float
+    _last_signature: Optional[np.ndarray]
+    # When the picture last changed (or we started watching)
+    _unchanged_since: Optional[datetime]
+
+    def __init__(self, timeout: float, base_interval: float):
+        self.timeout = timedelta(seconds=timeout)
+        self._base_interval = base_interval
+        self._max_interval = max(base_interval, timeout / _SAMPLES_PER_TIMEOUT)
+        self.interval = base_interval
+        self._last_signature = None
+        self._unchanged_since = None
+
+    def _changed(self, signature: np.ndarray) -> bool:
+        if self._last_signature is None:
+            return True
+        if self._last_signature.shape != signature.shape:
+            return True
+        difference = np.abs(signature - self._last_signature).max()
+        return difference > FROZEN_DISPLAY_TOLERANCE
+
+    def observe(
+        self,
+        thumbnail: Image,
+        now: datetime,
+        last_interaction: Optional[datetime] = None,
+    ) -> bool:
+        """
+        Records a sample, returning whether the picture is now considered frozen.
+        """
+        signature = frame_signature(thumbnail)
+        if self._changed(signature):
+            if self._last_signature is not None:
+                self.interval = min(self.interval * 2, self._max_interval)
+            self._last_signature = signature
+            self._unchanged_since = now
+            return False
+
+        self.interval = self._base_interval
+        unchanged_since = self._unchanged_since
+        if last_interaction is not None and last_interaction > unchanged_since:
+            unchanged_since = last_interaction
+        return now - unchanged_since >= self.timeout
+
+    def reset(self):
+        """
+        Forget the picture so far, e.g. when there was no viewport to sample.
+        """
+        self._last_signature = None
+        self._unchanged_since = None
+        self.interval = self._base_interval
+
+    def back_off(self):
+        """
+        Like reset, but sample again as rarely as we would a healthy picture, e.g.
+        when sampling timed out.
+        """
+        self.reset()
+        self.interval = self._max_interval
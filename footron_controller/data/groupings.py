@@ -4,6 +4,7 @@ import tomli
 from pydantic import BaseModel
 
 from ..constants import BASE_DATA_PATH
+from .catalog_snapshot import get_catalog_snapshot, input_key
 
 
 class Collection(BaseModel):
@@ -33,7 +34,15 @@ def load_experience_grouping(type: Type, file_name: str, path=BASE_DATA_PATH):
     if not file_path.exists():
         return {}
 
+    snapshot = get_catalog_snapshot()
+    key = input_key(file_path)
+    cached = snapshot.get(str(file_path), key)
+    if cached is not None:
+        return cached
+
     with open(file_path, "rb") as file:
         data = tomli.load(file)
 
-    return {id: type(id=id, **value) for id, value in data.items()}
+    grouping = {id: type(id=id, **value) for id, value in data.items()}
+    snapshot.put(str(file_path), key, grouping)
+    return grouping
@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import itertools
+import logging
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import docker.errors
+import docker.utils
+from pydantic import BaseModel
+
+from ..constants import (
+    IMAGE_MIN_FREE_DISK_GB,
+    IMAGE_PULL_CONCURRENCY,
+    IMAGE_PULL_RETRY_INTERVAL_S,
+    IMAGE_PULL_RETRY_MAX_INTERVAL_S,
+)
+from .docker_api import DockerApi, get_docker_api
+
+logger = logging.getLogger(__name__)
+
+_image_manager: Optional[ImageManager] = None
+
+_GB = 1024 * 1024 * 1024
+
+ImageListener = Callable[[str], None]
+
+
+def _repository(reference: str) -> str:
+    return docker.utils.parse_repository_tag(reference)[0]
+
+
+class PullPriority(enum.IntEnum):
+    """
+    Lower values are pulled first.
+    """
+
+    # Coming up next in the rotation
+    NEXT = 0
+    # Queueable, so it will come up in the rotation eventually
+    ROTATION = 1
+    CATALOG = 2
+    # Newer version of an image we already have
+    REFRESH = 3
+
+
+class ImageState(str, enum.Enum):
+    UNKNOWN = "unknown"
+    QUEUED = "queued"
+    PULLING = "pulling"
+    PRESENT = "present"
+    NOT_FOUND = "not_found"
+    FAILED = "failed"
+
+
+class ImageStatus(BaseModel):
+    image_id: str
+    state: ImageState = ImageState.UNKNOWN
+    # Whether some version of the image is available locally, which stays true while
+    # a newer version is being pulled
+    present: bool = False
+    priority: Optional[PullPriority] = None
+    # Summed over all layers that have reported progress so far
+    current_bytes: int = 0
+    total_bytes: int = 0
+    error: Optional[str] = None
+    # Consecutive failed pulls of an image we don't have
+    failures: int = 0
+    retry_at: Optional[datetime] = None
+    last_checked: Optional[datetime] = None
+
+
+class ImageManager:
+    """
+    Pulls Docker images in the background so that a missing or outdated image never
+    blocks the controller. Pulls are queued by priority and run a bounded number at a
+    time, and listeners hear about every image that finishes pulling so that the
+    experiences using it can be made available.
+
+    Refreshing an image only pulls the new version; running and pooled containers
+    keep using the version they were created from, and a failed refresh leaves the
+    image as it was. Failed pulls of images we don't have are retried with backoff.
+    """
+
+    _docker: DockerApi
+    _executor: ThreadPoolExecutor
+    _concurrency: int
+    _statuses: Dict[str, ImageStatus]
+    # Image IDs the catalog uses, which disk space eviction won't touch. Eviction only
+    # considers other images from their repositories.
+    _tracked: Set[str]
+    _queue: Optional[asyncio.PriorityQueue]
+    _queue_order: itertools.count
+    _workers: List[asyncio.Task]
+    _retries: Dict[str, asyncio.TimerHandle]
+    _listeners: List[ImageListener]
+    _eviction_lock: asyncio.Lock
+
+    def __init__(
+        self,
+        docker_api: DockerApi,
+        concurrency: int = IMAGE_PULL_CONCURRENCY,
+        min_free_disk_gb: float = IMAGE_MIN_FREE_DISK_GB,
+    ):
+        self._docker = docker_api
+        # Pulls and registry checks are slow enough that they get their own threads
+        # instead of tying up DockerApi's
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency + 1, thread_name_prefix="docker-images"
+        )
+        self._concurrency = concurrency
+        self._min_free_disk = min_free_disk_gb * _GB
+        self._statuses = {}
+        self._tracked = set()
+        self._queue = None
+        self._queue_order = itertools.count()
+        self._workers = []
+        self._retries = {}
+        self._listeners = []
+        self._eviction_lock = asyncio.Lock()
+
+    def add_listener(self, listener: ImageListener):
+        self._listeners.append(listener)
+
+    def statuses(self) -> Dict[str, ImageStatus]:
+        return self._statuses
+
+    def _status(self, image_id: str) -> ImageStatus:
+        if image_id not in self._statuses:
+            self._statuses[image_id] = ImageStatus(image_id=image_id)
+        return self._statuses[image_id]
+
+    def present(self, image_id: str) -> bool:
+        """
+        Whether the image is available locally. Blocks on the Docker daemon the first
+        time an image is checked, so call it off the event loop.
+        """
+        self._tracked.add(image_id)
+        status = self._status(image_id)
+        if status.state == ImageState.UNKNOWN:
+            try:
+                self._docker.client.images.get(image_id)
+                status.state = ImageState.PRESENT
+                status.present = True
+            except docker.errors.ImageNotFound:
+                # Stays unknown until someone asks for it to be pulled
+                return False
+        return status.present
+
+    def pull(self, image_id: str, priority: PullPriority = PullPriority.CATALOG):
+        """
+        Queue a pull of the image, or move an already queued pull up to `priority`.
+        """
+        self._tracked.add(image_id)
+        status = self._status(image_id)
+        if status.state == ImageState.PULLING:
+            return
+        if status.state == ImageState.QUEUED and status.priority <= priority:
+            return
+
+        if retry := self._retries.pop(image_id, None):
+            retry.cancel()
+            status.retry_at = None
+        status.state = ImageState.QUEUED
+        status.priority = priority
+        status.error = None
+        self._ensure_workers()
+        # An entry queued earlier at a lower priority is skipped once this one is done
+        self._queue.put_nowait((priority, next(self._queue_order), image_id))
+
+    def prioritize(self, image_id: str, priority: PullPriority = PullPriority.NEXT):
+        """
+        Move a queued pull up, if there is one.
+        """
+        if self._status(image_id).state == ImageState.QUEUED:
+            self.pull(image_id, priority)
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if self._workers:
+            return
+        loop = asyncio.get_event_loop()
+        self._workers = [
+            loop.create_task(self._pull_worker()) for _ in range(self._concurrency)
+        ]
+
+    async def _pull_worker(self):
+        while True:
+            priority, _, image_id = await self._queue.get()
+            status = self._status(image_id)
+            if status.state != ImageState.QUEUED or status.priority != priority:
+                continue
+            try:
+                await self._pull(image_id, status)
+            except Exception as e:
+                logger.exception(f"Error while pulling Docker image '{image_id}'")
+                self._pull_failed(image_id, status, ImageState.FAILED, str(e))
+
+    def _pull_failed(
+        self, image_id: str, status: ImageStatus, state: ImageState, error: str
+    ):
+        status.error = error
+        if status.present:
+            # The version we have still works, and the next refresh tries again
+            status.state = ImageState.PRESENT
+            return
+
+        status.state = state
+        delay = min(
+            IMAGE_PULL_RETRY_INTERVAL_S * 2**status.failures,
+            IMAGE_PULL_RETRY_MAX_INTERVAL_S,
+        )
+        status.failures += 1
+        status.retry_at = datetime.now() + timedelta(seconds=delay)
+        self._retries[image_id] = asyncio.get_event_loop().call_later(
+            delay, self._retry, image_id
+        )
+
+    def _retry(self, image_id: str):
+        self._retries.pop(image_id, None)
+        status = self._status(image_id)
+        status.retry_at = None
+        if status.state in [ImageState.FAILED, ImageState.NOT_FOUND]:
+            self.pull(image_id, status.priority)
+
+    async def _pull(self, image_id: str, status: ImageStatus):
+        if not await self._ensure_disk_space():
+            logger.error(f"Not enough disk space to pull Docker image '{image_id}'")
+            self._pull_failed(
+                image_id, status, ImageState.FAILED, "not enough disk space"
+            )
+            return
+
+        logger.info(f"Pulling Docker image '{image_id}'...")
+        status.state = ImageState.PULLING
+        status.current_bytes = 0
+        status.total_bytes = 0
+        loop = asyncio.get_event_loop()
+        layers: Dict[str, Tuple[int, int]] = {}
+
+        def on_progress(layer: str, current: int, total: int):
+            layers[layer] = (current, total)
+            status.current_bytes = sum(current for current, _ in layers.values())
+            status.total_bytes = sum(total for _, total in layers.values())
+
+        try:
+            await loop.run_in_executor(
+                self._executor,
+                self._pull_blocking,
+                image_id,
+                lambda *progress: loop.call_soon_threadsafe(on_progress, *progress),
+            )
+        except docker.errors.NotFound:
+            logger.warning(f"Couldn't find Docker image '{image_id}' in its registry")
+            self._pull_failed(image_id, status, ImageState.NOT_FOUND, "not found")
+            return
+        except docker.errors.APIError as e:
+            logger.error(f"Couldn't pull Docker image '{image_id}': {e}")
+            self._pull_failed(image_id, status, ImageState.FAILED, str(e))
+            return
+
+        logger.info(f"Pulled Docker image '{image_id}'")
+        status.state = ImageState.PRESENT
+        status.present = True
+        status.failures = 0
+        status.current_bytes = status.total_bytes
+        status.last_checked = datetime.now()
+        for listener in list(self._listeners):
+            listener(image_id)
+
+    def _pull_blocking(
+        self, image_id: str, on_progress: Callable[[str, int, int], None]
+    ):
+        repository, tag = docker.utils.parse_repository_tag(image_id)
+        for event in self._docker.client.api.pull(
+            repository, tag=tag or "latest", stream=True, decode=True
+        ):
+            if "error" in event:
+                raise docker.errors.APIError(event["error"])
+            detail = event.get("progressDetail") or {}
+            if "id" in event and detail.get("total"):
+                on_progress(event["id"], detail.get("current", 0), detail["total"])
+
+    def _outdated_blocking(self, image_id: str) -> bool:
+        client = self._docker.client
+        registry_digest = client.images.get_registry_data(image_id).id
+        local_digests = client.images.get(image_id).attrs.get("RepoDigests", [])
+        return not any(
+            digest.endswith(f"@{registry_digest}") for digest in local_digests
+        )
+
+    async def refresh(self, image_ids: Iterable[str]):
+        """
+        Check the registry for newer versions of the images we have, and queue pulls
+        for the ones that are out of date.
+        """
+        loop = asyncio.get_event_loop()
+        for image_id in image_ids:
+            status = self._status(image_id)
+            if status.state != ImageState.PRESENT:
+                continue
+            try:
+                outdated = await loop.run_in_executor(
+                    self._executor, self._outdated_blocking, image_id
+                )
+            except docker.errors.APIError as e:
+                # Images that were only ever built locally have no registry to check
+                logger.debug(f"Couldn't check '{image_id}' for updates: {e}")
+                continue
+            status.last_checked = datetime.now()
+            if outdated:
+                logger.info(f"Docker image '{image_id}' is out of date, refreshing")
+                self.pull(image_id, PullPriority.REFRESH)
+
+    def _free_disk_space(self) -> int:
+        root_dir = self._docker.client.info().get("DockerRootDir", "/var/lib/docker")
+        return shutil.disk_usage(root_dir).free
+
+    def _evict_blocking(self) -> bool:
+        """
+        Remove images from the repositories our experiences use that no container and
+        no experience uses, e.g. versions replaced by a refresh, oldest first, until
+        there's enough disk space again. Anything else on the host isn't ours to
+        remove.
+        """
+        client = self._docker.client
+        repositories = {_repository(image_id) for image_id in self._tracked}
+        in_use = {
+            container.attrs.get("Image")
+            for container in client.containers.list(all=True)
+        }
+        for image_id in self._tracked:
+            try:
+                in_use.add(client.images.get(image_id).id)
+            except docker.errors.ImageNotFound:
+                continue
+
+        unused = sorted(
+            (
+                image
+                for image in client.images.list()
+                if image.id not in in_use
+                and any(
+                    _repository(reference) in repositories
+                    # Either can be null, e.g. for an image whose tag moved on
+                    for reference in (image.attrs.get("RepoTags") or [])
+                    + (image.attrs.get("RepoDigests") or [])
+                )
+            ),
+            key=lambda image: image.attrs.get("Created", ""),
+        )
+        for image in unused:
+            if self._free_disk_space() >= self._min_free_disk:
+                break
+            logger.warning(f"Low on disk space, removing unused image {image.short_id}")
+            try:
+                client.images.remove(image.id, force=False)
+            except docker.errors.APIError:
+                # Probably became used in the meantime
+                logger.exception(f"Couldn't remove image {image.short_id}")
+        return self._free_disk_space() >= self._min_free_disk
+
+    async def _ensure_disk_space(self) -> bool:
+        if not self._min_free_disk:
+            return True
+
+        loop = asyncio.get_event_loop()
+        async with self._eviction_lock:
+            if (
+                await loop.run_in_executor(self._executor, self._free_disk_space)
+                >= self._min_free_disk
+            ):
+                return True
+            return await loop.run_in_executor(self._executor, self._evict_blocking)
+
+
+def get_image_manager() -> Optional[ImageManager]:
+    global _image_manager
+    if _image_manager is None:
+        docker_api = get_docker_api()
+        if docker_api:
+            _image_manager = ImageManager(docker_api)
+
+    return _image_manager
@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, ValidationError
+
+from ..constants import EXPERIENCE_LOAD_TIMES_PATH
+
+logger = logging.getLogger(__name__)
+
+_load_time_manager: Optional[LoadTimeManager] = None
+
+# Only recent starts count, so that estimates follow experiences as they're updated
+_HISTORY_SIZE = 20
+_MIN_SAMPLES = 3
+_PERCENTILE = 95
+
+
+class LoadTimeHistory(BaseModel):
+    samples: List[float] = []
+
+
+class LoadTimeManager:
+    """
+    Learns how long each experience takes to be ready after we start it, from a short
+    history of recent starts kept on disk. Estimates are the p95 of that history and
+    take over from the load_time in an experience's config once there are enough
+    samples.
+
+    Histories are read from disk all at once by load(), so that looking them up never
+    blocks the event loop.
+    """
+
+    _path: Path
+    _histories: Dict[str, LoadTimeHistory]
+    _loaded: bool
+
+    def __init__(self, path: Path = EXPERIENCE_LOAD_TIMES_PATH):
+        self._path = path
+        self._histories = {}
+        self._loaded = False
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def _history_path(self, experience_id: str) -> Path:
+        return self._path / f"{experience_id}.json"
+
+    def load(self):
+        """
+        Read every experience's history from disk. Blocks, so call it off the event
+        loop.
+        """
+        histories = {}
+        paths = self._path.glob("*.json") if self._path.exists() else []
+        for path in paths:
+            try:
+                histories[path.stem] = LoadTimeHistory.parse_file(path)
+            except (OSError, ValueError, ValidationError):
+                logger.warning(f"Couldn't read load times for app ID {path.stem}")
+        # Anything recorded in the meantime is newer than what was on disk
+        self._histories = {**histories, **self._histories}
+        self._loaded = True
+
+    def _history(self, experience_id: str) -> LoadTimeHistory:
+        # Not stored until there's a sample, so that load() can't be shadowed by
+        # lookups made before it finished
+        return self._histories.get(experience_id, LoadTimeHistory())
+
+    def _save(self, experience_id: str, history: LoadTimeHistory):
+        path = self._history_path(experience_id)
+        temp_path = path.with_suffix(".tmp")
+        try:
+            self._path.mkdir(parents=True, exist_ok=True)
+            temp_path.write_text(history.json())
+            temp_path.replace(path)
+        except OSError:
+            logger.exception(f"Couldn't save load times for app ID {experience_id}")
+
+    async def record(self, experience_id: str, seconds: float):
+        """
+        Adds a start that the experience itself reported as ready after `seconds`.
+        """
+        history = self._history(experience_id)
+        history.samples = [*history.samples, round(seconds, 3)][-_HISTORY_SIZE:]
+        self._histories[experience_id] = history
+        await asyncio.get_event_loop().run_in_executor(
+            None, self._save, experience_id, history
+        )
+
+    def samples(self, experience_id: str) -> int:
+        return len(self._history(experience_id).samples)
+
+    def estimate(self, experience_id: str) -> Optional[float]:
+        """
+        The p95 time to ready, or None if we haven't seen enough starts yet.
+        """
+        samples = sorted(self._history(experience_id).samples)
+        if len(samples) < _MIN_SAMPLES:
+            return None
+        # Nearest-rank percentile
+        return samples[math.ceil(_PERCENTILE / 100 * len(samples)) - 1]
+
+    def load_time(
+        self, experience_id: str, configured: Optional[float]
+    ) -> Optional[float]:
+        """
+        How long to expect the experience to take, preferring what we've learned over
+        the configured load_time.
+        """
+        estimate = self.estimate(experience_id)
+        return estimate if estimate is not None else configured
+
+
+def get_load_time_manager() -> LoadTimeManager:
+    global _load_time_manager
+    if _load_time_manager is None:
+        _load_time_manager = LoadTimeManager()
+
+    return _load_time_manager
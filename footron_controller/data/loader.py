@@ -12,6 +12,8 @@ if TYPE_CHECKING:
     from .wm import WmApi
 
 LOADER_PATH = BASE_BIN_PATH / "footron-loader"
+# Electron sets WM_CLASS from the app name
+LOADER_WINDOW_CLASS = "footron-loader"
 
 
 logger = logging.getLogger(__name__)
@@ -27,16 +29,22 @@ class LoaderManager:
         self._process_operation_lock = asyncio.Lock()
         self._wm = wm
 
-    async def stop_after_timeout(self, timeout: int):
-        await asyncio.sleep(timeout)
-        await self.stop()
-
-    async def start(self):
+    async def start(self) -> bool:
+        """
+        Show the loader, returning False if it was already showing.
+        """
         if not LOADER_PATH:
             logger.warning(f"Loader binary couldn't be found at {LOADER_PATH}")
-            return
+            return False
         async with self._process_operation_lock:
+            if self._loader_process and self._loader_process.poll() is None:
+                return False
             self._loader_process = subprocess.Popen([LOADER_PATH])
+            return True
+
+    @property
+    def running(self) -> bool:
+        return self._loader_process is not None
 
     async def stop(self):
         async with self._process_operation_lock:
@@ -1,25 +1,110 @@
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Optional
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
 
 import Xlib
 import Xlib.display
+import Xlib.error
 from PIL import Image
 from Xlib.xobject.drawable import Window
 
+from ..constants import (
+    SCREENSHOT_COALESCE_WINDOW_S,
+    SCREENSHOT_MAX_PENDING,
+    SCREENSHOT_MAX_STREAMS,
+    SCREENSHOT_TIMEOUT_S,
+    SCREENSHOT_USE_SHM,
+    VIEWPORT_WINDOW_NAME,
+)
+from ..util import encode_image, scale_image
+from .windows import WindowIndex, get_window_index
+from .xshm import ShmCapture, ShmCaptureError, ShmUnavailable
+
+logger = logging.getLogger(__name__)
+
 SCREENSHOT_MIME_TYPES = {
     "jpeg": "image/jpeg",
     "png": "image/png",
 }
 
+SCREENSHOT_TARGETS = ["display", "viewport"]
+
+# (x, y, width, height), relative to the capture target
+Region = Tuple[int, int, int, int]
+
+# (target, region, width, height, quality, format)
+ScreenshotKey = Tuple[
+    str, Optional[Region], Optional[int], Optional[int], Optional[int], str
+]
+
+# (target, width, height, quality, fps)
+StreamKey = Tuple[str, Optional[int], Optional[int], int, float]
+
+
+class ScreenshotTargetMissing(Exception):
+    pass
+
+
+class ScreenshotQueueFull(Exception):
+    pass
+
+
+class ScreenshotUnavailable(Exception):
+    """
+    There's no X server to capture from.
+    """
+
 
 class ScreenshotCapture:
-    def __init__(self):
-        self._display = Xlib.display.Display()
+    """
+    Blocking screen captures over our own X connection. Xlib connections aren't
+    thread-safe, so an instance must only ever be used from one thread.
+
+    Pixels are read through X shared memory (see ShmCapture) where possible, and
+    over the X connection otherwise.
+    """
+
+    _display: Optional[Xlib.display.Display]
+    _shm: Optional[ShmCapture]
+    _windows: WindowIndex
+
+    def __init__(self, use_shm: bool = SCREENSHOT_USE_SHM):
+        # We connect on first use so that the controller can start up without an X
+        # server, e.g. when benchmarking
+        self._display = None
+        self._shm = None
+        self._use_shm = use_shm
+        self._windows = get_window_index()
+
+    def _connect(self):
+        if self._display:
+            return
+        try:
+            self._display = Xlib.display.Display()
+        except (Xlib.error.DisplayError, OSError) as e:
+            raise ScreenshotUnavailable(f"Couldn't connect to X server: {e}")
         self._root: Window = self._display.screen().root
         self._net_wm_name_atom = self._display.intern_atom("_NET_WM_NAME")
+        if self._use_shm:
+            try:
+                self._shm = ShmCapture(self._display.get_display_name())
+            except ShmUnavailable as e:
+                logger.info(f"Not capturing through shared memory: {e}")
 
     def _window_by_name(self, name: str) -> Optional[Window]:
+        self._connect()
+        if self._windows.ready:
+            indexed = self._windows.find_by_name(name)
+            if indexed is None:
+                return None
+            # Window IDs are global to the X server, so we can use the index's windows
+            # on our own connection
+            return self._display.create_resource_object("window", indexed.id)
+
+        # Without the index we have to ask about every top-level window
         children = self._root.query_tree().children
         for child in children:
             # Note here that we only search through windows which implement the newer
@@ -32,15 +117,342 @@ class ScreenshotCapture:
             if decoded_name == name:
                 return child
 
-    @staticmethod
-    def _capture_window(window: Window) -> Image:
+    def _capture_window(self, window: Window, region: Optional[Region]) -> Image:
         geometry = window.get_geometry()
-        width, height = geometry.width, geometry.height
-        raw_image = window.get_image(0, 0, width, height, Xlib.X.ZPixmap, 0xFFFFFFFF)
+        x, y, width, height = 0, 0, geometry.width, geometry.height
+        if region is not None:
+            # Clipped to the window, X won't capture outside of it
+            region_x, region_y, region_width, region_height = region
+            x, y = max(region_x, 0), max(region_y, 0)
+            width = min(region_x + region_width, geometry.width) - x
+            height = min(region_y + region_height, geometry.height) - y
+            if width <= 0 or height <= 0:
+                raise ScreenshotTargetMissing("Region is outside of the target")
+
+        if self._shm:
+            try:
+                return self._shm.capture(window.id, x, y, width, height)
+            except ShmCaptureError:
+                logger.exception("Shared memory capture failed, falling back")
+
+        raw_image = window.get_image(x, y, width, height, Xlib.X.ZPixmap, 0xFFFFFFFF)
         return Image.frombytes("RGB", (width, height), raw_image.data, "raw", "BGRX")
 
-    def capture_root(self):
-        return self._capture_window(self._root)
+    def capture_root(self, region: Optional[Region] = None):
+        self._connect()
+        return self._capture_window(self._root, region)
+
+    def capture_viewport(self, region: Optional[Region] = None):
+        window = self._window_by_name(VIEWPORT_WINDOW_NAME)
+        if window is None:
+            raise ScreenshotTargetMissing("Viewport window doesn't exist")
+        try:
+            return self._capture_window(window, region)
+        except (Xlib.error.BadWindow, Xlib.error.BadDrawable, Xlib.error.BadMatch):
+            # Destroyed or unmapped since we looked it up
+            raise ScreenshotTargetMissing("Viewport window isn't showing")
+
+    def capture(self, target: str, region: Optional[Region] = None) -> Image:
+        if target == "display":
+            return self.capture_root(region)
+        if target == "viewport":
+            return self.capture_viewport(region)
+        raise ValueError(f"Unknown screenshot target '{target}'")
+
+
+class ScreenshotViewer:
+    """
+    One viewer of a screenshot stream. Slow viewers skip frames: only the latest
+    frame is kept for them.
+    """
+
+    _stream: _ScreenshotStream
+    _frames: asyncio.Queue
+
+    def __init__(self, stream: _ScreenshotStream):
+        self._stream = stream
+        self._frames = asyncio.Queue(maxsize=1)
+        stream.viewers.add(self)
+        if stream.last_frame is not None:
+            self.send(stream.last_frame)
+
+    def send(self, frame: bytes):
+        if self._frames.full():
+            self._frames.get_nowait()
+        self._frames.put_nowait(frame)
+
+    async def frames(self) -> AsyncIterator[bytes]:
+        """
+        Encoded frames as they change, until the viewer is closed (which also happens
+        when iteration is stopped).
+        """
+        try:
+            while True:
+                yield await self._frames.get()
+        finally:
+            self.close()
+
+    def close(self):
+        self._stream.viewers.discard(self)
+
+
+class _ScreenshotStream:
+    viewers: Set[ScreenshotViewer]
+    last_frame: Optional[bytes]
+    # The last frame's pixels at the stream's size, to tell whether it changed
+    last_pixels: Optional[bytes]
+    # Event loop time
+    next_frame_at: float
+
+    def __init__(self):
+        self.viewers = set()
+        self.last_frame = None
+        self.last_pixels = None
+        self.next_frame_at = 0
+
+
+class ScreenshotWorker:
+    """
+    Captures and encodes screenshots on a dedicated thread, which owns the X
+    connection, so that capturing the whole wall never stalls the event loop.
+
+    Requests for the same screenshot (target, region, size and format) share one
+    capture while it's in progress and for a short window after it finishes. At most
+    `max_pending` different screenshots are queued at once, past that we refuse more
+    instead of letting the backlog grow. Like DockerApi, a timed out capture keeps
+    running on the worker thread until it finishes; we just stop waiting for it.
+
+    Streams capture frames on the same thread, in one loop per target: each tick
+    captures the target once and scales it down for every stream configuration that
+    has a frame due, and all viewers of a configuration share its frames. A loop only
+    runs while its target has streams with viewers, and frames that look the same as
+    the last one at the stream's size aren't encoded or sent again. Streams never
+    keep the thread busy more than half of the time, so that screenshots and
+    thumbnails queued behind them still get their turn.
+    """
+
+    _capture: ScreenshotCapture
+    _executor: ThreadPoolExecutor
+    _max_pending: int
+    _timeout: float
+    _coalesce_window: float
+    # Captures in progress, or finished within the coalescing window
+    _results: Dict[ScreenshotKey, asyncio.Future]
+    _pending: int
+    _max_streams: int
+    _streams: Dict[StreamKey, _ScreenshotStream]
+    # Target -> the loop capturing frames for its streams
+    _stream_tasks: Dict[str, asyncio.Task]
+
+    def __init__(
+        self,
+        max_pending: int = SCREENSHOT_MAX_PENDING,
+        max_streams: int = SCREENSHOT_MAX_STREAMS,
+        timeout: float = SCREENSHOT_TIMEOUT_S,
+        coalesce_window: float = SCREENSHOT_COALESCE_WINDOW_S,
+    ):
+        self._capture = ScreenshotCapture()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="screenshot"
+        )
+        self._max_pending = max_pending
+        self._timeout = timeout
+        self._coalesce_window = coalesce_window
+        self._results = {}
+        self._pending = 0
+        self._max_streams = max_streams
+        self._streams = {}
+        self._stream_tasks = {}
+
+    def _screenshot_blocking(self, key: ScreenshotKey) -> bytes:
+        target, region, width, height, quality, format = key
+        return encode_image(
+            self._capture.capture(target, region),
+            width=width,
+            height=height,
+            quality=quality if quality is not None else 95,
+            format=format,
+        )
+
+    def _finished(self, key: ScreenshotKey, future: asyncio.Future):
+        self._pending -= 1
+        # Nobody might be waiting anymore if every request timed out, in which case
+        # this keeps asyncio from logging the exception as never retrieved
+        if future.cancelled() or future.exception() is not None:
+            self._expire(key, future)
+            return
+        asyncio.get_event_loop().call_later(
+            self._coalesce_window, self._expire, key, future
+        )
+
+    def _expire(self, key: ScreenshotKey, future: asyncio.Future):
+        if self._results.get(key) is future:
+            del self._results[key]
+
+    async def screenshot(
+        self,
+        target: str,
+        region: Optional[Region] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        quality: int = 95,
+        format: str = "jpeg",
+    ) -> bytes:
+        """
+        An encoded screenshot of `target`, cropped to `region` and scaled down to fit
+        within `width` and `height` if given.
+
+        :raises ScreenshotQueueFull: if too many other screenshots are queued
+        :raises ScreenshotTargetMissing: if there's nothing to capture for `target`
+        :raises ScreenshotUnavailable: if there's no X server to capture from
+        :raises asyncio.TimeoutError: if the screenshot took too long
+        """
+        # Quality only means something for JPEGs, so other formats can share captures
+        # regardless of it
+        key = (
+            target,
+            region,
+            width,
+            height,
+            quality if format == "jpeg" else None,
+            format,
+        )
+        future = self._results.get(key)
+        if future is None:
+            if self._pending >= self._max_pending:
+                raise ScreenshotQueueFull()
+            future = asyncio.get_event_loop().run_in_executor(
+                self._executor, self._screenshot_blocking, key
+            )
+            self._pending += 1
+            self._results[key] = future
+            future.add_done_callback(lambda done: self._finished(key, done))
+
+        # Shielded, so that one request timing out doesn't cancel the capture for
+        # everyone else waiting on it
+        return await asyncio.wait_for(asyncio.shield(future), self._timeout)
+
+    def _thumbnail_blocking(self, target: str, tile_size: int) -> Image:
+        # reduce() averages every tile_size square of pixels into one, partial tiles
+        # along the edges included
+        return self._capture.capture(target).convert("L").reduce(tile_size)
+
+    async def thumbnail(self, target: str, tile_size: int) -> Image:
+        """
+        A grayscale capture of `target` where each pixel is the average of a square
+        tile of `tile_size` pixels, for watching what's on screen cheaply. Bypasses
+        coalescing and the queue limit, so callers should only ever have one in
+        flight.
+
+        :raises ScreenshotTargetMissing: if there's nothing to capture for `target`
+        :raises ScreenshotUnavailable: if there's no X server to capture from
+        :raises asyncio.TimeoutError: if the capture took too long
+        """
+        return await asyncio.wait_for(
+            asyncio.get_event_loop().run_in_executor(
+                self._executor, self._thumbnail_blocking, target, tile_size
+            ),
+            self._timeout,
+        )
+
+    def _stream_frames_blocking(
+        self, target: str, streams: List[Tuple[StreamKey, Optional[bytes]]]
+    ) -> List[Tuple[bytes, Optional[bytes]]]:
+        """
+        For each (stream, last pixels), the scaled frame's pixels and the encoded
+        frame if it changed, all from a single capture of `target`.
+        """
+        capture = self._capture.capture(target)
+        frames = []
+        for key, last_pixels in streams:
+            _, width, height, quality, _ = key
+            frame = scale_image(capture, width, height)
+            pixels = frame.tobytes()
+            if pixels == last_pixels:
+                frames.append((pixels, None))
+                continue
+            frames.append((pixels, encode_image(frame, quality=quality, format="jpeg")))
+        return frames
+
+    async def _run_streams(self, target: str):
+        loop = asyncio.get_event_loop()
+        while True:
+            # Checked and removed without awaiting in between, so a viewer can't join a
+            # stream that's about to stop
+            streams = {}
+            for key, stream in list(self._streams.items()):
+                if key[0] != target:
+                    continue
+                if not stream.viewers:
+                    del self._streams[key]
+                    continue
+                streams[key] = stream
+            if not streams:
+                del self._stream_tasks[target]
+                return
+
+            started_at = loop.time()
+            due = [
+                key
+                for key, stream in streams.items()
+                if stream.next_frame_at <= started_at
+            ]
+            if due:
+                try:
+                    frames = await loop.run_in_executor(
+                        self._executor,
+                        self._stream_frames_blocking,
+                        target,
+                        [(key, streams[key].last_pixels) for key in due],
+                    )
+                except (ScreenshotTargetMissing, ScreenshotUnavailable):
+                    # e.g. no viewport between experiences, viewers keep the last frame
+                    frames = []
+                except Exception:
+                    logger.exception("Couldn't capture screenshot stream frame")
+                    frames = []
+
+                for key, (pixels, frame) in zip(due, frames):
+                    stream = streams[key]
+                    stream.last_pixels = pixels
+                    if frame is None:
+                        continue
+                    stream.last_frame = frame
+                    for viewer in list(stream.viewers):
+                        viewer.send(frame)
+                for key in due:
+                    streams[key].next_frame_at = started_at + 1 / key[4]
+
+            now = loop.time()
+            next_frame_at = min(stream.next_frame_at for stream in streams.values())
+            # However many frames are due, we leave the thread idle for at least as
+            # long as we just kept it busy
+            await asyncio.sleep(max(next_frame_at - now, now - started_at))
+
+    def watch(
+        self,
+        target: str,
+        fps: float,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        quality: int = 95,
+    ) -> ScreenshotViewer:
+        """
+        Starts watching a stream of JPEG frames of `target`, scaled down to fit within
+        `width` and `height` if given.
 
-    def capture_viewport(self):
-        return self._capture_window(self._window_by_name("FOOTRON_EXPERIENCE_VIEWPORT"))
+        :raises ScreenshotQueueFull: if too many other streams are running
+        """
+        key = (target, width, height, quality, fps)
+        stream = self._streams.get(key)
+        if stream is None:
+            if len(self._streams) >= self._max_streams:
+                raise ScreenshotQueueFull()
+            stream = _ScreenshotStream()
+            self._streams[key] = stream
+        if target not in self._stream_tasks:
+            # Doesn't run until we've added the viewer
+            self._stream_tasks[target] = asyncio.get_event_loop().create_task(
+                self._run_streams(target)
+            )
+        return ScreenshotViewer(stream)
@@ -1,9 +1,14 @@
+import abc
+import asyncio
+import enum
 import logging
-import subprocess
+import shutil
+from collections import deque
 from datetime import datetime, timedelta
-from typing import List, Tuple
+from pathlib import Path
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Tuple
 
-from ..constants import PACKAGE_SCRIPTS_PATH
+from ..constants import BASE_DATA_PATH, PACKAGE_SCRIPTS_PATH
 
 # Store previous Torch CUDA is_available attempts within this duration--note that we
 # don't control the frequency of invocations within StabilityManager
@@ -14,50 +19,440 @@ _TORCH_FAILS_STACK_DURATION = timedelta(minutes=2)
 _TORCH_FAILS_THRESHOLD = 0.4
 # We won't make any conclusions on less than 5 elements
 _TORCH_FAILS_MIN_ELEMENTS = 5
+# Upper bound on stored attempts, in case we're invoked much more often than expected
+_TORCH_ATTEMPTS_MAX = 64
+
+_GPU_PROBE_COMMAND = [str(PACKAGE_SCRIPTS_PATH / "gpu-stable.py"), "--serve"]
+# The first ping has to wait for torch to import and CUDA to initialize
+_PROBE_STARTUP_TIMEOUT_S = 60
+_PROBE_TIMEOUT_S = 10
+_TORCH_PROBE_INTERVAL_S = 15
+
+_PRESSURE_PATH = Path("/proc/pressure")
+_PRESSURE_PROBE_INTERVAL_S = 5
+_MEMINFO_PATH = Path("/proc/meminfo")
+# Where a container's memory usage lives for cgroup v2 with the systemd and cgroupfs
+# drivers, and for cgroup v1
+_CONTAINER_MEMORY_PATHS = [
+    "/sys/fs/cgroup/system.slice/docker-{id}.scope/memory.current",
+    "/sys/fs/cgroup/docker/{id}/memory.current",
+    "/sys/fs/cgroup/memory/docker/{id}/memory.usage_in_bytes",
+]
+_CONTAINER_MEMORY_PROBE_INTERVAL_S = 5
+_DISK_SPACE_PROBE_INTERVAL_S = 60
+
+# After applying a remedy, we give it this long to take effect before escalating to
+# the next one
+_REMEDY_ESCALATION_COOLDOWN_S = 60
 
 logger = logging.getLogger(__name__)
 
+ProbeFunction = Callable[[], Awaitable[bool]]
 
-class StabilityManager:
-    _torch_attempts: List[Tuple[datetime, bool]]
 
-    def __init__(self):
-        self._torch_attempts = []
+class ProbeWorker:
+    """
+    Long-lived probe process that answers a health ping for every line we write to
+    its stdin with "ok" or "fail", so that expensive setup (importing torch, creating
+    a CUDA context) only happens once. A worker that dies or stops answering counts
+    as a failed probe and is restarted on the next ping.
+    """
 
-    def _cull_torch_attempts(self):
-        cutoff = datetime.now() - _TORCH_FAILS_STACK_DURATION
-        while True:
-            if not self._torch_attempts:
-                break
+    _command: List[str]
+    _process: Optional[asyncio.subprocess.Process]
+    _lock: asyncio.Lock
 
-            when, attempt = self._torch_attempts[-1]
-            if when > cutoff:
-                break
+    def __init__(self, command: List[str]):
+        self._command = command
+        self._process = None
+        self._lock = asyncio.Lock()
 
-            self._torch_attempts.pop()
+    async def _ensure_started(self) -> bool:
+        if self._process and self._process.returncode is None:
+            return False
 
-    @staticmethod
-    def _torch_cuda_attempt() -> bool:
-        response = subprocess.run([PACKAGE_SCRIPTS_PATH / "gpu-stable.py"])
+        self._process = await asyncio.create_subprocess_exec(
+            *self._command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        return True
+
+    async def _kill(self):
+        if not self._process or self._process.returncode is not None:
+            return
+        self._process.kill()
+        await self._process.wait()
+
+    async def ping(self) -> bool:
+        async with self._lock:
+            try:
+                started = await self._ensure_started()
+                self._process.stdin.write(b"ping\n")
+                await self._process.stdin.drain()
+                response = await asyncio.wait_for(
+                    self._process.stdout.readline(),
+                    _PROBE_STARTUP_TIMEOUT_S if started else _PROBE_TIMEOUT_S,
+                )
+            except (OSError, asyncio.TimeoutError):
+                logger.exception("Stability probe worker didn't respond, restarting")
+                await self._kill()
+                return False
+
+            if not response:
+                logger.warning("Stability probe worker exited, restarting")
+                await self._kill()
+                return False
+
+            return response.strip() == b"ok"
+
+
+class Remedy(enum.IntEnum):
+    """
+    What to do about an unstable system, ordered from least to most disruptive.
+    """
+
+    NONE = 0
+    CLEAR_CONTAINER_POOL = 1
+    RESTART_EXPERIENCE = 2
+    REBOOT = 3
+
+
+class StabilityProbe(abc.ABC):
+    """
+    A single stability signal, sampled every `interval` seconds.
+
+    A probe trips once `trip_after` consecutive samples reach `trip_threshold` and
+    only clears again once a sample drops below `clear_threshold`, so that a signal
+    hovering around the threshold doesn't flap. While tripped, StabilityManager
+    escalates through `remedies` in order.
+    """
+
+    name: str
+    interval: float
+    trip_threshold: float
+    clear_threshold: float
+    trip_after: int
+    remedies: List[Remedy]
+    tripped: bool
+    last_value: Optional[float]
+    _over_count: int
+    _next_sample: float
+
+    def __init__(
+        self,
+        name: str,
+        interval: float,
+        trip_threshold: float,
+        clear_threshold: float,
+        remedies: List[Remedy],
+        trip_after: int = 1,
+    ):
+        self.name = name
+        self.interval = interval
+        self.trip_threshold = trip_threshold
+        self.clear_threshold = clear_threshold
+        self.remedies = remedies
+        self.trip_after = trip_after
+        self.tripped = False
+        self.last_value = None
+        self._over_count = 0
+        self._next_sample = 0
+
+    @abc.abstractmethod
+    async def sample(self) -> Optional[float]:
+        """
+        Return the current value of the signal, or None if it isn't available.
+        """
+        ...
+
+    def due(self, now: float) -> bool:
+        return now >= self._next_sample
+
+    async def update(self, now: float) -> bool:
+        self._next_sample = now + self.interval
+        value = await self.sample()
+        if value is None:
+            return self.tripped
+
+        self.last_value = value
+        if self.tripped:
+            if value < self.clear_threshold:
+                logger.info(f"Stability probe '{self.name}' cleared at {value:.2f}")
+                self.tripped = False
+                self._over_count = 0
+            return self.tripped
+
+        self._over_count = self._over_count + 1 if value >= self.trip_threshold else 0
+        if self._over_count >= self.trip_after:
+            logger.warning(f"Stability probe '{self.name}' tripped at {value:.2f}")
+            self.tripped = True
+        return self.tripped
+
+
+class TorchCudaProbe(StabilityProbe):
+    """
+    Proportion of recent failed attempts to put a tensor on the GPU.
+    """
+
+    # Newest attempts are on the right
+    _attempts: Deque[Tuple[datetime, bool]]
+    _fail_count: int
+    _probe: ProbeFunction
+
+    def __init__(self, probe: Optional[ProbeFunction] = None):
+        super().__init__(
+            "torch_cuda",
+            _TORCH_PROBE_INTERVAL_S,
+            trip_threshold=_TORCH_FAILS_THRESHOLD,
+            clear_threshold=_TORCH_FAILS_THRESHOLD,
+            remedies=[Remedy.REBOOT],
+        )
+        self._attempts = deque()
+        self._fail_count = 0
+        self._probe = probe or ProbeWorker(_GPU_PROBE_COMMAND).ping
+
+    def _pop_attempt(self):
+        _, attempt = self._attempts.popleft()
+        if not attempt:
+            self._fail_count -= 1
+
+    def _push_attempt(self, attempt: bool):
+        if len(self._attempts) >= _TORCH_ATTEMPTS_MAX:
+            self._pop_attempt()
+        self._attempts.append((datetime.now(), attempt))
+        if not attempt:
+            self._fail_count += 1
+
+    def _cull_attempts(self):
+        cutoff = datetime.now() - _TORCH_FAILS_STACK_DURATION
+        while self._attempts and self._attempts[0][0] <= cutoff:
+            self._pop_attempt()
 
-        if response.returncode != 0:
-            logger.warning(
-                "CUDA stability check failed with non-zero exit code, system may be unstable"
-            )
+    async def _cuda_attempt(self) -> bool:
+        if not await self._probe():
+            logger.warning("CUDA stability check failed, system may be unstable")
             return False
 
         return True
 
-    def _is_torch_stable(self) -> bool:
-        self._cull_torch_attempts()
-        self._torch_attempts.insert(0, (datetime.now(), self._torch_cuda_attempt()))
+    async def sample(self) -> Optional[float]:
+        self._cull_attempts()
+        self._push_attempt(await self._cuda_attempt())
 
-        total = len(self._torch_attempts)
+        total = len(self._attempts)
         if total < _TORCH_FAILS_MIN_ELEMENTS:
-            return True
+            return 0
+
+        return self._fail_count / total
+
+
+class PressureProbe(StabilityProbe):
+    """
+    Linux pressure stall information: the percentage of the last 10 seconds in which
+    some (or all, for `kind="full"`) tasks were stalled on `resource`.
+    """
+
+    _path: Path
+    _kind: str
+
+    def __init__(
+        self,
+        resource: str,
+        kind: str,
+        trip_threshold: float,
+        clear_threshold: float,
+        remedies: List[Remedy],
+    ):
+        super().__init__(
+            f"pressure_{resource}_{kind}",
+            _PRESSURE_PROBE_INTERVAL_S,
+            trip_threshold,
+            clear_threshold,
+            remedies,
+            # avg10 already smooths over 10 seconds, so a couple of samples is plenty
+            trip_after=2,
+        )
+        self._path = _PRESSURE_PATH / resource
+        self._kind = kind
+
+    async def sample(self) -> Optional[float]:
+        try:
+            lines = self._path.read_text().splitlines()
+        except OSError:
+            # Kernel without PSI (< 4.20 or booted with psi=0)
+            return None
+
+        for line in lines:
+            kind, *fields = line.split()
+            if kind != self._kind:
+                continue
+            values = dict(field.split("=") for field in fields)
+            return float(values["avg10"])
+
+
+class ContainerMemoryProbe(StabilityProbe):
+    """
+    Memory used by experience containers (running and pooled) as a percentage of
+    total system memory, read straight from their cgroups.
+    """
+
+    _container_ids: Callable[[], Iterable[str]]
+
+    def __init__(self, container_ids: Callable[[], Iterable[str]]):
+        super().__init__(
+            "container_memory",
+            _CONTAINER_MEMORY_PROBE_INTERVAL_S,
+            trip_threshold=85,
+            clear_threshold=75,
+            remedies=[Remedy.CLEAR_CONTAINER_POOL, Remedy.RESTART_EXPERIENCE],
+        )
+        self._container_ids = container_ids
+
+    @staticmethod
+    def _total_memory() -> Optional[int]:
+        for line in _MEMINFO_PATH.read_text().splitlines():
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+
+    @staticmethod
+    def _container_memory(container_id: str) -> int:
+        for path in _CONTAINER_MEMORY_PATHS:
+            try:
+                return int(Path(path.format(id=container_id)).read_text())
+            except (OSError, ValueError):
+                continue
+        return 0
+
+    async def sample(self) -> Optional[float]:
+        container_ids = list(self._container_ids())
+        if not container_ids:
+            return 0
+
+        try:
+            total_memory = self._total_memory()
+        except OSError:
+            return None
+        if not total_memory:
+            return None
+
+        used_memory = sum(map(self._container_memory, container_ids))
+        return used_memory / total_memory * 100
+
+
+class DiskSpaceProbe(StabilityProbe):
+    """
+    Percentage of the data volume in use.
+    """
+
+    _path: Path
+
+    def __init__(self, path: Path):
+        super().__init__(
+            "disk_space",
+            _DISK_SPACE_PROBE_INTERVAL_S,
+            trip_threshold=95,
+            clear_threshold=90,
+            # None of our remedies free up disk space, so this is just reported
+            remedies=[],
+        )
+        self._path = path
+
+    async def sample(self) -> Optional[float]:
+        try:
+            usage = shutil.disk_usage(self._path)
+        except OSError:
+            return None
+        return usage.used / usage.total * 100
+
+
+def default_probes(
+    container_ids: Callable[[], Iterable[str]],
+    gpu_probe: Optional[ProbeFunction] = None,
+) -> List[StabilityProbe]:
+    return [
+        TorchCudaProbe(gpu_probe),
+        PressureProbe(
+            "memory",
+            "full",
+            trip_threshold=10,
+            clear_threshold=2,
+            remedies=[
+                Remedy.CLEAR_CONTAINER_POOL,
+                Remedy.RESTART_EXPERIENCE,
+                Remedy.REBOOT,
+            ],
+        ),
+        PressureProbe(
+            "io",
+            "full",
+            trip_threshold=40,
+            clear_threshold=10,
+            remedies=[Remedy.RESTART_EXPERIENCE],
+        ),
+        PressureProbe(
+            "cpu",
+            "some",
+            trip_threshold=90,
+            clear_threshold=60,
+            remedies=[Remedy.RESTART_EXPERIENCE],
+        ),
+        ContainerMemoryProbe(container_ids),
+        DiskSpaceProbe(BASE_DATA_PATH),
+    ]
+
+
+class StabilityManager:
+    _probes: List[StabilityProbe]
+    # Probe name -> (index into its remedies, time the remedy was applied)
+    _escalations: Dict[str, Tuple[int, float]]
+
+    def __init__(self, probes: List[StabilityProbe]):
+        self._probes = probes
+        self._escalations = {}
+
+    @property
+    def probes(self) -> List[StabilityProbe]:
+        return self._probes
+
+    def _next_remedy(self, probe: StabilityProbe, now: float) -> Remedy:
+        if not probe.remedies:
+            if probe.name not in self._escalations:
+                logger.warning(
+                    f"Stability probe '{probe.name}' tripped, but it has no remedies"
+                )
+                self._escalations[probe.name] = (0, now)
+            return Remedy.NONE
+
+        if probe.name not in self._escalations:
+            level = 0
+        else:
+            level, applied_at = self._escalations[probe.name]
+            if now - applied_at < _REMEDY_ESCALATION_COOLDOWN_S:
+                return Remedy.NONE
+            level = min(level + 1, len(probe.remedies) - 1)
+
+        self._escalations[probe.name] = (level, now)
+        return probe.remedies[level]
 
-        fail_count = len(list(filter(lambda a: not a[1], self._torch_attempts)))
-        return fail_count / total < _TORCH_FAILS_THRESHOLD
+    async def check(self) -> Remedy:
+        """
+        Sample every probe that's due, returning the most disruptive remedy needed by
+        any tripped probe.
+        """
+        now = asyncio.get_event_loop().time()
+        due_probes = [probe for probe in self._probes if probe.due(now)]
+        results = await asyncio.gather(
+            *(probe.update(now) for probe in due_probes), return_exceptions=True
+        )
+        for probe, result in zip(due_probes, results):
+            if isinstance(result, Exception):
+                logger.error(f"Stability probe '{probe.name}' failed", exc_info=result)
 
-    def check_stable(self):
-        return self._is_torch_stable()
+        remedy = Remedy.NONE
+        for probe in self._probes:
+            if not probe.tripped:
+                self._escalations.pop(probe.name, None)
+                continue
+            remedy = max(remedy, self._next_remedy(probe, now))
+        return remedy
@@ -0,0 +1,348 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import Xlib
+import Xlib.display
+import Xlib.error
+import Xlib.ext.res
+import Xlib.protocol.event
+from Xlib.xobject.drawable import Window
+
+logger = logging.getLogger(__name__)
+
+_window_index: Optional[WindowIndex] = None
+
+# Connecting blocks the event loop, so without an X server we only try this often
+_RECONNECT_INTERVAL_S = 30
+
+
+class IndexedWindow:
+    id: int
+    wm_class: Tuple[str, ...]
+    # _NET_WM_NAME, which is what our own windows (e.g. the viewport) set
+    name: Optional[str]
+    mapped: bool
+
+    def __init__(
+        self,
+        id: int,
+        wm_class: Tuple[str, ...],
+        name: Optional[str] = None,
+        mapped: bool = False,
+    ):
+        self.id = id
+        self.wm_class = wm_class
+        self.name = name
+        self.mapped = mapped
+
+
+WindowPredicate = Callable[[IndexedWindow], bool]
+
+
+class WindowIndex:
+    """
+    Keeps track of the top-level windows (children of the root window) and tells us
+    when they show up on screen.
+
+    The index is populated once with a walk of the window tree, and from then on
+    kept up to date on a background thread from SubstructureNotify events on the
+    root and PropertyNotify events on each window. The thread has its own X
+    connection because Xlib connections aren't thread safe. Lookups read the index
+    from any thread without talking to the X server.
+
+    If there's no X server to connect to, the index is never ready and waiters just
+    never hear back, so callers should always bound how long they wait.
+    """
+
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _thread: Optional[threading.Thread]
+    _waiters: List[Tuple[WindowPredicate, asyncio.Future]]
+    # Only ever modified on the event thread. Each change is a single dict operation,
+    # so other threads can read these without locking.
+    _windows: Dict[int, IndexedWindow]
+    _by_name: Dict[str, int]
+    _ready: bool
+    _last_connect_attempt: Optional[float]
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._last_connect_attempt = None
+        self._waiters = []
+        self._windows = {}
+        self._by_name = {}
+        self._ready = False
+
+    @property
+    def ready(self) -> bool:
+        """
+        Whether the index is up to date. Lookups should fall back to asking the X
+        server when it isn't.
+        """
+        return self._ready
+
+    def start(self):
+        if self._thread:
+            return
+
+        now = time.monotonic()
+        if (
+            self._last_connect_attempt is not None
+            and now - self._last_connect_attempt < _RECONNECT_INTERVAL_S
+        ):
+            return
+        self._last_connect_attempt = now
+
+        try:
+            display = Xlib.display.Display()
+        except (Xlib.error.DisplayError, OSError):
+            logger.warning("Couldn't connect to X server, can't keep track of windows")
+            return
+
+        self._loop = asyncio.get_event_loop()
+        self._thread = threading.Thread(
+            target=self._follow_events, args=(display,), name="x-windows", daemon=True
+        )
+        self._thread.start()
+
+    def _read_window(self, window: Window, atoms: Dict[str, int]) -> IndexedWindow:
+        # Raises XError if the window is already gone again
+        wm_name = window.get_full_property(atoms["_NET_WM_NAME"], 0)
+        return IndexedWindow(
+            window.id,
+            tuple(window.get_wm_class() or ()),
+            wm_name.value.decode("utf8") if wm_name and wm_name.value else None,
+            window.get_attributes().map_state != Xlib.X.IsUnmapped,
+        )
+
+    def _track(self, window: Window, atoms: Dict[str, int]):
+        try:
+            # So that we hear about its name changing
+            window.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        except Xlib.error.XError:
+            return
+        self._refresh(window, atoms)
+
+    def _refresh(self, window: Window, atoms: Dict[str, int]):
+        try:
+            indexed = self._read_window(window, atoms)
+        except Xlib.error.XError:
+            self._forget(window.id)
+            return
+
+        previous = self._windows.get(window.id)
+        self._windows[window.id] = indexed
+        if previous and previous.name and previous.name != indexed.name:
+            if self._by_name.get(previous.name) == window.id:
+                del self._by_name[previous.name]
+        if indexed.name:
+            self._by_name[indexed.name] = window.id
+
+    def _forget(self, window_id: int):
+        window = self._windows.pop(window_id, None)
+        if window and window.name and self._by_name.get(window.name) == window_id:
+            del self._by_name[window.name]
+
+    def _follow_events(self, display: Xlib.display.Display):
+        # Windows can disappear between an event and us asking about them, which makes
+        # for asynchronous errors that we don't care about
+        display.set_error_handler(lambda *args: None)
+        atoms = {
+            name: display.intern_atom(name) for name in ["_NET_WM_NAME", "WM_CLASS"]
+        }
+        root = display.screen().root
+        try:
+            # Selected before walking the tree so we can't miss windows created while
+            # we're walking it
+            root.change_attributes(event_mask=Xlib.X.SubstructureNotifyMask)
+            self._windows = {}
+            self._by_name = {}
+            for child in root.query_tree().children:
+                self._track(child, atoms)
+            self._ready = True
+
+            while True:
+                event = display.next_event()
+                self._handle_event(event, root, atoms)
+        except Exception:
+            logger.exception("Lost X connection while keeping track of windows")
+        finally:
+            self._ready = False
+            display.close()
+            # Reconnect the next time someone waits for a window
+            self._thread = None
+
+    def _handle_event(self, event, root: Window, atoms: Dict[str, int]):
+        if event.type == Xlib.X.CreateNotify:
+            if event.parent.id == root.id:
+                self._track(event.window, atoms)
+        elif event.type == Xlib.X.DestroyNotify:
+            self._forget(event.window.id)
+        elif event.type == Xlib.X.ReparentNotify:
+            # e.g. a window manager frame taking a window in
+            if event.parent.id == root.id:
+                self._track(event.window, atoms)
+            else:
+                self._forget(event.window.id)
+        elif event.type in [Xlib.X.MapNotify, Xlib.X.UnmapNotify]:
+            window = self._windows.get(event.window.id)
+            if window is None:
+                return
+            window.mapped = event.type == Xlib.X.MapNotify
+            # Override-redirect windows are menus, tooltips and the like
+            if window.mapped and not event.override:
+                self._loop.call_soon_threadsafe(self._dispatch, window)
+        elif event.type == Xlib.X.PropertyNotify:
+            if event.atom in atoms.values() and event.window.id in self._windows:
+                self._refresh(event.window, atoms)
+
+    def _dispatch(self, window: IndexedWindow):
+        waiters = []
+        for predicate, future in self._waiters:
+            if future.done():
+                continue
+            if predicate(window):
+                future.set_result(window)
+                continue
+            waiters.append((predicate, future))
+        self._waiters = waiters
+
+    def find_by_name(self, name: str) -> Optional[IndexedWindow]:
+        window_id = self._by_name.get(name)
+        return self._windows.get(window_id) if window_id is not None else None
+
+    def windows(self) -> List[IndexedWindow]:
+        return list(self._windows.values())
+
+    def wait_for_map(self, predicate: WindowPredicate) -> asyncio.Future:
+        """
+        Returns a future for the next window to be mapped that matches `predicate`.
+        Cancel it to stop waiting.
+        """
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        waiter = (predicate, future)
+        self._waiters.append(waiter)
+        # Without an X server nothing ever dispatches, so waiters that gave up have
+        # to clean up after themselves
+        future.add_done_callback(lambda _: self._remove_waiter(waiter))
+        return future
+
+    def _remove_waiter(self, waiter: Tuple[WindowPredicate, asyncio.Future]):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            # Already dropped by _dispatch
+            pass
+
+
+def _client_windows(display: Xlib.display.Display, pids: Iterable[int]) -> List[Window]:
+    """
+    Mapped top-level windows belonging to X clients running as any of `pids`, either
+    directly under the root or inside a window manager frame.
+    """
+    pids = set(pids)
+    client_ids = display.res_query_client_ids(
+        [{"client": 0, "mask": Xlib.ext.res.LocalClientPIDMask}]
+    ).ids
+    # Every resource a client creates shares its resource ID base
+    bases = {
+        client.spec.client
+        for client in client_ids
+        if client.value and client.value[0] in pids
+    }
+    if not bases:
+        return []
+
+    id_mask = display.display.info.resource_id_mask
+
+    def owned(window: Window) -> bool:
+        return window.id & ~id_mask in bases
+
+    windows = []
+    for child in display.screen().root.query_tree().children:
+        candidates = [child] if owned(child) else child.query_tree().children
+        windows.extend(
+            window
+            for window in candidates
+            if owned(window) and window.get_attributes().map_state != Xlib.X.IsUnmapped
+        )
+    return windows
+
+
+def hide_client_windows(pids: Iterable[int]) -> List[int]:
+    """
+    Withdraws the top-level windows of the X clients running as any of `pids`, so
+    that e.g. a paused container doesn't leave a stale picture on screen. Returns the
+    IDs of the hidden windows for show_windows.
+
+    This blocks on the X server, so run it on an executor.
+    """
+    try:
+        display = Xlib.display.Display()
+    except (Xlib.error.DisplayError, OSError):
+        logger.warning("Couldn't connect to X server to hide windows")
+        return []
+
+    try:
+        if not display.has_extension(Xlib.ext.res.extname):
+            logger.warning("X server doesn't support X-Resource, can't hide windows")
+            return []
+        root = display.screen().root
+        windows = _client_windows(display, pids)
+        for window in windows:
+            # Per ICCCM, withdrawing a window means unmapping it and telling the
+            # window manager, which may have reparented it into a frame
+            window.unmap()
+            root.send_event(
+                Xlib.protocol.event.UnmapNotify(
+                    event=root, window=window, from_configure=False
+                ),
+                event_mask=Xlib.X.SubstructureNotifyMask
+                | Xlib.X.SubstructureRedirectMask,
+            )
+        display.sync()
+        return [window.id for window in windows]
+    except Xlib.error.XError:
+        logger.exception("Couldn't hide client windows")
+        return []
+    finally:
+        display.close()
+
+
+def show_windows(window_ids: Iterable[int]):
+    """
+    Maps windows hidden with hide_client_windows again. Blocks on the X server.
+    """
+    window_ids = list(window_ids)
+    if not window_ids:
+        return
+
+    try:
+        display = Xlib.display.Display()
+    except (Xlib.error.DisplayError, OSError):
+        logger.warning("Couldn't connect to X server to show windows")
+        return
+
+    try:
+        # Windows that were destroyed in the meantime just make for errors we don't
+        # care about
+        display.set_error_handler(lambda *args: None)
+        for window_id in window_ids:
+            display.create_resource_object("window", window_id).map()
+        display.sync()
+    finally:
+        display.close()
+
+
+def get_window_index() -> WindowIndex:
+    global _window_index
+    if _window_index is None:
+        _window_index = WindowIndex()
+
+    return _window_index
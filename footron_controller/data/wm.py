@@ -1,8 +1,11 @@
+import asyncio
+import itertools
 import logging
 from datetime import datetime
 from enum import Enum
-from typing import List, Optional
+from typing import Dict, List, Optional
 
+import rollbar
 import zmq
 import zmq.asyncio
 
@@ -10,6 +13,18 @@ from ..util import datetime_to_timestamp
 
 logger = logging.getLogger(__name__)
 
+# How long to wait for the window manager to acknowledge a message. Window managers
+# that never acknowledge anything are only waited on once.
+_ACK_TIMEOUT_S = 0.5
+
+# Receiving backs off after errors, doubling up to the maximum, so that an error that
+# keeps happening can't spin the event loop or flood rollbar
+_RECEIVE_RETRY_INTERVAL_S = 1
+_RECEIVE_RETRY_MAX_INTERVAL_S = 60
+
+# Errors after which the socket will never work again
+_FATAL_SOCKET_ERRORS = {zmq.ETERM, zmq.ENOTSOCK}
+
 
 class DisplayLayout(str, Enum):
     Full = "full"
@@ -18,14 +33,86 @@ class DisplayLayout(str, Enum):
 
 
 class WmApi:
+    """
+    Sends display commands to the window manager. Every message carries an ID, and
+    the window manager can reply with {"type": "ack", "id": <id>} once it has
+    applied it, in which case sending waits for the acknowledgement.
+    """
+
+    _message_ids: itertools.count
+    _pending_acks: Dict[int, asyncio.Future]
+    # None until we know whether the window manager acknowledges messages
+    _acks_supported: Optional[bool]
+    _receive_task: Optional[asyncio.Task]
+
     def __init__(self):
         self._context = zmq.asyncio.Context()
         # noinspection PyUnresolvedReferences
         self._socket = self._context.socket(zmq.PAIR)
         self._socket.connect("tcp://localhost:5557")
+        self._message_ids = itertools.count(1)
+        self._pending_acks = {}
+        self._acks_supported = None
+        self._receive_task = None
+
+    async def _receive_loop(self):
+        retry_interval = _RECEIVE_RETRY_INTERVAL_S
+        while True:
+            try:
+                message = await self._socket.recv_json()
+                retry_interval = _RECEIVE_RETRY_INTERVAL_S
+                if message.get("type") != "ack":
+                    continue
+                self._acks_supported = True
+                ack = self._pending_acks.get(message.get("id"))
+                if ack and not ack.done():
+                    ack.set_result(None)
+            except Exception as e:
+                if isinstance(e, zmq.ZMQError) and (
+                    self._socket.closed or e.errno in _FATAL_SOCKET_ERRORS
+                ):
+                    logger.error(
+                        "Window manager socket closed, no longer receiving messages"
+                    )
+                    # Nothing can acknowledge our messages anymore
+                    self._acks_supported = False
+                    return
+                rollbar.report_exc_info(e)
+                logger.exception("Error while receiving window manager message")
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, _RECEIVE_RETRY_MAX_INTERVAL_S)
+
+    async def _send(self, data):
+        if not self._receive_task:
+            self._receive_task = asyncio.get_event_loop().create_task(
+                self._receive_loop()
+            )
+
+        data["id"] = next(self._message_ids)
+        if self._acks_supported is False:
+            await self._socket.send_json(data)
+            return
+
+        ack = asyncio.get_event_loop().create_future()
+        self._pending_acks[data["id"]] = ack
+        try:
+            await self._socket.send_json(data)
+            await asyncio.wait_for(ack, _ACK_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            if self._acks_supported is None:
+                logger.info(
+                    "Window manager doesn't acknowledge messages, not waiting for it"
+                )
+                self._acks_supported = False
+            else:
+                logger.warning(
+                    f"Window manager didn't acknowledge '{data['type']}' message"
+                )
+        finally:
+            del self._pending_acks[data["id"]]
 
     async def set_layout(self, layout: DisplayLayout):
-        await self._socket.send_json(
+        await self._send(
             {
                 "type": "layout",
                 "after": datetime_to_timestamp(datetime.now()),
@@ -42,4 +129,4 @@ class WmApi:
         if include is not None:
             data["include"] = include
 
-        await self._socket.send_json(data)
+        await self._send(data)
@@ -0,0 +1,349 @@
+"""
+Screen capture through the MIT-SHM X extension, which has the X server write pixels
+straight into a shared memory segment instead of sending them over the socket.
+
+python-xlib doesn't implement MIT-SHM, so this talks to libX11 and libXext through
+ctypes on a connection of its own.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+_SHM_PERMISSIONS = 0o600
+
+_Z_PIXMAP = 2
+_ALL_PLANES = ctypes.c_ulong(-1)
+
+
+class ShmUnavailable(Exception):
+    """
+    MIT-SHM can't be used with this X server, e.g. a remote display or an Xvfb
+    without the extension.
+    """
+
+
+class ShmCaptureError(Exception):
+    pass
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+
+class _XImage(ctypes.Structure):
+    # Only the leading fields we use, we never allocate XImages ourselves
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+        ("red_mask", ctypes.c_ulong),
+        ("green_mask", ctypes.c_ulong),
+        ("blue_mask", ctypes.c_ulong),
+    ]
+
+
+class _XErrorEvent(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_int),
+        ("display", ctypes.c_void_p),
+        ("resourceid", ctypes.c_ulong),
+        ("serial", ctypes.c_ulong),
+        ("error_code", ctypes.c_ubyte),
+        ("request_code", ctypes.c_ubyte),
+        ("minor_code", ctypes.c_ubyte),
+    ]
+
+
+_XErrorHandler = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(_XErrorEvent)
+)
+
+
+def _load_library(name: str) -> ctypes.CDLL:
+    path = ctypes.util.find_library(name)
+    if path is None:
+        raise ShmUnavailable(f"Couldn't find lib{name}")
+    return ctypes.CDLL(path)
+
+
+def _declare(function, argtypes, restype):
+    function.argtypes = argtypes
+    function.restype = restype
+
+
+class ShmCapture:
+    """
+    Captures drawables into a shared memory segment that's reused across captures,
+    and only grown when a capture doesn't fit.
+
+    Owns its own X connection, so like any Xlib connection it must only ever be used
+    from one thread.
+    """
+
+    _display: ctypes.c_void_p
+    _info: _XShmSegmentInfo
+    _segment_size: int
+    _image: Optional[ctypes.POINTER(_XImage)]
+    # X errors are reported asynchronously through the error handler
+    _error_code: Optional[int]
+
+    def __init__(self, display_name: Optional[str] = None):
+        self._x11 = _load_library("X11")
+        self._xext = _load_library("Xext")
+        self._libc = _load_library("c")
+        self._declare_functions()
+
+        self._segment_size = 0
+        self._image = None
+        self._display = self._x11.XOpenDisplay(
+            display_name.encode() if display_name else None
+        )
+        if not self._display:
+            raise ShmUnavailable("Couldn't open X display")
+        try:
+            self._set_up()
+        except ShmUnavailable:
+            self.close()
+            raise
+
+    def _set_up(self):
+        if not self._xext.XShmQueryExtension(self._display):
+            raise ShmUnavailable("X server doesn't support MIT-SHM")
+
+        # Xlib's default handler exits the process on any error, so we record errors
+        # and check for them after each request instead. We only ever talk to the X
+        # server through python-xlib otherwise, so replacing the process-wide handler
+        # doesn't affect anyone else.
+        self._error_code = None
+        self._error_handler = _XErrorHandler(self._handle_error)
+        self._x11.XSetErrorHandler(self._error_handler)
+
+        screen = self._x11.XDefaultScreen(self._display)
+        self._visual = self._x11.XDefaultVisual(self._display, screen)
+        self._depth = self._x11.XDefaultDepth(self._display, screen)
+        self._info = _XShmSegmentInfo()
+        self._image_size = (0, 0)
+
+        # Attaching can still fail, e.g. when the X server is on another machine, so
+        # we try it once up front
+        try:
+            self._prepare_image(1, 1)
+        except ShmCaptureError as e:
+            raise ShmUnavailable(str(e)) from e
+
+        image = self._image.contents
+        if image.bits_per_pixel != 32 or image.red_mask != 0xFF0000:
+            raise ShmUnavailable(
+                f"Unsupported pixel format ({image.bits_per_pixel} bpp, "
+                f"red mask {image.red_mask:#x})"
+            )
+
+    def _declare_functions(self):
+        display = ctypes.c_void_p
+        info = ctypes.POINTER(_XShmSegmentInfo)
+        image = ctypes.POINTER(_XImage)
+        _declare(self._x11.XOpenDisplay, [ctypes.c_char_p], display)
+        _declare(self._x11.XCloseDisplay, [display], ctypes.c_int)
+        _declare(self._x11.XDefaultScreen, [display], ctypes.c_int)
+        _declare(self._x11.XDefaultVisual, [display, ctypes.c_int], ctypes.c_void_p)
+        _declare(self._x11.XDefaultDepth, [display, ctypes.c_int], ctypes.c_int)
+        _declare(self._x11.XSync, [display, ctypes.c_int], ctypes.c_int)
+        _declare(self._x11.XFree, [ctypes.c_void_p], ctypes.c_int)
+        _declare(self._x11.XSetErrorHandler, [_XErrorHandler], ctypes.c_void_p)
+        _declare(self._xext.XShmQueryExtension, [display], ctypes.c_int)
+        _declare(
+            self._xext.XShmCreateImage,
+            [
+                display,
+                ctypes.c_void_p,
+                ctypes.c_uint,
+                ctypes.c_int,
+                ctypes.c_void_p,
+                info,
+                ctypes.c_uint,
+                ctypes.c_uint,
+            ],
+            image,
+        )
+        _declare(self._xext.XShmAttach, [display, info], ctypes.c_int)
+        _declare(self._xext.XShmDetach, [display, info], ctypes.c_int)
+        _declare(
+            self._xext.XShmGetImage,
+            [
+                display,
+                ctypes.c_ulong,
+                image,
+                ctypes.c_int,
+                ctypes.c_int,
+                ctypes.c_ulong,
+            ],
+            ctypes.c_int,
+        )
+        _declare(
+            self._libc.shmget,
+            [ctypes.c_int, ctypes.c_size_t, ctypes.c_int],
+            ctypes.c_int,
+        )
+        _declare(
+            self._libc.shmat,
+            [ctypes.c_int, ctypes.c_void_p, ctypes.c_int],
+            ctypes.c_void_p,
+        )
+        _declare(self._libc.shmdt, [ctypes.c_void_p], ctypes.c_int)
+        _declare(
+            self._libc.shmctl,
+            [ctypes.c_int, ctypes.c_int, ctypes.c_void_p],
+            ctypes.c_int,
+        )
+
+    def close(self):
+        if not self._display:
+            return
+        self._detach()
+        if self._image is not None:
+            self._x11.XFree(self._image)
+            self._image = None
+        self._x11.XCloseDisplay(self._display)
+        self._display = None
+
+    def _handle_error(self, _display, event) -> int:
+        self._error_code = event.contents.error_code
+        return 0
+
+    def _sync(self, action: str):
+        self._x11.XSync(self._display, 0)
+        if self._error_code is not None:
+            error_code, self._error_code = self._error_code, None
+            raise ShmCaptureError(f"X error {error_code} while {action}")
+
+    def _detach(self):
+        if not self._segment_size:
+            return
+        self._xext.XShmDetach(self._display, ctypes.byref(self._info))
+        self._x11.XSync(self._display, 0)
+        self._libc.shmdt(self._info.shmaddr)
+        self._segment_size = 0
+
+    def _attach(self, size: int):
+        shmid = self._libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | _SHM_PERMISSIONS)
+        if shmid < 0:
+            raise ShmCaptureError(f"shmget failed for {size} bytes")
+        address = self._libc.shmat(shmid, None, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            self._libc.shmctl(shmid, _IPC_RMID, None)
+            raise ShmCaptureError("shmat failed")
+
+        self._info.shmid = shmid
+        self._info.shmaddr = address
+        self._info.readOnly = 0
+        attached = self._xext.XShmAttach(self._display, ctypes.byref(self._info))
+        try:
+            self._sync("attaching shared memory")
+            if not attached:
+                raise ShmCaptureError("XShmAttach failed")
+        except ShmCaptureError:
+            self._libc.shmdt(address)
+            raise
+        finally:
+            # The segment is only actually removed once both we and the X server
+            # have detached from it, so it can't leak even if we crash
+            self._libc.shmctl(shmid, _IPC_RMID, None)
+        self._segment_size = size
+
+    def _prepare_image(self, width: int, height: int):
+        if self._image is not None and self._image_size == (width, height):
+            return
+        if self._image is not None:
+            # The XImage struct only; its data is our segment
+            self._x11.XFree(self._image)
+            self._image = None
+
+        image = self._xext.XShmCreateImage(
+            self._display,
+            self._visual,
+            self._depth,
+            _Z_PIXMAP,
+            None,
+            ctypes.byref(self._info),
+            width,
+            height,
+        )
+        if not image:
+            raise ShmCaptureError("XShmCreateImage failed")
+
+        size = image.contents.bytes_per_line * height
+        if size > self._segment_size:
+            self._detach()
+            try:
+                self._attach(size)
+            except ShmCaptureError:
+                self._x11.XFree(image)
+                raise
+        image.contents.data = self._info.shmaddr
+        self._image = image
+        self._image_size = (width, height)
+
+    def _capture_rows(
+        self, drawable: int, x: int, y: int, width: int, height: int
+    ) -> np.ndarray:
+        self._prepare_image(width, height)
+        captured = self._xext.XShmGetImage(
+            self._display, drawable, self._image, x, y, _ALL_PLANES
+        )
+        self._sync("capturing")
+        if not captured:
+            raise ShmCaptureError("XShmGetImage failed")
+
+        stride = self._image.contents.bytes_per_line
+        buffer = (ctypes.c_ubyte * (stride * height)).from_address(self._info.shmaddr)
+        # Rows can be padded past the last pixel
+        return np.frombuffer(buffer, dtype=np.uint8).reshape(height, stride)
+
+    def capture_array(
+        self, drawable: int, x: int, y: int, width: int, height: int
+    ) -> np.ndarray:
+        """
+        Captures a region of a drawable (e.g. a window ID), which has to lie entirely
+        within it, as a (height, width, 4) array of BGRX pixels.
+
+        The array is a view of the shared memory segment, not a copy, so it's only
+        valid until the next capture overwrites it.
+        """
+        rows = self._capture_rows(drawable, x, y, width, height)
+        return rows[:, : width * 4].reshape(height, width, 4)
+
+    def capture(
+        self, drawable: int, x: int, y: int, width: int, height: int
+    ) -> Image.Image:
+        """
+        Like capture_array, but as an image of its own that later captures don't
+        overwrite.
+        """
+        rows = self._capture_rows(drawable, x, y, width, height)
+        # PIL has no BGRX mode, so decoding to RGB is the one copy we make
+        return Image.frombuffer(
+            "RGB", (width, height), rows, "raw", "BGRX", rows.shape[1], 1
+        )
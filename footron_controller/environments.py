@@ -3,10 +3,12 @@ from __future__ import annotations
 import abc
 import asyncio
 import enum
+import itertools
 import logging
 import os
 import subprocess
 import urllib.parse
+import weakref
 from datetime import datetime
 from pathlib import Path
 from typing import Awaitable, Callable, List, Optional, Union
@@ -21,20 +23,46 @@ from .constants import (
     BASE_MESSAGING_URL,
     CAPTURE_FAILED_TIMEOUT_S,
     CAPTURE_SHELL_PATH,
+    CONTAINER_LABEL_CONTROLLER,
+    CONTAINER_LABEL_EXPERIENCE,
+    CONTAINER_LABEL_GENERATION,
     EXPERIENCE_DATA_PATH,
+    FAILURE_FALLBACK_POLL_INTERVAL_S,
+    FAILURE_POLL_INTERVAL_S,
     PACKAGE_STATIC_PATH,
 )
 from .data.capture import CaptureApi, get_capture_api
+from .data.container_pool import ContainerPool, get_container_pool
+from .data.docker_api import CONTROLLER_INSTANCE_ID, DockerApi, get_docker_api
+from .data.images import ImageManager, get_image_manager
+from .data.load_times import LoadTimeManager, get_load_time_manager
 from .data.video_devices import VideoDeviceManager, get_video_device_manager
-from .util import mercilessly_kill_process
+from .util import mercilessly_kill_process, watch_process_exit
 
 logger = logging.getLogger(__name__)
 
-try:
-    docker_client = docker.from_env()
-except docker.errors.DockerException:
-    docker_client = None
-    logger.warning("Couldn't create Docker client, Docker experiences will be disabled")
+# Every container we launch gets a new generation, so that cleanup can tell which
+# containers are still owned by a live environment
+_container_generations = itertools.count(1)
+
+# Environments that currently own a container, whether or not the catalog still holds
+# them: a reload can replace the experience that's on screen. Only touched on the event
+# loop, and held weakly so that environments we've lost track of don't keep their
+# containers alive.
+_container_owners: weakref.WeakSet[DockerEnvironment] = weakref.WeakSet()
+
+
+def create_shared_resources():
+    """
+    Create the singletons environments share ahead of time. Experiences can be loaded
+    on worker threads, where creating them could race or wouldn't find an event loop.
+    """
+    get_docker_api()
+    get_container_pool()
+    get_image_manager()
+    get_video_device_manager()
+    get_capture_api()
+    get_load_time_manager()
 
 
 class EnvironmentInitializationError(Exception):
@@ -63,23 +91,44 @@ class EnvironmentState(enum.Enum):
                 ↓
               failed
 
+    Environments can also be warmed up ahead of time with prepare(), which goes
+    through starting and settles on prepared. A later start() picks up from there:
+
+    idle → starting → prepared → starting → running
+                         ↓
+                      stopping → stopped
+
     """
 
     IDLE = enum.auto()
     STARTING = enum.auto()
+    PREPARED = enum.auto()
     RUNNING = enum.auto()
     STOPPING = enum.auto()
     STOPPED = enum.auto()
     FAILED = enum.auto()
 
 
+FailureListener = Callable[["BaseEnvironment"], None]
+
+_PREPARABLE_STATES = [
+    EnvironmentState.IDLE,
+    EnvironmentState.STOPPED,
+    EnvironmentState.FAILED,
+]
+
+
 class BaseEnvironment(
     abc.ABC,
 ):
     _state: EnvironmentState
+    _failure_listeners: List[FailureListener]
+    _failure_unwatchers: List[Callable[[], None]]
 
     def __init__(self):
         self._state = EnvironmentState.IDLE
+        self._failure_listeners = []
+        self._failure_unwatchers = []
 
     async def _attempt_state_transition(
         self,
@@ -99,10 +148,31 @@ class BaseEnvironment(
             raise
         self._state = settled_state
 
+    async def can_prepare(self) -> bool:
+        """
+        Whether prepare() would go ahead right now, which it won't while the
+        environment is still running or stopping from the last time it was shown.
+        """
+        return (await self.state()) in _PREPARABLE_STATES
+
+    async def prepare(self):
+        await self._attempt_state_transition(
+            _PREPARABLE_STATES,
+            EnvironmentState.STARTING,
+            EnvironmentState.PREPARED,
+            self._prepare,
+        )
+
     async def start(self, last_environment: Optional[BaseEnvironment] = None):
+        start_fn = (
+            self._start_prepared
+            if self._state == EnvironmentState.PREPARED
+            else self._start
+        )
         await self._attempt_state_transition(
             [
                 EnvironmentState.IDLE,
+                EnvironmentState.PREPARED,
                 EnvironmentState.STOPPING,
                 EnvironmentState.STOPPED,
                 # TODO: This is in violation of the state diagram. We should think about
@@ -112,15 +182,20 @@ class BaseEnvironment(
             ],
             EnvironmentState.STARTING,
             EnvironmentState.RUNNING,
-            lambda: self._start(last_environment),
+            lambda: start_fn(last_environment),
         )
+        self._failure_unwatchers = self._watch_failures()
 
     async def stop(self, next_environment: Optional[BaseEnvironment] = None):
+        # We're about to take the environment down on purpose, so any exit from here
+        # on isn't a failure
+        self._unwatch_failures()
         await self._attempt_state_transition(
             # Not sure if this is okay
             [
                 EnvironmentState.RUNNING,
                 EnvironmentState.STARTING,
+                EnvironmentState.PREPARED,
                 EnvironmentState.FAILED,
             ],
             EnvironmentState.STOPPING,
@@ -136,10 +211,77 @@ class BaseEnvironment(
     async def _stop(self, next_environment: Optional[BaseEnvironment] = None):
         ...
 
+    async def _prepare(self):
+        """
+        Do as much of the work of starting as possible without putting anything on
+        screen. Environments that can't be warmed up just start cold.
+        """
+        pass
+
+    async def _start_prepared(self, last_environment: Optional[BaseEnvironment] = None):
+        await self._start(last_environment)
+
     @abc.abstractmethod
     async def state(self) -> EnvironmentState:
         ...
 
+    async def wait_ready(self) -> bool:
+        """
+        Wait until a started environment has put its first frame on screen. Returns
+        False straight away if the environment has no way of telling, in which case
+        callers have to find out some other way.
+        """
+        return False
+
+    def add_failure_listener(self, listener: FailureListener):
+        self._failure_listeners.append(listener)
+
+    def remove_failure_listener(self, listener: FailureListener):
+        if listener in self._failure_listeners:
+            self._failure_listeners.remove(listener)
+
+    def _watch_failures(self) -> List[Callable[[], None]]:
+        """
+        Arm push-based failure notifications for a running environment, returning a
+        function for each source that disarms it. Environments that can't push
+        failures return an empty list and are polled through state() instead.
+        """
+        return []
+
+    def _unwatch_failures(self):
+        for unwatch in self._failure_unwatchers:
+            unwatch()
+        self._failure_unwatchers = []
+
+    def mark_failed(self, reason: str):
+        """
+        Mark a running environment as failed from the outside, e.g. when it's still
+        running but something else tells us it isn't healthy.
+        """
+        self._notify_failed(reason)
+
+    def _notify_failed(self, reason: str):
+        if self._state != EnvironmentState.RUNNING:
+            return
+
+        logger.warning(f"Environment {type(self).__name__} failed: {reason}")
+        self._state = EnvironmentState.FAILED
+        self._unwatch_failures()
+        for listener in list(self._failure_listeners):
+            listener(self)
+
+    @property
+    def failure_poll_interval(self) -> float:
+        """
+        How often state() should be polled for failures. Environments with push-based
+        failure notifications armed only need the occasional fallback check.
+        """
+        return (
+            FAILURE_FALLBACK_POLL_INTERVAL_S
+            if self._failure_unwatchers
+            else FAILURE_POLL_INTERVAL_S
+        )
+
     # TODO: Make this a regular function, not a property getter
     #  See https://python.org/dev/peps/pep-0008/#designing-for-inheritance:
     #  > Avoid using properties for computationally expensive operations; the attribute notation makes the caller
@@ -165,9 +307,24 @@ class _BaseWebEnvironment(BaseEnvironment):
     async def _start(self, last_environment=None):
         await self._runner.start()
 
+    async def _prepare(self):
+        # The browser window would show up in the viewport as soon as it's mapped, so
+        # we can only get the static server ready ahead of time
+        await self._runner.prepare()
+
     async def _stop(self, next_environment=None):
         await self._runner.stop()
 
+    async def wait_ready(self) -> bool:
+        await self._runner.wait_ready()
+        return True
+
+    def _watch_failures(self):
+        unwatch = self._runner.watch_browser_exit(
+            lambda: self._notify_failed("web shell exited")
+        )
+        return [unwatch] if unwatch else []
+
     def _check_static_path(self):
         if self._static_path.exists():
             return
@@ -210,9 +367,13 @@ class VideoEnvironment(_BaseWebEnvironment):
 class DockerEnvironment(BaseEnvironment):
     _id: str
     _container: Optional[Container]
+    _generation: Optional[int]
+    _docker: Optional[DockerApi]
+    _pool: Optional[ContainerPool]
+    _poolable: bool
     _video_devices: VideoDeviceManager
     _host_network: Optional[int]
-    _image_exists: Optional[bool]
+    _images: Optional[ImageManager]
     _data_path: Optional[Path]
 
     def __init__(
@@ -225,15 +386,31 @@ class DockerEnvironment(BaseEnvironment):
         self._id = id
         self._image_id = image_id
         self._container = None
+        self._generation = None
+        self._docker = get_docker_api()
+        self._pool = get_container_pool()
+        self._poolable = False
         self._video_devices = get_video_device_manager()
         self._host_network = host_network
-        self._image_exists = None
+        self._images = get_image_manager()
         self._data_path = EXPERIENCE_DATA_PATH / image_id.replace(":", "_").replace(
             "/", "_"
         )
         self._data_path.mkdir(parents=True, exist_ok=True)
 
-    async def _start(self, last_environment=None):
+    @property
+    def container_id(self) -> Optional[str]:
+        return self._container.id if self._container else None
+
+    def _claim_generation(self, generation: int):
+        self._generation = generation
+        _container_owners.add(self)
+
+    def _release_generation(self):
+        self._generation = None
+        _container_owners.discard(self)
+
+    async def _create_container(self) -> Container:
         # For now, we will expose only our center webcam as /dev/video0 within
         # containers
         video_devices = [
@@ -241,15 +418,22 @@ class DockerEnvironment(BaseEnvironment):
             for name, path in self._video_devices.devices.items()
         ]
         network_config = {"network_mode": "host"} if self._host_network else {}
-        self._container = docker_client.containers.run(
+        # We claim the generation before the container exists so that a cleanup sweep
+        # running while it's being created doesn't consider it rogue
+        self._claim_generation(next(_container_generations))
+        return await self._docker.create_container(
             self._image_id,
             detach=True,
+            labels={
+                CONTAINER_LABEL_EXPERIENCE: self._id,
+                CONTAINER_LABEL_CONTROLLER: CONTROLLER_INSTANCE_ID,
+                CONTAINER_LABEL_GENERATION: str(self._generation),
+            },
             volumes={
                 "/tmp/.X11-unix": {"bind": "/tmp/.X11-unix", "mode": "rw"},
                 str(self._data_path): {"bind": "/localdata", "mode": "rw"},
             },
-            remove=True,
-            stdout=False,
+            auto_remove=True,
             environment=[
                 f"DISPLAY={os.environ['DISPLAY']}",
                 "NVIDIA_DRIVER_CAPABILITIES=all",
@@ -265,47 +449,200 @@ class DockerEnvironment(BaseEnvironment):
             **network_config,
         )
 
-    def _kill_container_checked(self, container: Container):
-        container.reload()
-        if container.status != "running":
+    async def _start(self, last_environment=None):
+        if self._pool and (container := await self._pool.checkout(self._id)):
+            self._container = container
+            self._claim_generation(int(container.labels[CONTAINER_LABEL_GENERATION]))
+            return
+        self._container = await self._create_container()
+        await self._docker.start_container(self._container)
+
+    async def _prepare(self):
+        # A pooled container is already warmer than anything we could prepare
+        if self._pool and self._id in self._pool:
+            return
+        # Creating the container is the part we can do without the experience showing
+        # up on screen
+        self._container = await self._create_container()
+
+    async def _start_prepared(self, last_environment=None):
+        if not self._container:
+            await self._start(last_environment)
             return
+        await self._docker.start_container(self._container)
 
+    @staticmethod
+    async def _kill_container(docker_api: DockerApi, container: Container):
         try:
-            container.kill()
-        except docker.errors.APIError as e:
+            status = await docker_api.container_status(container)
+            if status == "created":
+                # Prepared containers that never started won't remove themselves
+                await docker_api.remove_container(container)
+                return
+            if status == "paused":
+                # e.g. pooled by a previous controller. Older Docker versions refuse to
+                # kill paused containers.
+                await docker_api.unpause_container(container)
+            elif status != "running":
+                return
+            await docker_api.kill_container(container)
+        except docker.errors.NotFound:
+            # Containers are started with auto_remove, so it may be gone already
+            return
+        except (docker.errors.APIError, asyncio.TimeoutError):
             logger.exception(
-                f"Docker errored while trying to kill container for app ID {self._id}:"
+                f"Docker errored while trying to kill container {container.short_id}:"
             )
 
+    async def _kill_container_checked(self, container: Container):
+        await self._kill_container(self._docker, container)
+
     async def shutdown_by_tag(self):
-        matching_containers = docker_client.containers.list(
-            filters={"ancestor": self._image_id, "status": "running"}
+        matching_containers = await self._docker.list_containers(
+            filters={
+                "label": f"{CONTAINER_LABEL_EXPERIENCE}={self._id}",
+                "status": "running",
+            }
         )
+        # Pooled containers are paused rather than running, but we make sure not to
+        # reap them either way
+        if self._pool:
+            pooled_ids = self._pool.container_ids()
+            matching_containers = [
+                container
+                for container in matching_containers
+                if container.id not in pooled_ids
+            ]
         if not matching_containers:
             return
         logger.warning(
-            f"Found live containers with image ID {self._image_id}, attempting to kill in 1s"
+            f"Found live containers for app ID {self._id}, attempting to kill them"
+        )
+        await asyncio.gather(*map(self._kill_container_checked, matching_containers))
+
+    @staticmethod
+    async def cleanup_rogue_containers():
+        """
+        Kill every container we launched that isn't owned by a live environment or
+        the container pool, in a single sweep over our labelled containers.
+        """
+        docker_api = get_docker_api()
+        if not docker_api:
+            return
+
+        # Including containers that were created but never started, e.g. prepared
+        # for an experience that was never shown
+        containers = await docker_api.list_containers(
+            filters={"label": CONTAINER_LABEL_EXPERIENCE}, all=True
         )
-        await asyncio.sleep(1)
-        list(map(self._kill_container_checked, matching_containers))
+        # Only once we have the list, so that containers claimed while we were
+        # waiting for it aren't taken for rogue ones
+        live_generations = {
+            str(environment._generation)
+            for environment in _container_owners
+            if environment._generation is not None
+        }
+        pool = get_container_pool()
+        pooled_ids = pool.container_ids() if pool else set()
+        rogue_containers = [
+            container
+            for container in containers
+            if container.id not in pooled_ids
+            and (
+                container.labels.get(CONTAINER_LABEL_CONTROLLER)
+                != CONTROLLER_INSTANCE_ID
+                or container.labels.get(CONTAINER_LABEL_GENERATION)
+                not in live_generations
+            )
+        ]
+        if not rogue_containers:
+            return
+
+        logger.warning(
+            f"Found {len(rogue_containers)} rogue experience containers, killing them"
+        )
+        await asyncio.gather(
+            *(
+                DockerEnvironment._kill_container(docker_api, container)
+                for container in rogue_containers
+            )
+        )
+
+    def _watch_failures(self):
+        return [
+            self._docker.watch_container(
+                self._container.id,
+                lambda event: self._notify_failed(
+                    f"container received '{event.get('Action')}' event"
+                ),
+            )
+        ]
+
+    async def wait_ready(self) -> bool:
+        container = self._container
+        # Only images with a HEALTHCHECK can tell us when they're ready
+        if not container or not container.attrs.get("Config", {}).get("Healthcheck"):
+            return False
+
+        healthy = asyncio.get_event_loop().create_future()
+
+        def on_health_event(event):
+            if event.get("Action") == "health_status: healthy" and not healthy.done():
+                healthy.set_result(None)
+
+        unwatch = self._docker.watch_container_health(container.id, on_health_event)
+        try:
+            # It may have become healthy before we started listening, e.g. if it came
+            # out of the pool
+            if await self._docker.container_health(container) != "healthy":
+                await healthy
+        except (docker.errors.APIError, asyncio.TimeoutError):
+            logger.exception(f"Couldn't get health of container for app ID {self._id}")
+            return False
+        finally:
+            unwatch()
+        return True
+
+    async def stop(self, next_environment: Optional[BaseEnvironment] = None):
+        # Only healthy containers are worth keeping around
+        self._poolable = self._state == EnvironmentState.RUNNING
+        await super().stop(next_environment)
 
     async def _stop(self, next_environment=None):
-        self._kill_container_checked(self._container)
+        if (
+            self._poolable
+            and self._pool
+            and await self._pool.checkin(self._id, self._container)
+        ):
+            # The pool owns the container now
+            self._container = None
+            self._release_generation()
+            return
+
+        if self._container:
+            await self._kill_container_checked(self._container)
         await self.shutdown_by_tag()
         self._container = None
+        self._release_generation()
 
     async def state(self) -> EnvironmentState:
         if self._state != EnvironmentState.RUNNING:
             return self._state
 
         try:
-            self._container.reload()
-            container_status = self._container.status
+            container_status = await self._docker.container_status(self._container)
         except docker.errors.NotFound as e:
             logger.exception(
                 f"Docker errored while trying to get state of container for app ID {self._id}"
             )
             return EnvironmentState.FAILED
+        except asyncio.TimeoutError:
+            # A slow daemon doesn't mean the container died, so we'll check again on
+            # the next pass
+            logger.warning(
+                f"Timed out while getting state of container for app ID {self._id}"
+            )
+            return EnvironmentState.RUNNING
 
         if container_status in ["running", "created"]:
             return EnvironmentState.RUNNING
@@ -314,30 +651,9 @@ class DockerEnvironment(BaseEnvironment):
 
     @property
     def available(self) -> bool:
-        if not docker_client:
-            return False
-        if self._image_exists is not None:
-            return self._image_exists
-
-        try:
-            docker_client.images.get(self._image_id)
-            self._image_exists = True
-            return True
-        except docker.errors.ImageNotFound:
-            logger.info(
-                f"Couldn't find Docker image '{self._image_id}' locally, attempting to pull..."
-            )
-            try:
-                docker_client.images.pull(self._image_id)
-            except docker.errors.NotFound:
-                logger.warning(
-                    f"Couldn't find Docker image '{self._image_id}', experience will be disabled"
-                )
-                self._image_exists = False
-                return False
-
-            self._image_exists = True
-            return True
+        # Missing images are pulled in the background by the image manager, see
+        # Controller._defer_experience
+        return bool(self._images) and self._images.present(self._image_id)
 
 
 class CaptureEnvironment(BaseEnvironment):
@@ -347,6 +663,7 @@ class CaptureEnvironment(BaseEnvironment):
 
     _capture_process: Optional[subprocess.Popen]
     _api: CaptureApi
+    _load_times: LoadTimeManager
     _start_time: Optional[datetime]
 
     def __init__(self, id: str, path: str, load_time: Optional[int] = None):
@@ -356,6 +673,8 @@ class CaptureEnvironment(BaseEnvironment):
         self._load_time = load_time
 
         self._api = get_capture_api()
+        self._load_times = get_load_time_manager()
+        self._capture_process = None
         self._start_time = None
 
     async def _start_capture_api(self):
@@ -379,6 +698,19 @@ class CaptureEnvironment(BaseEnvironment):
         await self._start_capture_api()
         await self._start_capture_process()
 
+    def _watch_failures(self):
+        # The capture API on the Windows side can only be polled, so this only covers
+        # the local capture shell
+        unwatch = watch_process_exit(
+            self._capture_process,
+            lambda: self._notify_failed("capture shell exited"),
+        )
+        return [unwatch] if unwatch else []
+
+    @property
+    def failure_poll_interval(self) -> float:
+        return FAILURE_POLL_INTERVAL_S
+
     async def _stop(self, next_environment=None):
         await self._stop_capture_process()
         if not next_environment or not isinstance(next_environment, CaptureEnvironment):
@@ -389,9 +721,10 @@ class CaptureEnvironment(BaseEnvironment):
             return self._state
 
         capture_experience_response = await self._api.current_experience()
+        load_time = self._load_times.load_time(self._id, self._load_time)
         capture_timeout = (
-            max(self._load_time, CAPTURE_FAILED_TIMEOUT_S)
-            if self._load_time
+            max(load_time, CAPTURE_FAILED_TIMEOUT_S)
+            if load_time
             else CAPTURE_FAILED_TIMEOUT_S
         )
         if not self._start_time or (
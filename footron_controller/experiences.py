@@ -2,19 +2,38 @@ from __future__ import annotations
 
 import abc
 import asyncio
+import hashlib
 import json
-import operator
+import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from typing import Dict, Generic, List, Optional, Type, TypeVar
+from typing import (
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Optional,
+    Type,
+    TypeVar,
+)
 
 import footron_protocol as protocol
 import tomli
 from pydantic import BaseModel, PrivateAttr, root_validator, validator
 
-from .constants import EXPERIENCES_PATH, VIDEO_ACTION_HINTS, JsonDict
+from .constants import (
+    CATALOG_AVAILABILITY_WORKERS,
+    CATALOG_LOAD_WORKERS,
+    EXPERIENCES_PATH,
+    FROZEN_DISPLAY_TIMEOUTS_S,
+    VIDEO_ACTION_HINTS,
+    JsonDict,
+)
+from .data.catalog_snapshot import get_catalog_snapshot, input_key
 from .data.wm import DisplayLayout
 from .environments import (
     BaseEnvironment,
@@ -22,11 +41,15 @@ from .environments import (
     DockerEnvironment,
     VideoEnvironment,
     WebEnvironment,
+    create_shared_resources,
 )
 
+logger = logging.getLogger(__name__)
+
 _DEFAULT_LIFETIME = 60
 _FIELD_TYPE = "type"
 _CONFIG_FILENAME = "config"
+_THUMBNAIL_FILENAME = "thumb.jpg"
 
 
 class ExperienceType(str, Enum):
@@ -51,9 +74,15 @@ class BaseExperience(BaseModel, abc.ABC, Generic[EnvironmentType]):
     unlisted: bool = False
     queueable: bool = True
     load_time: Optional[int] = None
+    # Seconds the viewport can look the same before the experience is considered
+    # frozen, 0 to never check. Defaults to FROZEN_DISPLAY_TIMEOUTS_S for its type.
+    frozen_timeout: Optional[int] = None
     action_hints: List[str] = []
     experience_path: Path
     _environment: EnvironmentType = PrivateAttr()
+    # Computed while loading the catalog so that nobody has to read the thumbnail on
+    # the event loop. None for unlisted experiences and missing thumbnails.
+    _thumbnail_hash: Optional[str] = PrivateAttr(None)
 
     def __init__(self, **data):
         super().__init__(**data)
@@ -67,6 +96,26 @@ class BaseExperience(BaseModel, abc.ABC, Generic[EnvironmentType]):
     def environment(self) -> BaseEnvironment:
         return self._environment
 
+    @property
+    def thumbnail_path(self) -> Path:
+        return self.experience_path / _THUMBNAIL_FILENAME
+
+    @property
+    def thumbnail_hash(self) -> Optional[str]:
+        return self._thumbnail_hash
+
+    @property
+    def frozen_display_timeout(self) -> int:
+        if self.frozen_timeout is not None:
+            return self.frozen_timeout
+        return FROZEN_DISPLAY_TIMEOUTS_S[self.type.value]
+
+    @validator("frozen_timeout")
+    def frozen_timeout_not_negative(cls, value):
+        if value is not None and value < 0:
+            raise ValueError("'frozen_timeout' can't be negative, use 0 to disable")
+        return value
+
     @validator("long_description")
     def long_description_requires_description(cls, value, values):
         if "description" not in values or values["description"] is None:
@@ -75,6 +124,9 @@ class BaseExperience(BaseModel, abc.ABC, Generic[EnvironmentType]):
             )
         return value
 
+    async def prepare(self):
+        await self._environment.prepare()
+
     async def start(self, last_experience: Optional[BaseExperience] = None):
         last_environment = last_experience._environment if last_experience else None
         await self._environment.start(last_environment)
@@ -105,9 +157,6 @@ class DockerExperience(BaseExperience[DockerEnvironment]):
     def _create_environment(self) -> DockerEnvironment:
         return DockerEnvironment(self.id, self.image_id, self.host_network)
 
-    async def attempt_cleanup(self):
-        await self._environment.shutdown_by_tag()
-
 
 class WebExperience(BaseExperience[WebEnvironment]):
     type = ExperienceType.Web
@@ -260,17 +309,104 @@ def _load_config_at_path(path: Path):
         return
 
 
+def _restore_experience(data: JsonDict) -> BaseExperience:
+    # Already validated when it was cached, so we skip straight to building the model
+    experience = experience_type_map[data[_FIELD_TYPE]].construct(**data)
+    experience._environment = experience._create_environment()
+    return experience
+
+
+def _hash_thumbnail(thumb_path: Path) -> Optional[str]:
+    snapshot = get_catalog_snapshot()
+    key = input_key(thumb_path)
+    hash = snapshot.get(str(thumb_path), key)
+    if hash is None:
+        try:
+            hash = hashlib.sha256(thumb_path.read_bytes()).hexdigest()
+        except FileNotFoundError:
+            return None
+        snapshot.put(str(thumb_path), key, hash)
+    return hash
+
+
 def _load_experience_at_path(path: Path) -> Optional[BaseExperience]:
     if not path.is_dir():
         return
 
-    return _deserialize_experience(_load_config_at_path(path), path)
-
+    snapshot = get_catalog_snapshot()
+    key = input_key(
+        path / f"{_CONFIG_FILENAME}.json", path / f"{_CONFIG_FILENAME}.toml"
+    )
+    cached = snapshot.get(str(path), key)
+    if cached is not None:
+        experience = _restore_experience(cached)
+    else:
+        config = _load_config_at_path(path)
+        if config is None:
+            return
 
-def load_experiences_fs(path=EXPERIENCES_PATH):
-    return list(
-        filter(
-            operator.attrgetter("available"),
-            map(_load_experience_at_path, path.iterdir()),
-        )
+        experience = _deserialize_experience(config, path)
+        snapshot.put(str(path), key, experience.dict())
+
+    # Only listed experiences show up in the web interface, which is what the
+    # thumbnail's colors are for
+    if not experience.unlisted:
+        experience._thumbnail_hash = _hash_thumbnail(experience.thumbnail_path)
+    return experience
+
+
+async def load_experiences_fs(
+    on_available: Callable[[BaseExperience], None],
+    on_unavailable: Optional[Callable[[BaseExperience], None]] = None,
+    path=EXPERIENCES_PATH,
+    experience_paths: Optional[Iterable[Path]] = None,
+) -> List[BaseExperience]:
+    """
+    Load every experience under `path` in parallel, calling `on_available` as soon as
+    each one turns out to be available and `on_unavailable` for the ones that
+    aren't. Configs are parsed and validated on a thread pool, and availability
+    (which may mean asking the Docker daemon about an image) is checked on another so
+    that a slow daemon doesn't hold up parsing. Experiences that fail to load are
+    logged and skipped.
+
+    Pass `experience_paths` to only load those experience directories instead of
+    everything under `path`.
+    """
+    loop = asyncio.get_event_loop()
+    create_shared_resources()
+    paths = (
+        list(experience_paths)
+        if experience_paths is not None
+        else await loop.run_in_executor(None, lambda: list(path.iterdir()))
     )
+
+    with ThreadPoolExecutor(
+        max_workers=CATALOG_LOAD_WORKERS, thread_name_prefix="catalog-load"
+    ) as load_executor, ThreadPoolExecutor(
+        max_workers=CATALOG_AVAILABILITY_WORKERS,
+        thread_name_prefix="catalog-availability",
+    ) as availability_executor:
+
+        async def load(experience_path: Path) -> Optional[BaseExperience]:
+            try:
+                experience = await loop.run_in_executor(
+                    load_executor, _load_experience_at_path, experience_path
+                )
+                if not experience:
+                    return None
+                available = await loop.run_in_executor(
+                    availability_executor, lambda: experience.available
+                )
+            except Exception:
+                logger.exception(f"Couldn't load experience at '{experience_path}'")
+                return None
+            if not available:
+                if on_unavailable:
+                    on_unavailable(experience)
+                return None
+            on_available(experience)
+            return experience
+
+        experiences = await asyncio.gather(*map(load, paths))
+
+    return [experience for experience in experiences if experience]
@@ -0,0 +1,249 @@
+"""
+Minimal in-process metrics, rendered in the Prometheus text exposition format.
+
+Recording a sample is a dict lookup and an addition, and nothing is formatted until
+someone scrapes /metrics, so instrumenting hot paths is close to free.
+"""
+
+import abc
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+_DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    name: str
+    documentation: str
+    label_names: Tuple[str, ...]
+    type: str
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self._render_samples()
+
+    @abc.abstractmethod
+    def _render_samples(self) -> Iterable[str]:
+        ...
+
+
+class Counter(Metric):
+    type = "counter"
+    _values: Dict[LabelValues, float]
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._label_values(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self):
+        for key, value in self._values.items():
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """
+    A value that can go up and down. Gauges created with `function` are unlabelled
+    and read their value from it at scrape time instead.
+    """
+
+    type = "gauge"
+    _values: Dict[LabelValues, float]
+    _function: Optional[Callable[[], float]]
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+        self._function = function
+
+    def set(self, value: float, **labels: str):
+        self._values[self._label_values(labels)] = value
+
+    def _render_samples(self):
+        if self._function:
+            yield f"{self.name} {_format_value(self._function())}"
+            return
+
+        for key, value in self._values.items():
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+    _buckets: Tuple[float, ...]
+    # Label values -> (per-bucket counts, sum, count)
+    _values: Dict[LabelValues, Tuple[List[int], float, int]]
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = _DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self._buckets = (*sorted(buckets), math.inf)
+        self._values = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._label_values(labels)
+        counts, total, count = self._values.get(key, ([0] * len(self._buckets), 0.0, 0))
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self):
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    (*self.label_names, "le"), (*key, _format_value(bound))
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class MetricsRegistry:
+    _metrics: List[Metric]
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = (line for metric in self._metrics for line in metric.render())
+        return "".join(f"{line}\n" for line in lines)
+
+
+registry = MetricsRegistry()
+
+transition_phase_seconds = registry.register(
+    Histogram(
+        "footron_transition_phase_seconds",
+        "Time spent in each phase of an experience transition",
+        ["phase", "experience_type"],
+    )
+)
+transition_seconds = registry.register(
+    Histogram(
+        "footron_transition_seconds",
+        "Total time to switch to an experience",
+        ["experience_type"],
+    )
+)
+throttle_rejections = registry.register(
+    Counter(
+        "footron_throttle_rejections_total",
+        "Experience changes rejected with HTTP 429",
+        ["reason"],
+    )
+)
+transitions = registry.register(
+    Counter(
+        "footron_transitions_total",
+        "Finished experience transitions",
+        ["outcome"],
+    )
+)
+environment_failures = registry.register(
+    Counter(
+        "footron_environment_failures_total",
+        "Running environments that failed",
+        ["experience_type"],
+    )
+)
+frozen_displays = registry.register(
+    Counter(
+        "footron_frozen_displays_total",
+        "Running experiences failed because their picture froze",
+        ["experience_type"],
+    )
+)
+frozen_display_sample_seconds = registry.register(
+    Histogram(
+        "footron_frozen_display_sample_seconds",
+        "Time to capture a viewport thumbnail for frozen display detection",
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+    )
+)
+placard_retries = registry.register(
+    Counter("footron_placard_retries_total", "Placard updates that had to be retried")
+)
+color_jobs = registry.register(
+    Counter(
+        "footron_color_jobs_total",
+        "Thumbnail color extraction jobs",
+        ["state"],
+    )
+)
+event_loop_lag_seconds = registry.register(
+    Gauge(
+        "footron_event_loop_lag_seconds",
+        "How late the last event loop lag probe woke up",
+    )
+)
+event_loop_lag_max_seconds = registry.register(
+    Gauge(
+        "footron_event_loop_lag_max_seconds",
+        "Worst event loop lag seen in the last minute",
+    )
+)
@@ -0,0 +1,94 @@
+import gzip
+import json
+from typing import Any, Dict, Optional
+
+import brotli
+
+_GZIP_LEVEL = 9
+# Brotli's highest qualities are much slower for very little gain on JSON
+_BROTLI_QUALITY = 9
+
+# In order of preference
+_ENCODINGS = ["br", "gzip"]
+
+
+class SerializedPayload:
+    """
+    A JSON response body that's encoded and compressed at most once per encoding and
+    then served as is, along with a strong ETag per encoding.
+
+    Payloads that are served over and over can be compressed up front with
+    `precompress`. Otherwise each encoding is only compressed the first time it's
+    asked for, since one-off payloads (e.g. filtered queries) are usually served only
+    once.
+    """
+
+    version: str
+    _bodies: Dict[Optional[str], bytes]
+
+    def __init__(self, data: Any, version: str, precompress: bool = False):
+        self.version = version
+        self._bodies = {None: json.dumps(data, separators=(",", ":")).encode()}
+        if precompress:
+            for encoding in _ENCODINGS:
+                self.body(encoding)
+
+    def body(self, encoding: Optional[str]) -> bytes:
+        body = self._bodies.get(encoding)
+        if body is None:
+            body = _compress(self._bodies[None], encoding)
+            self._bodies[encoding] = body
+        return body
+
+    def etag(self, encoding: Optional[str]) -> str:
+        # Strong ETags have to differ between encodings of the same content
+        return f'"{self.version}-{encoding}"' if encoding else f'"{self.version}"'
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=_GZIP_LEVEL, mtime=0)
+    if encoding == "br":
+        return brotli.compress(body, mode=brotli.MODE_TEXT, quality=_BROTLI_QUALITY)
+    raise ValueError(f"Unsupported encoding '{encoding}'")
+
+
+def preferred_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    The compression to use given an Accept-Encoding header, or None for none.
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        if quality > 0:
+            accepted.add(coding.strip().lower())
+
+    for encoding in _ENCODINGS:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
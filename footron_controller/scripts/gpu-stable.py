@@ -1,12 +1,34 @@
 #!/usr/bin/python3
 
+# Checks whether we can still put a tensor on the GPU. Run without arguments for a
+# single check (exit code 0 means stable), or with --serve to keep torch and the CUDA
+# context loaded and answer a check for every line received on stdin with "ok" or
+# "fail".
+
+import argparse
 import sys
 
 import torch
 
-if __name__ == "__main__":
+
+def probe(device: str) -> bool:
     try:
-        torch.Tensor([1]).to("cuda")
-        sys.exit(0)
+        torch.Tensor([1]).to(device)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return True
     except RuntimeError:
-        sys.exit(1)
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--device", default="cuda")
+    args = parser.parse_args()
+
+    if not args.serve:
+        sys.exit(0 if probe(args.device) else 1)
+
+    for _ in sys.stdin:
+        print("ok" if probe(args.device) else "fail", flush=True)
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import bisect
+import math
+import re
+import unicodedata
+from typing import Dict, List, Mapping, Tuple
+
+from .experiences import BaseExperience
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+# How much a match in each field counts towards an experience's score
+_FIELD_WEIGHTS = {
+    "id": 2.0,
+    "title": 4.0,
+    "artist": 2.0,
+    "description": 1.5,
+    "long_description": 1.0,
+}
+
+# A query token that's only the start of a term (e.g. while the user is still typing)
+# counts for less than the whole term
+_PREFIX_MATCH_FACTOR = 0.5
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase words with accents removed, so that e.g. "Café" matches "cafe".
+    """
+    normalized = unicodedata.normalize("NFKD", text.casefold())
+    return _TOKEN_PATTERN.findall(
+        "".join(char for char in normalized if not unicodedata.combining(char))
+    )
+
+
+class SearchIndex:
+    """
+    An inverted index from terms in experience metadata to the experiences that
+    contain them.
+
+    Every query token has to match, either as a whole term or as the start of one.
+    Experiences are ranked by how well each token matches them: which fields the
+    matching term is in, how rare the term is across the catalog, and whether the
+    match is exact.
+    """
+
+    # term -> {experience ID -> summed weight of the fields the term appears in}
+    _postings: Dict[str, Dict[str, float]]
+    # Sorted, for finding terms by prefix
+    _terms: List[str]
+    _idf: Dict[str, float]
+    _positions: Dict[str, int]
+
+    def __init__(self, experiences: Mapping[str, BaseExperience]):
+        self._postings = {}
+        self._positions = {}
+        for position, (id, experience) in enumerate(experiences.items()):
+            self._positions[id] = position
+            for field, weight in _FIELD_WEIGHTS.items():
+                text = getattr(experience, field)
+                if not text:
+                    continue
+                for term in set(tokenize(text)):
+                    postings = self._postings.setdefault(term, {})
+                    postings[id] = postings.get(id, 0) + weight
+
+        self._terms = sorted(self._postings)
+        count = len(experiences)
+        self._idf = {
+            term: math.log(1 + count / len(postings))
+            for term, postings in self._postings.items()
+        }
+
+    def _token_scores(self, token: str) -> Dict[str, float]:
+        scores: Dict[str, float] = {}
+        start = bisect.bisect_left(self._terms, token)
+        for term in self._terms[start:]:
+            if not term.startswith(token):
+                break
+            factor = self._idf[term]
+            if term != token:
+                factor *= _PREFIX_MATCH_FACTOR
+            for id, weight in self._postings[term].items():
+                scores[id] = max(scores.get(id, 0), weight * factor)
+        return scores
+
+    def search(self, query: str) -> List[Tuple[str, float]]:
+        """
+        (experience ID, score) for every experience matching `query`, best first.
+        """
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+
+        scores = None
+        # Rarest matches first, so we can stop as soon as nothing is left
+        for token_scores in sorted(map(self._token_scores, tokens), key=len):
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {
+                    id: score + token_scores[id]
+                    for id, score in scores.items()
+                    if id in token_scores
+                }
+            if not scores:
+                return []
+
+        return sorted(
+            scores.items(), key=lambda item: (-item[1], self._positions[item[0]])
+        )
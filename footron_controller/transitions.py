@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import asyncio
+import enum
+import logging
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+import rollbar
+
+from .metrics import transitions
+
+logger = logging.getLogger(__name__)
+
+# How many finished transitions we keep around for clients to look up
+_TRANSITION_HISTORY_SIZE = 100
+
+
+class TransitionStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    SUPERSEDED = "superseded"
+    FAILED = "failed"
+
+
+class Transition:
+    """
+    A request to switch the current experience, which clients can wait on through
+    its ID.
+    """
+
+    id: str
+    experience_id: Optional[str]
+    status: TransitionStatus
+    # Set by the controller while the transition is starting an experience and can
+    # be cancelled outright
+    preemptible: bool
+    created_at: datetime
+    finished_at: Optional[datetime]
+    _superseded: bool
+    _done: asyncio.Event
+
+    def __init__(self, experience_id: Optional[str]):
+        self.id = uuid.uuid4().hex
+        self.experience_id = experience_id
+        self.status = TransitionStatus.PENDING
+        self.preemptible = False
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self._superseded = False
+        self._done = asyncio.Event()
+
+    @property
+    def superseded(self) -> bool:
+        """
+        Whether a newer transition has been requested, in which case this one should
+        give up as soon as it can.
+        """
+        return self._superseded
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    async def wait(self) -> TransitionStatus:
+        await self._done.wait()
+        return self.status
+
+    def _finish(self, status: TransitionStatus):
+        self.status = status
+        self.finished_at = datetime.now()
+        transitions.inc(outcome=status.value)
+        self._done.set()
+
+
+TransitionRunner = Callable[[Transition], Awaitable[bool]]
+
+
+class TransitionScheduler:
+    """
+    Runs experience transitions one at a time, latest request wins. A new request
+    replaces the pending one instead of queueing behind it, and makes the running
+    transition give up: it's cancelled outright if it's in the middle of starting an
+    experience, and otherwise skips starting once it gets there.
+
+    The runner returns False if it gave up because it was superseded.
+    """
+
+    _run: TransitionRunner
+    _pending: Optional[Transition]
+    _active: Optional[Transition]
+    _active_task: Optional[asyncio.Task]
+    _worker: Optional[asyncio.Task]
+    _history: OrderedDict[str, Transition]
+
+    def __init__(self, run: TransitionRunner):
+        self._run = run
+        self._pending = None
+        self._active = None
+        self._active_task = None
+        self._worker = None
+        self._history = OrderedDict()
+
+    @property
+    def active(self) -> Optional[Transition]:
+        return self._active
+
+    @property
+    def latest(self) -> Optional[Transition]:
+        """
+        The transition that will win, if any is pending or running.
+        """
+        if self._pending:
+            return self._pending
+        if self._active and not self._active.superseded:
+            return self._active
+        return None
+
+    def get(self, id: str) -> Optional[Transition]:
+        return self._history.get(id)
+
+    def request(self, experience_id: Optional[str]) -> Transition:
+        # Coalesce with whatever is already headed for the same experience
+        if self._pending and self._pending.experience_id == experience_id:
+            return self._pending
+        if (
+            not self._pending
+            and self._active
+            and not self._active.superseded
+            and self._active.experience_id == experience_id
+        ):
+            return self._active
+
+        transition = Transition(experience_id)
+        self._remember(transition)
+        if self._pending:
+            # Never got to run, so there's nothing to clean up
+            self._pending._finish(TransitionStatus.SUPERSEDED)
+        self._pending = transition
+        self._preempt_active()
+
+        if not self._worker:
+            self._worker = asyncio.get_event_loop().create_task(self._work())
+        return transition
+
+    def _remember(self, transition: Transition):
+        self._history[transition.id] = transition
+        while len(self._history) > _TRANSITION_HISTORY_SIZE:
+            self._history.popitem(last=False)
+
+    def _preempt_active(self):
+        if not self._active or self._active.superseded:
+            return
+
+        self._active._superseded = True
+        if self._active.preemptible:
+            logger.info(
+                f"Cancelling start of experience '{self._active.experience_id}' for a "
+                "newer transition"
+            )
+            self._active.preemptible = False
+            self._active_task.cancel()
+
+    async def _work(self):
+        loop = asyncio.get_event_loop()
+        while self._pending:
+            transition, self._pending = self._pending, None
+            transition.status = TransitionStatus.RUNNING
+            self._active = transition
+            self._active_task = loop.create_task(self._run(transition))
+            try:
+                completed = await self._active_task
+            except asyncio.CancelledError:
+                transition._finish(TransitionStatus.SUPERSEDED)
+            except Exception as e:
+                rollbar.report_exc_info(e)
+                logger.exception(
+                    f"Error while transitioning to experience "
+                    f"'{transition.experience_id}'"
+                )
+                transition._finish(TransitionStatus.FAILED)
+            else:
+                transition._finish(
+                    TransitionStatus.COMPLETED
+                    if completed
+                    else TransitionStatus.SUPERSEDED
+                )
+            finally:
+                self._active = None
+                self._active_task = None
+        self._worker = None
@@ -1,11 +1,12 @@
 import asyncio
 import io
 import logging
+import os
 import socket
 import subprocess
 from contextlib import closing
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Optional
 
 from PIL import Image
 
@@ -23,6 +24,45 @@ async def mercilessly_kill_process(process: subprocess.Popen):
         await asyncio.sleep(1)
 
 
+def watch_process_exit(
+    process: subprocess.Popen, callback: Callable[[], None]
+) -> Optional[Callable[[], None]]:
+    """
+    Call `callback` on the event loop as soon as `process` exits, using a pidfd.
+
+    Returns a function that cancels the watch, or None if pidfds aren't supported
+    here (Python < 3.9 or Linux < 5.3), in which case callers should fall back to
+    polling.
+    """
+    if not hasattr(os, "pidfd_open"):
+        return None
+
+    try:
+        pidfd = os.pidfd_open(process.pid)
+    except OSError:
+        # Either pidfds aren't supported by this kernel or the process is already
+        # gone--polling will pick up the latter case
+        return None
+
+    loop = asyncio.get_event_loop()
+    closed = False
+
+    def unwatch():
+        nonlocal closed
+        if closed:
+            return
+        closed = True
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+    def on_readable():
+        unwatch()
+        callback()
+
+    loop.add_reader(pidfd, on_readable)
+    return unwatch
+
+
 # https://stackoverflow.com/a/45690594/1979008
 def find_free_port():
     with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
@@ -39,15 +79,13 @@ def timestamp_to_datetime(timestamp: int):
     return datetime.fromtimestamp(timestamp / 1000)
 
 
-async def create_image_bytes_generator(
-    image: Image,
-    width: Optional[int] = None,
-    height: Optional[int] = None,
-    quality: int = 95,
-    format: str = "jpeg",
-):
+def scale_image(
+    image: Image, width: Optional[int] = None, height: Optional[int] = None
+) -> Image:
+    """
+    Scales an image down (never up) to fit within the given width and height.
+    """
     image_width, image_height = image.size
-    image_bytes = io.BytesIO()
 
     width = width if width is not None else image_width
     height = height if height is not None else image_height
@@ -56,6 +94,18 @@ async def create_image_bytes_generator(
 
     if ratio != 1 and ratio != 0:
         image = image.resize((int(ratio * image_width), int(ratio * image_height)))
+    return image
+
+
+def encode_image(
+    image: Image,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    quality: int = 95,
+    format: str = "jpeg",
+) -> bytes:
+    image = scale_image(image, width, height)
+    image_bytes = io.BytesIO()
 
     format_params = {}
 
@@ -63,4 +113,4 @@ async def create_image_bytes_generator(
         format_params = {"quality": quality}
 
     image.save(image_bytes, format=format, **format_params)
-    yield image_bytes.getvalue()
+    return image_bytes.getvalue()
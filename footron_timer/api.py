@@ -11,6 +11,7 @@ CURRENT_EXPERIENCE_SET_DELAY_S = 10
 
 EXPERIENCES_ENDPOINT = "experiences"
 CURRENT_ENDPOINT = f"current?throttle={CURRENT_EXPERIENCE_SET_DELAY_S}"
+NEXT_ENDPOINT = "next"
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +23,7 @@ class TimerApi:
             self._url, EXPERIENCES_ENDPOINT
         )
         self._current_endpoint = urllib.parse.urljoin(self._url, CURRENT_ENDPOINT)
+        self._next_endpoint = urllib.parse.urljoin(self._url, NEXT_ENDPOINT)
         self._current = None
         self._last = None
         self.experiences = None
@@ -97,6 +99,21 @@ class TimerApi:
         self._current = current
         return True
 
+    def set_next(self, next) -> bool:
+        response = requests.put(
+            self._next_endpoint,
+            headers={"Content-Type": "application/json"},
+            json={"id": next.id if next else None},
+        )
+
+        if not response.ok:
+            logging.warning(
+                f"Couldn't prepare next experience, got HTTP {response.status_code}"
+            )
+            return False
+
+        return True
+
 
 class Playlist:
     def __init__(self, source) -> None:
@@ -115,6 +132,16 @@ class Playlist:
             return item.pop()
         return item
 
+    def peek(self):
+        if not self._shuffled:
+            self.reload()
+        if not self._shuffled:
+            return None
+        item = self._shuffled[-1]
+        if isinstance(item, Playlist):
+            return item.peek()
+        return item
+
     def reload(self):
         self._shuffled = self._source.copy()
         random.shuffle(self._shuffled)
@@ -9,6 +9,7 @@ class Experience(BaseModel):
     queueable: bool
     collection: Optional[str]
     lifetime: int
+    load_time: Optional[float]
     title: str
     artist: Optional[str]
     description: Optional[str]
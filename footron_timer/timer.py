@@ -45,9 +45,11 @@ class Timer:
         ):
             return False
 
+        # Lifetime counts from when the experience is expected to be on screen, so that
+        # slow loaders don't lose their time to the loading screen
         if (
             current_exp.start_time is not None
-            and current_exp.lifetime
+            and current_exp.lifetime + (current_exp.load_time or 0)
             > (current_date - dt.fromtimestamp(current_exp.start_time / 1000)).seconds
         ):
             return False
@@ -65,7 +67,10 @@ class Timer:
         return self._api.experiences.pop()
 
     def advance(self):
-        self._api.set_current(self._pop_next())
+        if self._api.set_current(self._pop_next()):
+            # Commercials are interleaved on a timer, so we only warm up the next
+            # regular experience
+            self._api.set_next(self._api.experiences.peek())
 
     def advance_if_ready(self):
         # Note that when we add support for an "up next" notification, we should ignore